@@ -18,16 +18,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from asyncio import sleep
+import sqlite3
+from asyncio import CancelledError, Lock, create_task, sleep, to_thread, wait
+from collections import namedtuple
+from contextlib import nullcontext
 from functools import wraps
-from time import time
+from time import perf_counter, time
+from weakref import WeakValueDictionary
 
-from telegram.constants import ParseMode, ChatType
+from telegram import Update
+from telegram.constants import ParseMode, ChatType, MessageLimit
 from telegram.ext import (
     Application,
-    CommandHandler,
-    AIORateLimiter,
-    ContextTypes
+    MessageHandler,
+    TypeHandler,
+    ContextTypes,
+    filters,
 )
 
 from const import (
@@ -60,18 +66,95 @@ from const import (
     JOKER,
     BEST,
     RULES,
+    ADVICE,
+    ODDS,
+    STATS,
+    TOP,
+    EMOJIS,
+    TABLE_BUILD_TIMEOUT,
+    SCORE_BUCKET,
+    TOP_RECENT_DAYS,
+    POSITIONS,
+    VARIANTS,
+    HTTP_POOL_SIZE,
+    HTTP_UPDATES_POOL_SIZE,
 )
-from creds import TOKEN
-from error import IllegalMoveError, PlayerError
+from advisor import (
+    advise,
+    choice_loss,
+    load_solvers,
+    load_value_tables,
+    solver_state,
+    win_advice,
+)
+from bonus import load_bonus_tables
+from catchup import catch_up, replaying
+from compute import ComputeService
+from creds import ADMINS, TOKEN
+from error import ComputeError, IllegalMoveError, PlayerError, TableError
+from export import TurnExporter
 from gamemanager import GameManager
+from handoff import Handoff
+from logs import kv, setup_logging
+from metrics import (
+    BotMetrics,
+    TimedRateLimiter,
+    bot_request,
+    import_times,
+    is_pool_timeout,
+    is_tracing,
+    rss,
+    stop_tracing,
+    top_allocators,
+)
+from replay import ReplayArchive
+from rollout import WinOdds, rollout_state
+from stats import StatsStore
+from tables import variant_name
+from tracing import setup_tracing, span, trace
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+stats = StatsStore()
+exporter = TurnExporter()
+archive = ReplayArchive()
+
 
-gamemanager = GameManager()
+def game_finished(game):
+    """Record results, turns and replay of a completed game"""
+    stats.record(game)
+    exporter.record(game)
+    archive.record(game)
+
+
+gamemanager = GameManager(on_finish=game_finished)
+handoff = Handoff(gamemanager)
+metrics = BotMetrics()
+compute = ComputeService(initializer=load_solvers)
+win_odds = WinOdds(compute)
 answer_timer = {}
+# Updates are processed concurrently, but one at a time for each table (a
+# lock lives only while some update for its table is being processed)
+table_locks = WeakValueDictionary()
+table_loader = None  # Task, which loads lookup tables in background
+catchup = None  # Task, which processes update backlog in background
+# Tasks, which measure skill loss of moves in background (by game id)
+metric_jobs = {}
+
+# A command parsed out of a message text (without slash and bot mention)
+Command = namedtuple('Command', ['name', 'args'])
+
+# Reroll pool management commands
+REROLL_COMMANDS = ['1', '2', '3', '4', '5', '6', 'dr', 'rr', 'sa', 'qr', 'q']
+# Commands, which only change reroll pool (logged as sampled events)
+DICE_TOGGLES = {'1', '2', '3', '4', '5', '6', 'rr', 'sa'}
+POOL_RESETS = {'rr', 'sa'}
+
+# Commands, which change nothing, when repeated right away by same player
+REPEATABLE = {'roll', 'move', 'score', 'score_all', 'score_total', 'help',
+              'stats', 'top', 'join', 'leave'}
 
 
 def dice_to_wildcard(game):
@@ -91,16 +174,36 @@ async def answer(update, msg, parse_mode=None, delay=1.5):
     }
     if parse_mode is not None:
         kw['parse_mode'] = parse_mode
-    chat = update.message.chat
-    current = time()
-    real_delay = max(answer_timer.get(chat, 0.0) - current, 0.0)
-    answer_timer[chat] = current + real_delay + delay
-    await sleep(real_delay)
+    if not replaying.get():  # Backlog replies are sent without pacing
+        table = get_table(update)
+        current = time()
+        real_delay = max(answer_timer.get(table, 0.0) - current, 0.0)
+        answer_timer[table] = current + real_delay + delay
+        with span("pacing", delay=real_delay):
+            await sleep(real_delay)
     await update.message.reply_text(msg, **kw)
 
 
+def get_table(update):
+    """
+    Get a table, where a game is played - chat id and forum topic (thread id
+    is None outside of forum topics, as replies in ordinary groups have
+    thread ids too)
+    """
+    message = update.message
+    thread = message.message_thread_id if message.is_topic_message else None
+    return message.chat.id, thread
+
+
+def log_kv(update, **fields):
+    """Structured log fields of an update (chat, topic and user)"""
+    chat_id, thread = get_table(update)
+    return kv(chat_id=chat_id, thread=thread,
+              user_id=update.message.from_user.id, **fields)
+
+
 def get_game(update):
-    return gamemanager.game(update.message.chat)
+    return gamemanager.game(get_table(update))
 
 
 def get_player(update):
@@ -108,7 +211,7 @@ def get_player(update):
 
 
 def get_current_player(update):
-    return gamemanager.current_turn(update.message.chat)
+    return gamemanager.current_turn(get_table(update))
 
 
 async def _game_chooser_msg(update):
@@ -135,7 +238,7 @@ async def _game_chooser_msg(update):
 async def _game_start_msg(update, turn_order_messages, game):
     for msg in turn_order_messages:
         await answer(update, msg, delay=5)
-    player = gamemanager.current_turn(update.message.chat)
+    player = gamemanager.current_turn(get_table(update))
     msg = (
         f"{START} Game begins! Roll dice with {ROLL} /roll command.\n\n"
         f"To see help for {game.get_name()}, use {HELP} /help command.\n\n"
@@ -146,15 +249,15 @@ async def _game_start_msg(update, turn_order_messages, game):
     await answer(update, msg, parse_mode=ParseMode.HTML)
 
 
-async def start(update, _: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"Start attempt - chat_id {update.message.chat.id}")
+async def start(update, _: Command):
+    logger.info("Start attempt", extra=log_kv(update))
     game = get_game(update)
-    if not gamemanager.is_game_created(update.message.chat) or game.finished:
+    if not gamemanager.is_game_created(get_table(update)) or game.finished:
         await _game_chooser_msg(update)
-    elif not gamemanager.is_game_running(update.message.chat):
+    elif not gamemanager.is_game_running(get_table(update)):
         try:
             turn_order_msgs = game.start_game(get_player(update))
-            logger.info(f"Game started - chat_id {update.message.chat.id}")
+            logger.info("Game started", extra=log_kv(update))
             await _game_start_msg(update, turn_order_msgs, game)
         except PlayerError as e:
             await answer(update, str(e))
@@ -194,7 +297,7 @@ async def startgame(update, yahtzee, forced=False, maxi=False):
         gamename = ' '.join(gamename)
     try:
         gamemanager.new_game(
-            update.message.chat,
+            get_table(update),
             update.message.from_user,
             yahtzee,
             forced,
@@ -206,56 +309,54 @@ async def startgame(update, yahtzee, forced=False, maxi=False):
     except PlayerError as e:
         await answer(update, str(e))
         return
-    logger.info(
-        f"{player} has created a new {gamename} game"
-        f" - chat_id {update.message.chat.id}"
-    )
+    logger.info("%s has created a new %s game", player, gamename,
+                extra=log_kv(update))
     await _game_created_msg(update, player, gamename)
 
 
-async def startyahtzee(update, _: ContextTypes.DEFAULT_TYPE):
+async def startyahtzee(update, _: Command):
     await startgame(update, True)
 
 
-async def startyatzy(update, _: ContextTypes.DEFAULT_TYPE):
+async def startyatzy(update, _: Command):
     await startgame(update, False)
 
 
-async def startforcedyatzy(update, _: ContextTypes.DEFAULT_TYPE):
+async def startforcedyatzy(update, _: Command):
     await startgame(update, False, True, False)
 
 
-async def startmaxiyatzy(update, _: ContextTypes.DEFAULT_TYPE):
+async def startmaxiyatzy(update, _: Command):
     await startgame(update, False, False, True)
 
 
-async def startforcedmaxiyatzy(update, _: ContextTypes.DEFAULT_TYPE):
+async def startforcedmaxiyatzy(update, _: Command):
     await startgame(update, False, True, True)
 
 
 def chk_game_runs(func):
     @wraps(func)
-    async def wrapper(update, _: ContextTypes.DEFAULT_TYPE):
-        if not gamemanager.is_game_created(update.message.chat):
+    async def wrapper(update, command: Command):
+        if not gamemanager.is_game_created(get_table(update)):
             await answer(
                 update, f"{ERROR} Game doesn't exist (try {START} /start)."
             )
             return
-        if not gamemanager.is_game_running(update.message.chat):
+        if not gamemanager.is_game_running(get_table(update)):
             await answer(
                 update,
                 f"{ERROR} Game is not running (try {START} /start)."
             )
             return
-        await func(update, _)
+        await func(update, command)
 
     return wrapper
 
 
 def roster_check(func):
     @wraps(func)
-    async def wrapper(update, _: ContextTypes.DEFAULT_TYPE):
-        if not gamemanager.is_game_created(update.message.chat):
+    async def wrapper(update, command: Command):
+        if not gamemanager.is_game_created(get_table(update)):
             await answer(
                 update, f"{ERROR} Game doesn't exist (try {START} /start)."
             )
@@ -267,7 +368,7 @@ def roster_check(func):
                 f"(try {START} /start)."
             )
             return
-        await func(update, _)
+        await func(update, command)
 
     return wrapper
 
@@ -279,21 +380,64 @@ def is_private(update):
 
 
 @roster_check
-async def stop(update, _: ContextTypes.DEFAULT_TYPE):
+async def stop(update, _: Command):
     try:
         get_game(update).stop_game(get_player(update))
-        logger.info(f"Stopped game - chat_id {update.message.chat.id}")
+        compute.cancel(get_table(update))
+        win_odds.cancel(("rollout", get_table(update)))
+        compute.cancel(("metrics", get_table(update)))
+        logger.info("Stopped game", extra=log_kv(update))
         await answer(update, f"{STOP} Current game has been stopped.\n\n")
     except PlayerError as e:
         await answer(update, str(e))
 
 
+def measure_choices(table, game):
+    """Measure skill loss of game's queued moves in compute workers"""
+    if not game.choices:
+        return
+    choices, game.choices = game.choices, []
+    job = create_task(
+        _measure(table, game, choices, metric_jobs.get(game.game_id))
+    )
+    metric_jobs[game.game_id] = job
+
+    def forget(_):
+        if metric_jobs.get(game.game_id) is job:
+            del metric_jobs[game.game_id]
+
+    job.add_done_callback(forget)
+
+
+async def _measure(table, game, choices, previous):
+    if previous is not None:
+        await wait([previous])  # Jobs of a game are chained
+    try:
+        for seat, args in choices:
+            try:
+                loss = await compute.run(
+                    ("metrics", table), choice_loss, *args
+                )
+            except ComputeError:
+                loss = None
+            game.add_skill_loss(seat, loss)
+    except CancelledError:
+        for seat in {seat for seat, _ in choices}:
+            game.discard_metrics(seat)  # Some moves are left unmeasured
+        raise
+
+
+async def metrics_ready(game):
+    """Wait until skill loss of all moves of a game is measured"""
+    job = metric_jobs.get(game.game_id)
+    if job is not None:
+        await wait([job])
+
+
 async def owner_transfer_msg(update, oldowner, newowner):
     if oldowner != newowner:
-        logger.info(
-            f"Owner {oldowner} left the game, new owner is"
-            f" {newowner} - chat_id {update.message.chat.id}"
-        )
+        logger.info("Owner %s left the game, new owner is %s", oldowner,
+                    newowner, extra=log_kv(update))
         await answer(
             update, f"{OWNER} Owner {oldowner} has left the game. "
                     f"Ownership is transferred to player {newowner}."
@@ -301,31 +445,30 @@ async def owner_transfer_msg(update, oldowner, newowner):
 
 
 @roster_check
-async def kick(update, _: ContextTypes.DEFAULT_TYPE):
+async def kick(update, _: Command):
     try:
         game = get_game(update)
         kicker = get_player(update)
         oldowner = game.owner
         kicked = game.kick_player(kicker)
-        kicked_msg = f"{kicker} has kicked {kicked} from the game"
         if kicker == kicked or (kicked is None and kicker == oldowner):
+            logger.info("%s kicks self from the game", kicker,
+                        extra=log_kv(update))
             kicked_msg = f"{kicker} kicks self from the game"
-        elif kicked is None:
-            kicked_msg = f"{kicker} has kicked {oldowner} from the game"
-        logger.info(f"{kicked_msg} - chat_id {update.message.chat.id}")
+        else:
+            victim = oldowner if kicked is None else kicked
+            logger.info("%s has kicked %s from the game", kicker, victim,
+                        extra=log_kv(update))
+            kicked_msg = f"{kicker} has kicked {victim} from the game"
         await answer(update, f"{KICK} {kicked_msg}.\n\n")
         if kicked is None:
-            logger.info(
-                f"Game stopped (owner is kicked) - "
-                f"chat_id {update.message.chat.id}"
-            )
+            logger.info("Game stopped (owner is kicked)",
+                        extra=log_kv(update))
             await answer(update, f"{STOP} Owner was kicked. Game is aborted.")
             return
         await owner_transfer_msg(update, oldowner, game.owner)
         if game.finished and not game.has_active_players():
-            logger.info(
-                f"Game stopped (abandoned) - chat_id {update.message.chat.id}"
-            )
+            logger.info("Game stopped (abandoned)", extra=log_kv(update))
             await answer(update, f"{STOP} Last player kicked. Game is over.")
         await score_messages(update, kicked, game.finished)
         if game.finished:
@@ -336,13 +479,11 @@ async def kick(update, _: ContextTypes.DEFAULT_TYPE):
 
 
 @roster_check
-async def join(update, _: ContextTypes.DEFAULT_TYPE):
+async def join(update, _: Command):
     player = get_player(update)
     try:
         get_game(update).add_player(player)
-        logger.info(
-            f"{player} has joined a game - chat_id {update.message.chat.id}"
-        )
+        logger.info("%s has joined a game", player, extra=log_kv(update))
     except PlayerError as e:
         await answer(update, str(e))
         return
@@ -360,7 +501,7 @@ async def join(update, _: ContextTypes.DEFAULT_TYPE):
 
 
 @roster_check
-async def leave(update, _: ContextTypes.DEFAULT_TYPE):
+async def leave(update, _: Command):
     player = get_player(update)
     game = get_game(update)
     try:
@@ -370,10 +511,8 @@ async def leave(update, _: ContextTypes.DEFAULT_TYPE):
         if not is_lobby:
             turn = game.get_current_player()
         lobby = " lobby" if is_lobby else ""
-        logger.info(
-            f"{player} has left a game{lobby}"
-            f" - chat_id {update.message.chat.id}"
-        )
+        logger.info("%s has left a game%s", player, lobby,
+                    extra=log_kv(update))
         game.del_player(player)
         switch_turn = not game.finished and turn == player
     except PlayerError as e:
@@ -382,9 +521,7 @@ async def leave(update, _: ContextTypes.DEFAULT_TYPE):
     await answer(update, f"{LEAVE} {player} has left the game{lobby}!")
     await owner_transfer_msg(update, oldowner, game.owner)
     if game.finished and not game.has_active_players():
-        logger.info(
-            f"Game stopped (abandoned) - chat_id {update.message.chat.id}"
-        )
+        logger.info("Game stopped (abandoned)", extra=log_kv(update))
         await answer(
             update, f"{STOP} Last player has left the game. Game is over."
         )
@@ -420,12 +557,59 @@ def mk_movelink(options, metrics, compact=False):
     return "".join(movelink)
 
 
+async def advice_msg(update, game, player):
+    """
+    Get a solver advice on dice to keep or a box to score (in multiplayer -
+    the one, which maximises chance to win, once rivals' rollouts are ready)
+    """
+    table = get_table(update)
+    hand = tuple(int(die) for die in game.hand)
+    seat = game.seat(player)
+    rerolls = game.get_rerolls_left(player)
+    rivals = win_odds.rivals(game, seat)
+    allowed = list(game.scoreboard.get_score_options(seat, game.hand))
+    try:
+        if rivals is not None:
+            advice = await compute.run(
+                table, win_advice, game.yahtzee, game.forced, game.maxi,
+                solver_state(game.scoreboard, seat),
+                rollout_state(game, seat)[0], hand, rerolls, rivals, allowed
+            )
+        else:
+            if len(game.scoreboard.players) > 1:
+                win_odds.schedule(("rollout", table), game)
+            advice = await compute.run(
+                table, advise, game.yahtzee, game.forced, game.maxi,
+                solver_state(game.scoreboard, seat), hand, rerolls, allowed
+            )
+    except ComputeError as e:
+        logger.warning("No advice - %s", e, extra=log_kv(update))
+        return ""
+    if advice is None:
+        return ""  # No solver table for this game variant
+    keep, box, value = advice
+    if box is not None:
+        advice_msg = f"score {MOVE_BOX_ICONS[box]} {box} now"
+    elif not keep:
+        advice_msg = "reroll all dice"
+    else:
+        advice_msg = (f"keep {' '.join([EMOJIS[str(die)] for die in keep])} "
+                      f"and reroll the rest")
+    if rivals is None:
+        outcome = f" (expected final score is {value:.0f})"
+    elif value is not None:
+        outcome = f" (chance to win is {value:.0%})"
+    else:
+        outcome = ""
+    return f"{ADVICE} Advice: {advice_msg}{outcome}.\n\n"
+
+
 async def roll_msg(update, game, player, dice):
     rerolllink = (f"{ROLL} /reroll to choose dice for reroll.\n\n"
                   f"{ROLL} /qr <positions> to do a quick reroll.\n\n")
     if game.reroll > 1:
         if game.maxi:
-            if not game.saved_rerolls[player]:
+            if not game.saved_rerolls[game.seat(player)]:
                 rerolllink = ""
         else:
             rerolllink = ""
@@ -440,18 +624,21 @@ async def roll_msg(update, game, player, dice):
             movelink = (f"{INFO} You have no rerolls left and only one valid"
                         f" move, finishing turn automatically.\n\n")
             automove = MAP_COMMANDS[next(iter(options))]
+    advice = ""
+    if rerolllink:
+        advice = await advice_msg(update, game, player)
     await answer(
         update,
         f"{ROLL} {player} has rolled (Reroll {rollnumber}/2):\n\n"
         f"{' '.join([d.to_emoji() for d in dice])}\n\n"
-        f"{rerolllink}{movelink}{saved}"
+        f"{rerolllink}{movelink}{advice}{saved}"
     )
     if automove:
         await process_move(update, game, player, automove, auto=True)
 
 
 @chk_game_runs
-async def roll(update, _: ContextTypes.DEFAULT_TYPE):
+async def roll(update, _: Command):
     game = get_game(update)
     player = get_player(update)
     try:
@@ -497,7 +684,7 @@ async def reroll_msg(update, game, player, dice):
 
 
 @chk_game_runs
-async def reroll(update, _: ContextTypes.DEFAULT_TYPE):
+async def reroll(update, _: Command):
     game = get_game(update)
     player = get_player(update)
     try:
@@ -570,9 +757,8 @@ def quick_reroll_set(game, command):
 
 
 @chk_game_runs
-async def reroll_process(update, _: ContextTypes.DEFAULT_TYPE):
-    arg = update.message.text.strip()[1:].split(None)[0].split("@")[0]
-    args = update.message.text.strip().split(None)[1:]
+async def reroll_process(update, command: Command):
+    arg = command.name
     game = get_game(update)
     player = get_player(update)
     try:
@@ -596,11 +782,14 @@ async def reroll_process(update, _: ContextTypes.DEFAULT_TYPE):
             await send_dice(update, game)
         elif arg == 'dr' or arg == 'qr' or arg == 'q':
             if arg == 'qr' or arg == 'q':
-                to_reroll = quick_reroll_set(game, "".join(args).lower())
+                to_reroll = quick_reroll_set(
+                    game, "".join(command.args).lower()
+                )
                 dice = game.reroll_dice(player, to_reroll)
                 game.reroll_pool_clear(player)
             else:
                 dice = game.reroll_pooled(player)
+            measure_choices(get_table(update), game)
             await roll_msg(update, game, player, dice)
         else:
             await answer(update, f"{ERROR} Invalid reroll action.")
@@ -610,7 +799,7 @@ async def reroll_process(update, _: ContextTypes.DEFAULT_TYPE):
 
 
 @chk_game_runs
-async def commit(update, _: ContextTypes.DEFAULT_TYPE):
+async def commit(update, _: Command):
     game = get_game(update)
     player = get_player(update)
     try:
@@ -624,7 +813,8 @@ async def commit(update, _: ContextTypes.DEFAULT_TYPE):
             f"{MOVE_BOX_ICONS[option]} /{MAP_COMMANDS[option]} "
             f"{option} - {options[option]} points."
         )
-    if game.reroll < 2 or (game.maxi and game.saved_rerolls[player]):
+    if game.reroll < 2 or (
+            game.maxi and game.saved_rerolls[game.seat(player)]):
         output.append(f"{ROLL} /reroll - to choose dice for reroll.")
         output.append(f"{ROLL} /qr <positions> - to do a quick reroll.\n\n")
     table = '\n\n'.join(output)
@@ -634,7 +824,7 @@ async def commit(update, _: ContextTypes.DEFAULT_TYPE):
 def get_extra_rerolls(game, player):
     saved = ""
     if game.maxi:
-        extra = game.saved_rerolls[player]
+        extra = game.saved_rerolls[game.seat(player)]
         if extra:
             saved = f"{INFO} You have {extra} extra saved reroll(s).\n\n"
     return saved
@@ -680,45 +870,55 @@ async def process_move(update, game, player, move, auto=False):
     except (PlayerError, IllegalMoveError) as e:
         await answer(update, str(e))
         return
+    # Anything computed for the previous turn is outdated now
+    compute.cancel(get_table(update))
+    measure_choices(get_table(update), game)
+    # Rollouts for player's new state are ready by next /score_total
+    win_odds.schedule(("rollout", get_table(update)), game)
     await move_msg(update, saved_rerolls, player, move, score_pos, auto)
     await scoreboard_msg(update, player)
-    if gamemanager.game(update.message.chat).is_completed():
+    if gamemanager.game(get_table(update)).is_completed():
+        await metrics_ready(game)  # Final scores show skill loss
         await totalscore_msg(update, finished=True)
     else:
         await current_turn_msg(update)
 
 
 @chk_game_runs
-async def commit_move(update, _: ContextTypes.DEFAULT_TYPE):
-    arg = update.message.text.strip()[1:].split(None)[0].split("@")[0]
+async def commit_move(update, command: Command):
     game = get_game(update)
     player = get_player(update)
-    await process_move(update, game, player, arg)
+    await process_move(update, game, player, command.name)
 
 
 async def scoreboard_msg(update, player):
     try:
         game = get_game(update)
         if player is None:
-            playerlist = game.players
-        else:
-            playerlist = [player]
-        for plr in playerlist:
-            scores = game.scores_player(plr)
-            await answer(
-                update,
-                f"{SCORE} Scoreboard for {plr}:\n\n`{scores}`",
-                parse_mode=ParseMode.MARKDOWN
-            )
+            header = f"{SCORE} Scoreboard:\n\n"
+            # Fit as many players as possible into a single message
+            limit = MessageLimit.MAX_TEXT_LENGTH - len(header) - 2
+            for scores in game.scores_all(player, limit):
+                await answer(
+                    update,
+                    f"{header}`{scores}`",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+            return
+        scores = game.scores_player(player)
+        await answer(
+            update,
+            f"{SCORE} Scoreboard for {player}:\n\n`{scores}`",
+            parse_mode=ParseMode.MARKDOWN
+        )
     except PlayerError as e:
         await answer(update, str(e))
 
 
 @chk_game_runs
-async def score(update, _: ContextTypes.DEFAULT_TYPE):
-    arg = update.message.text.strip()[1:].split(None)[0].split("@")[0]
+async def score(update, command: Command):
     requestor = get_player(update)
-    if arg == "score":
+    if command.name == "score":
         player = requestor
     else:
         player = None
@@ -737,15 +937,38 @@ async def totalscore_msg(update, finished=False):
     if finished:
         emoji = CONGRATS
         msg = "The game has ended! Final scores"
-        logger.info(
-            f"The game is completed - chat_id {update.message.chat.id}"
-        )
+        logger.info("The game is completed", extra=log_kv(update))
     try:
-        scores = get_game(update).scores_final(player)
+        game = get_game(update)
+        scores = game.scores_final(player)
     except PlayerError as e:
         await answer(update, str(e))
         return
-    await answer(update, f"{emoji} {msg}:\n\n{scores}")
+    odds = ""
+    if not finished and game.is_game_in_progress():
+        odds = await win_odds_msg(update, game)
+    await answer(update, f"{emoji} {msg}:\n\n{scores}{odds}")
+
+
+async def win_odds_msg(update, game):
+    """Get estimated chances to win and projected final scores"""
+    await win_odds.refresh(("rollout", get_table(update)), game)
+    estimates = win_odds.estimate(game)
+    if estimates is None:
+        return ""  # Rollouts have failed or were cancelled
+    output = [f"\n\n{ODDS} Chances to win:\n"]
+    for seat, (chance, projected) in estimates.items():
+        if chance < 0.01 and chance:
+            chance_msg = "<1%"
+        elif 0.99 < chance < 1:
+            chance_msg = ">99%"
+        else:
+            chance_msg = f"{chance:.0%}"
+        output.append(
+            f"\n{game.scoreboard.players[seat]} - {chance_msg} "
+            f"(projected {projected:.0f} points)"
+        )
+    return "".join(output)
 
 
 async def score_messages(update, player, finished):
@@ -754,7 +977,7 @@ async def score_messages(update, player, finished):
 
 
 @chk_game_runs
-async def score_all(update, _: ContextTypes.DEFAULT_TYPE):
+async def score_all(update, _: Command):
     try:
         player = get_player(update)
         get_game(update).chk_command_usable_any_turn(player)
@@ -764,11 +987,157 @@ async def score_all(update, _: ContextTypes.DEFAULT_TYPE):
     await totalscore_msg(update)
 
 
-async def bot_help(update, _: ContextTypes.DEFAULT_TYPE):
-    logger.info("Help invoked")
+async def stats_msg(update, _: Command):
+    """Show user's statistics across all finished games"""
+    player = get_player(update)
+    try:
+        variants = await stats.player_stats(player.id)
+    except sqlite3.Error as e:
+        logger.error("Failed to read statistics: %s", e,
+                     extra=log_kv(update))
+        await answer(update, f"{ERROR} Statistics are unavailable now.")
+        return
+    if not variants:
+        await answer(
+            update, f"{STATS} {player} hasn't finished any games yet."
+        )
+        return
+    msg = [f"{STATS} Statistics for {player}:"]
+    for variant, row in variants.items():
+        msg.append(f"\n\n{variant_title(variant)} - {row['games']} game(s), "
+                   f"{row['wins']} win(s)")
+        if "rating" in row:
+            msg.append(f", rating {row['rating']:.0f}")
+        if row['finished']:
+            finished = row['finished']
+            histogram = ", ".join(
+                f"{low}-{low + SCORE_BUCKET - 1}: {count}"
+                for low, count in row['histogram'].items()
+            )
+            msg.append(
+                f"\nAverage score {row['total_score'] / finished:.0f}, "
+                f"best score {row['best_score']}\n"
+                f"Upper section bonus in {row['bonuses'] / finished:.0%} of "
+                f"games, {row['yatzies']} Yatzy(s)\n"
+                f"Scores: {histogram}"
+            )
+    await answer(update, "".join(msg))
+
+
+def variant_title(variant):
+    """Get a human-readable game variant name (e.g. Forced Maxi Yatzy)"""
+    return " ".join(part.capitalize() for part in variant.split("-"))
+
+
+async def top(update, command: Command):
+    """
+    Show a leaderboard of best scores: /top [chat] [recent] [variant], e.g.
+    /top chat recent maxi yatzy
+    """
+    args = [arg.lower() for arg in command.args]
+    chat_id = None
+    if "chat" in args:
+        args.remove("chat")
+        chat_id = update.message.chat.id
+    recent = "recent" in args
+    if recent:
+        args.remove("recent")
+    variants = [variant_name(*variant) for variant in VARIANTS]
+    variant = "-".join(args)
+    if not variant:
+        game = get_game(update)
+        variant = variants[0]
+        if game is not None:
+            variant = variant_name(game.yahtzee, game.forced, game.maxi)
+    if variant not in variants:
+        await answer(
+            update,
+            f"{ERROR} Unknown game variant, use one of: "
+            f"{', '.join(name.replace('-', ' ') for name in variants)}."
+        )
+        return
+    try:
+        leaders = await stats.top(variant, chat_id, recent)
+    except sqlite3.Error as e:
+        logger.error("Failed to read leaderboard: %s", e,
+                     extra=log_kv(update))
+        await answer(update, f"{ERROR} Leaderboards are unavailable now.")
+        return
+    period = f"last {TOP_RECENT_DAYS} days" if recent else "all-time"
+    where = "this chat" if chat_id is not None else "all chats"
+    msg = [f"{TOP} {variant_title(variant)} top scores in {where} "
+           f"({period}):\n"]
+    if not leaders:
+        msg.append("\nNo games have been finished yet.")
+    for place, (name, score) in enumerate(leaders, 1):
+        msg.append(f"\n{POSITIONS.get(place, f'{place}.')} {name} - {score}")
+    await answer(update, "".join(msg))
+
+
+def http_stats_msg(http, limit=5):
+    """Bot API request latencies of top endpoints and connection pool waits"""
+    if not http.latency:
+        return ""
+    msg = ["\n\nBot API requests:"]
+    endpoints = sorted(http.latency.items(), key=lambda e: -e[1].count)
+    for endpoint, latency in endpoints[:limit]:
+        msg.append(f"\n{endpoint}: {latency.summary()}")
+    for pool, waits in sorted(http.pool_waits.items()):
+        msg.append(f"\nWaits for {pool} connection: {waits.summary()}, "
+                   f"{http.pool_timeouts[pool]} timeout(s)")
+    return "".join(msg)
+
+
+async def botstats(update, command: Command):
+    """
+    Show runtime statistics of the bot to admins: /botstats, or /botstats
+    mem to see top memory allocators (/botstats mem stop to stop tracing)
+    """
+    if update.message.from_user.id not in ADMINS:
+        await answer(update, f"{ERROR} This command is for bot admins only.")
+        return
+    if command.args[:1] == ["mem"]:
+        if command.args[1:2] == ["stop"]:
+            stop_tracing()
+            await answer(update, f"{INFO} Memory tracing has been stopped.")
+            return
+        allocators = top_allocators()
+        if allocators is None:
+            await answer(
+                update, f"{INFO} Memory tracing has been started, repeat the "
+                        f"command later to see top allocators."
+            )
+            return
+        msg = [f"{STATS} Top memory allocators:\n"]
+        for location, size, count in allocators:
+            msg.append(f"\n{location} - {size / 1024:.0f} KiB in {count} "
+                       f"block(s)")
+        await answer(update, "".join(msg))
+        return
+    games = gamemanager.states
+    waits = metrics.rate_limiter_waits()
+    await answer(
+        update,
+        f"{STATS} Bot statistics:\n\n"
+        f"Games: {games['live']} in progress, {games['lobby']} in lobby, "
+        f"{games['finished']} finished\n"
+        f"Players: {len(gamemanager.players)}, pacing entries: "
+        f"{len(answer_timer)}, table locks: {len(table_locks)}\n"
+        f"Updates: {metrics.queue_depth()} queued, {metrics.in_flight} "
+        f"in flight\n"
+        f"Handler latency: {metrics.latency.summary()}\n"
+        f"Rate limiter waits: "
+        f"{'n/a' if waits is None else waits.summary()}\n"
+        f"Memory: RSS {rss() / 2 ** 20:.1f} MiB"
+        f"{', tracing' if is_tracing() else ''}"
+        f"{http_stats_msg(metrics.http)}"
+    )
+
+
+async def bot_help(update, _: Command):
+    logger.info("Help invoked", extra=log_kv(update))
     game = get_game(update)
-    chat = update.message.chat
-    if not gamemanager.is_game_created(chat) or game.finished:
+    if not gamemanager.is_game_created(get_table(update)) or game.finished:
         await answer(
             update,
             f"{HELP} Use {START} /start command to begin and follow the "
@@ -776,7 +1145,10 @@ async def bot_help(update, _: ContextTypes.DEFAULT_TYPE):
             f"https://en.wikipedia.org/wiki/Yatzy\n"
             f"https://en.wikipedia.org/wiki/Yahtzee\n\n"
             f"Use {HELP} /help command again during a game to see help for "
-            f"current game variation."
+            f"current game variation.\n\n"
+            f"Use {STATS} /stats to see your statistics.\n\n"
+            f"Use {TOP} /top to see leaderboards (add chat, recent and game "
+            f"variant to narrow it down, e.g. /top chat recent maxi yatzy)."
         )
     else:
         avg_dice = 3 + (1 if game.maxi else 0) - (1 if game.forced else 0)
@@ -944,67 +1316,219 @@ async def bot_help(update, _: ContextTypes.DEFAULT_TYPE):
 
 async def error(update, context: ContextTypes.DEFAULT_TYPE):
     """Log Errors caused by Updates."""
+    if is_pool_timeout(context.error):
+        logger.warning("No free Bot API connection in time (HTTP_POOL_SIZE "
+                       "or HTTP_POOL_TIMEOUT might be too low)")
     logger.error('Update "%s" caused error "%s"', update, context.error)
 
 
+async def load_tables():
+    """
+    Build missing lookup tables in a worker, then map them here. Until
+    they're loaded, features, which need them (e.g. bonus chances and move
+    advice), are just not shown.
+    """
+    started = perf_counter()
+    try:
+        await compute.warmup()
+        await compute.run(
+            "tables", load_bonus_tables, timeout=TABLE_BUILD_TIMEOUT
+        )
+        await to_thread(load_bonus_tables)
+        await to_thread(load_value_tables)
+    except (ComputeError, TableError, OSError) as e:
+        logger.error("Failed to load lookup tables: %r", e)
+        return
+    logger.info("Lookup tables are loaded", extra=kv(
+        event="tables_loaded", latency=perf_counter() - started
+    ))
+
+
+async def post_init(application: Application):
+    """
+    Bring up background services before polling starts (lookup tables are
+    loaded in background, so updates are served right away) and start to
+    catch up with updates, which have piled up while the bot was down (in
+    background too)
+    """
+    global table_loader, catchup
+    metrics.application = application
+    await compute.start(warmup=False)
+    table_loader = create_task(load_tables())
+    await stats.start()
+    exporter.start()
+    archive.start()
+    if application.updater is not None:
+        # Polling by ourselves (not a shard worker) - games can be handed
+        # over from previous process and to the next one
+        await handoff.start(application)
+        catchup = await catch_up(
+            application,
+            lambda update: parse_backlog_update(
+                update, application.bot.username
+            ),
+            table_lock,
+            toggles=DICE_TOGGLES,
+            resets=POOL_RESETS,
+            moves=MAP_TURNS,
+            repeatable=REPEATABLE,
+        )
+
+
+async def post_shutdown(_: Application):
+    """Shut down background services"""
+    handoff.stop()
+    if table_loader is not None:
+        table_loader.cancel()
+    if catchup is not None:
+        catchup.cancel()
+    compute.stop()
+    await stats.stop()
+    await exporter.stop()
+    await archive.stop()
+
+
+def parse_command(update, username):
+    """Parse a command (None, if it's not a command of this bot)"""
+    command = update.message.text.strip()[1:].split(None, 1)
+    name, _, mention = command[0].partition("@")
+    if mention and mention.lower() != username.lower():
+        return None  # Command is addressed to some other bot
+    name = name.lower()
+    if name not in ROUTES:
+        return None
+    return Command(name, command[1].split() if len(command) > 1 else [])
+
+
+def parse_backlog_update(update, username):
+    """Get a table and a command of an update from backlog (if it's one)"""
+    if not COMMANDS.check_update(update):
+        return None
+    command = parse_command(update, username)
+    if command is None:
+        return None
+    return get_table(update), command
+
+
+def table_lock(table):
+    """Get a lock of a table (it lives only while someone holds it)"""
+    lock = table_locks.get(table)
+    if lock is None:
+        lock = table_locks[table] = Lock()
+    return lock
+
+
+async def dispatch(update, context: ContextTypes.DEFAULT_TYPE):
+    """Parse a command once and route it to its handler"""
+    command = parse_command(update, context.bot.username)
+    if command is None:
+        return
+    name = command.name
+    handler = ROUTES[name]
+    started = perf_counter()
+    table = get_table(update)
+    # Catch-up holds the lock of a table, while its backlog is processed
+    lock = nullcontext() if replaying.get() else table_lock(table)
+    metrics.in_flight += 1
+    try:
+        with trace(f"/{name}", command=name, chat_id=table[0],
+                   thread=table[1], user_id=update.message.from_user.id):
+            async with lock:
+                await handler(update, command)
+    finally:
+        metrics.in_flight -= 1
+    latency = perf_counter() - started
+    metrics.latency.observe(latency)
+    event = "dice_toggle" if name in DICE_TOGGLES else "command"
+    logger.info("Handled /%s", name, extra=log_kv(
+        update, event=event, command=name, latency=latency
+    ))
+
+
+# Routing table, mapping commands to their handlers
+ROUTES = {
+    'start': start,
+    'startyatzy': startyatzy,
+    'startyahtzee': startyahtzee,
+    'startforcedyatzy': startforcedyatzy,
+    'startmaxiyatzy': startmaxiyatzy,
+    'startforcedmaxiyatzy': startforcedmaxiyatzy,
+    'stop': stop,
+    'join': join,
+    'leave': leave,
+    'kick': kick,
+    'roll': roll,
+    'reroll': reroll,
+    'help': bot_help,
+    'move': commit,
+    'score_total': score_all,
+    'score': score,
+    'score_all': score,
+    'stats': stats_msg,
+    'top': top,
+    'botstats': botstats,
+}
+ROUTES.update(dict.fromkeys(REROLL_COMMANDS, reroll_process))
+ROUTES.update(dict.fromkeys(MAP_TURNS, commit_move))
+
+# Updates, that bot handles
+COMMANDS = filters.COMMAND & filters.UpdateType.MESSAGE
+
+
+def setup(application):
+    """Register handlers (in a standalone bot or a shard worker)"""
+    application.add_handler(MessageHandler(COMMANDS, dispatch))
+    application.add_error_handler(error)
+
+
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run YatzyBot.")
+    parser.add_argument(
+        "--shards", type=int, default=0,
+        help="run games in N worker processes, split by chat "
+             "(send SIGUSR1 to add one more worker)"
+    )
+    parser.add_argument(
+        "--takeover", action="store_true",
+        help="take live games over from a running bot, which then exits"
+    )
+    parser.add_argument(
+        "--import-times", action="store_true",
+        help="show modules, which take most time to import, and exit"
+    )
+    args = parser.parse_args()
+    if args.import_times:
+        print("Cumulative      Self  Module")
+        for name, own, cumulative in import_times("YatzyBot"):
+            print(f"{cumulative:7.1f} ms {own:6.1f} ms  {name}")
+        return
+    # Not on import - shard workers (which re-import this module) set up
+    # logging and tracing into files of their own
+    setup_logging()
+    setup_tracing()
+    handoff.takeover = args.takeover
+    if args.shards > 0:
+        from shard import Supervisor
+        Supervisor(args.shards).run(COMMANDS)
+        return
+
     application = (
         Application.
         builder().
         token(TOKEN).
-        rate_limiter(AIORateLimiter()).
+        request(bot_request(metrics.http, "send", HTTP_POOL_SIZE)).
+        get_updates_request(bot_request(
+            metrics.http, "updates", HTTP_UPDATES_POOL_SIZE
+        )).
+        rate_limiter(TimedRateLimiter()).
+        concurrent_updates(True).
+        post_init(post_init).
+        post_shutdown(post_shutdown).
         build()
     )
-
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CommandHandler('startyatzy', startyatzy))
-    application.add_handler(
-        CommandHandler(
-            'startyahtzee',
-            startyahtzee))
-    application.add_handler(
-        CommandHandler(
-            'startforcedyatzy',
-            startforcedyatzy))
-    application.add_handler(
-        CommandHandler(
-            'startmaxiyatzy',
-            startmaxiyatzy))
-    application.add_handler(
-        CommandHandler(
-            'startforcedmaxiyatzy',
-            startforcedmaxiyatzy))
-    application.add_handler(CommandHandler('stop', stop))
-    application.add_handler(CommandHandler('join', join))
-    application.add_handler(CommandHandler('leave', leave))
-    application.add_handler(CommandHandler('kick', kick))
-    application.add_handler(CommandHandler('roll', roll))
-    application.add_handler(CommandHandler('reroll', reroll))
-    application.add_handler(CommandHandler('help', bot_help))
-    application.add_handler(CommandHandler('move', commit))
-    application.add_handler(CommandHandler('score_total', score_all))
-    application.add_handler(
-        CommandHandler(['score', 'score_all'], score)
-    )
-    application.add_handler(
-        CommandHandler(
-            ['1', '2', '3', '4', '5', '6', 'dr', 'rr', 'sa', 'qr', 'q'],
-            reroll_process
-        )
-    )
-    application.add_handler(
-        CommandHandler(
-            ['on', 'ac', 'tw', 'th', 'fo', 'fi',
-             'si', 'op', 'tp', '3p', 'tk', 'fk',
-             '5k', 'fh', 'ca', 'to', 'ss', 'ls',
-             'fs', 'ch', 'ya', 'yh', 'my'],
-            commit_move
-        )
-    )
-    application.add_error_handler(error)
-
-    logging.getLogger('httpx').setLevel(logging.WARNING)
-    logging.getLogger('apscheduler').setLevel(logging.WARNING)
+    application.add_handler(TypeHandler(Update, handoff.track), group=-1)
+    setup(application)
 
     # Start the Bot
     logger.info("YatzyBot has started.")
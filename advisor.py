@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from approxsolver import approx_solver, load_approx_solvers
+from forcedsolver import forced_solver, load_forced_solvers
+from rollout import advise_to_win, load_rollout_models
+
+
+def load_value_tables():
+    """Load solvers, which are needed for table lookups only"""
+    load_forced_solvers()
+    load_approx_solvers()
+
+
+def load_solvers():
+    """Load all solvers (to be run in compute worker processes)"""
+    load_value_tables()
+    load_rollout_models()
+
+
+def solver_state(scoreboard, seat):
+    """
+    Get player's state for solvers: mask of open upper boxes, upper section
+    sum, indices of open lower boxes, score, that has been scored so far
+    (without upper section bonus), and whether Yahtzee has been scored (so
+    Yahtzee Bonus and joker rules apply)
+    """
+    scores = scoreboard.scores[seat]
+    boxes = [box for box in scores.values() if box.rule]
+    mask = 0
+    for face, box in enumerate(boxes[:6]):
+        if box.score is None:
+            mask |= 1 << face
+    lower_open = [i for i, box in enumerate(boxes[6:]) if box.score is None]
+    banked = scores["Grand Total"].score - scores["Up. Sect. Bonus"].score
+    yahtzee_scored = int(bool(
+        scoreboard.yahtzee and scores["Yahtzee"].score
+    ))
+    return (mask, scores["Up. Sect. Total"].score, lower_open, banked,
+            yahtzee_scored)
+
+
+def _forced_index(state):
+    """Index of a box to be filled next in Forced Yatzy"""
+    mask, _, lower_open, _, _ = state
+    if mask:
+        return (mask & -mask).bit_length() - 1
+    return 6 + lower_open[0]
+
+
+def expected_score(yahtzee, forced, maxi, state, saved=0):
+    """
+    Get expected final score of a player before a turn (table lookups only).
+    Returns None if no solver is available for a game variant. Saved rerolls
+    are ignored in Forced Maxi Yatzy (see ForcedSolver).
+    """
+    mask, upper_sum, lower_open, banked, flag = state
+    if forced:
+        solver = forced_solver(maxi)
+        if solver is None:
+            return None
+        if not mask and not lower_open:
+            index = len(solver.boxes)
+        else:
+            index = _forced_index(state)
+        return banked + solver.expected_score(index, upper_sum)
+    solver = approx_solver(yahtzee, maxi)
+    if solver is None:
+        return None
+    return banked + solver.expected_score(
+        mask, upper_sum, lower_open, saved, flag
+    )
+
+
+def box_values(yahtzee, forced, maxi, state, hand, saved=0, allowed=None):
+    """
+    Get expected final score of a player after scoring a hand in each box,
+    it may be scored in (by box name, limited to allowed names, if given)
+    with saved rerolls left (table lookups only). Returns None if there is
+    no choice or no solver for a game variant.
+    """
+    mask, upper_sum, lower_open, banked, flag = state
+    solver = None if forced else approx_solver(yahtzee, maxi)
+    if solver is None:
+        return None
+    values = solver.box_values(
+        mask, upper_sum, lower_open,
+        solver.space.index[tuple(sorted(hand))], saved, flag
+    )
+    reserved = sum(solver.reserve[box] for box in lower_open)
+    return {
+        solver.names[box]: banked + value + reserved
+        for box, value in values.items()
+        if allowed is None or solver.names[box] in allowed
+    }
+
+
+def advise(yahtzee, forced, maxi, state, hand, rerolls, allowed=None):
+    """
+    Get the best dice to keep from hand, a box to score it in right now (if
+    rerolling is not worth it, limited to allowed names, if given) and
+    expected final score. Returns None if no solver is available for a game
+    variant.
+    """
+    mask, upper_sum, lower_open, banked, flag = state
+    if forced:
+        solver = forced_solver(maxi)
+        if solver is None:
+            return None
+        keep, box, expected = solver.advise(
+            _forced_index(state), upper_sum, hand, rerolls
+        )
+        return keep, box, banked + expected
+    solver = approx_solver(yahtzee, maxi)
+    if solver is None:
+        return None
+    keep, box, expected = solver.advise(
+        mask, upper_sum, lower_open, hand, rerolls, flag, allowed
+    )
+    return keep, box, banked + expected
+
+
+def option_values(yahtzee, forced, maxi, state, hand, rerolls, allowed=None):
+    """
+    Get expected final score of a player after scoring a hand right now in
+    each box (by box name, limited to allowed names, if given) and after
+    keeping each subset of its dice on a reroll (by dice kept), if there
+    are rerolls left. Returns None if no solver is available for a game
+    variant.
+    """
+    mask, upper_sum, lower_open, banked, flag = state
+    hand = tuple(sorted(hand))
+    if forced:
+        solver = forced_solver(maxi)
+        if solver is None:
+            return None
+        index = _forced_index(state)
+        boxes = {
+            solver.boxes[index].name:
+                banked + solver.score_value(index, upper_sum, hand)
+        }
+        keeps = {}
+        if rerolls:
+            keeps = {
+                keep: banked + value for keep, value in
+                solver.keep_values(index, upper_sum, hand, rerolls).items()
+            }
+        return boxes, keeps
+    solver = approx_solver(yahtzee, maxi)
+    if solver is None:
+        return None
+    boxes = box_values(
+        yahtzee, forced, maxi, state, hand, rerolls, allowed
+    )
+    keeps = {}
+    if rerolls:
+        reserved = sum(solver.reserve[box] for box in lower_open)
+        keeps = {
+            keep: banked + value + reserved for keep, value in
+            solver.keep_values(
+                mask, upper_sum, lower_open, hand, rerolls, flag
+            ).items()
+        }
+    return boxes, keeps
+
+
+def win_advice(yahtzee, forced, maxi, state, rollout_state, hand, rerolls,
+               rivals, allowed=None):
+    """
+    Get dice to keep or a box to score hand in, which maximise chance to
+    win (see rollout.advise_to_win), given player's state for solvers and
+    for rollouts, and a chance to win (or None, if it's unknown)
+    """
+    values = option_values(
+        yahtzee, forced, maxi, state, hand, rerolls, allowed
+    )
+    return advise_to_win(
+        (yahtzee, forced, maxi), rollout_state, hand, rerolls, rivals,
+        values, allowed
+    )
+
+
+def choice_loss(yahtzee, forced, maxi, state, hand, rerolls, allowed,
+                keep=None, box=None):
+    """
+    Get expected final score lost by a move - keeping dice on a reroll or
+    scoring hand in a box (by name) - against the best move (that solves a
+    turn, so it's run in compute workers). Returns None if no solver is
+    available for a game variant.
+    """
+    options = option_values(
+        yahtzee, forced, maxi, state, hand, rerolls, allowed
+    )
+    if options is None:
+        return None
+    boxes, keeps = options
+    # Rerolling a hand takes at least one die to be rerolled
+    values = [value for dice, value in keeps.items() if len(dice) != len(hand)]
+    best = max(values + list(boxes.values()))
+    if box is not None:
+        return best - boxes[box]
+    return best - keeps[tuple(sorted(keep))]
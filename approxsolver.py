@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+from array import array
+from math import comb
+from multiprocessing import Pool
+from time import time
+
+from dice import Dice
+from scoreboard import Scoreboard
+from solver import hand_space
+from tables import (
+    FLOAT16,
+    open_table,
+    rule_hash,
+    table_path,
+    variant_name,
+    write_table,
+)
+
+# Bump this when the model below changes, so tables get rebuilt
+APPROX_TABLE_VERSION = 1
+# Yahtzee tables have a version of their own (2 has Yahtzee Bonus flag)
+YAHTZEE_TABLE_VERSION = 2
+# Saved Maxi Yatzy rerolls above this number are valued as this number
+SAVED_REROLLS_CAP = 3
+# Seconds between generation checkpoints
+CHECKPOINT_INTERVAL = 60
+# Game variants (as yahtzee and maxi flags), covered by this solver
+APPROX_VARIANTS = ((False, False), (True, False), (False, True))
+
+logger = logging.getLogger(__name__)
+
+_solvers = {}
+_generator = None  # Solver of a table generation worker process
+
+
+def subset_max_expectation(values, size):
+    """Expected maximum of values in a uniformly random subset of size"""
+    ordered = sorted(values, reverse=True)
+    count = len(ordered)
+    return sum(
+        value * comb(count - i - 1, size - 1)
+        for i, value in enumerate(ordered)
+    ) / comb(count, size)
+
+
+def approx_table_name(yahtzee=False, maxi=False):
+    return f"approx-{variant_name(yahtzee, False, maxi)}"
+
+
+def approx_rule_hash(yahtzee=False, maxi=False):
+    return hashlib.sha256(
+        rule_hash(yahtzee, False, maxi) + bytes([
+            YAHTZEE_TABLE_VERSION if yahtzee else APPROX_TABLE_VERSION,
+            SAVED_REROLLS_CAP
+        ])
+    ).digest()
+
+
+class ValueGrid(object):
+    """Flat list of values, indexed like a table"""
+
+    def __init__(self, dims, values=None):
+        self.dims = dims
+        self.strides = []
+        stride = 1
+        for dim in reversed(dims):
+            self.strides.insert(0, stride)
+            stride *= dim
+        self.values = values if values is not None else [0.0] * stride
+
+    def offset(self, index):
+        return sum(i * stride for i, stride in zip(index, self.strides))
+
+    def __getitem__(self, index):
+        return self.values[self.offset(index)]
+
+    def __setitem__(self, index, value):
+        self.values[self.offset(index)] = value
+
+
+class ApproxSolver(object):
+    """
+    Approximate-optimal solver for Yatzy, Yahtzee and Maxi Yatzy.
+
+    Exact state (every open box, upper section sum and saved rerolls) is
+    way too large for Maxi Yatzy, so it's compressed to (open upper boxes
+    mask, upper section sum, number of open lower boxes, saved rerolls,
+    capped at SAVED_REROLLS_CAP). Each lower box is valued at its
+    reservation value (expected score of a turn dedicated to it), and a
+    table keeps expected surplus over those - upper section scores, bonus,
+    saved rerolls and scoring lower boxes better than their reservation.
+    While generating a table, open lower boxes are assumed to be a random
+    subset of a given size; advice uses actual open boxes.
+
+    In Yahtzee, state also has a flag, whether Yahtzee has been scored for
+    50 points, so that further Yahtzees get Yahtzee Bonus and joker rules
+    (it shares the last table dimension with saved rerolls, which Yahtzee
+    doesn't have). Scoring a Yahtzee sets the flag only in advice, as it's
+    not known during generation, whether Yahtzee box is still open.
+    """
+
+    def __init__(self, yahtzee=False, maxi=False, values=None):
+        self.yahtzee = yahtzee
+        self.maxi = maxi
+        self.ndice = 6 if maxi else 5
+        self.space = hand_space(self.ndice)
+        scoreboard = Scoreboard([None], yahtzee, False, maxi)
+        boxes = [box for box in scoreboard.scores[0].values() if box.rule]
+        self.names = [box.name for box in boxes]
+        self.lower = self.names[6:]
+        self.target = scoreboard.get_upper_section_bonus_score()
+        self.bonus = scoreboard.get_upper_section_bonus_value()
+        self.cap = SAVED_REROLLS_CAP if maxi else 0
+        self.flags = 2 if yahtzee else 1
+        self.dims = (64, self.target + 1, len(self.lower) + 1,
+                     (self.cap + 1) * self.flags)
+        self.values = values if values is not None else ValueGrid(self.dims)
+        self.counts = [
+            [hand.count(face) for face in range(1, 7)]
+            for hand in self.space.hands
+        ]
+        scores = [self.space.score(box) for box in boxes[6:]]
+        self.reserve = [
+            self.space.expected(self.space.turn_levels(box_scores, 2)[2])
+            for box_scores in scores
+        ]
+        # surplus[b][h] - score of a hand h in b-th lower box over reserve
+        self.surplus = [
+            [score - reserve for score in box_scores]
+            for box_scores, reserve in zip(scores, self.reserve)
+        ]
+        # open_surplus[l][h] - expected best surplus with l random open boxes
+        self.open_surplus = [None]
+        for size in range(1, len(self.lower) + 1):
+            self.open_surplus.append([
+                subset_max_expectation(
+                    [surplus[hand] for surplus in self.surplus], size
+                )
+                for hand in range(len(self.space.hands))
+            ])
+        # Yahtzee hands (by index) and their surplus in lower boxes, when
+        # they're scored by joker rules
+        self.yatzy = {}
+        self.yahtzee_box = None
+        if yahtzee:
+            self.yahtzee_box = self.lower.index("Yahtzee")
+            for face in range(1, 7):
+                hand = (face,) * self.ndice
+                dice = [Dice(die) for die in hand]
+                self.yatzy[self.space.index[hand]] = [
+                    box.preview_joker_dice(dice) - reserve
+                    for box, reserve in zip(boxes[6:], self.reserve)
+                ]
+
+    def key(self, mask, upper_sum, lower_count, saved, flag):
+        """Table index of a state"""
+        return mask, upper_sum, lower_count, saved * self.flags + flag
+
+    def max_upper_sum(self, mask):
+        """Maximum upper section sum with mask of open upper boxes"""
+        total = sum(
+            face * self.ndice for face in range(1, 7)
+            if not mask & (1 << (face - 1))
+        )
+        return min(total, self.target)
+
+    def upper_options(self, mask, upper_sum, lower_count, saved, flag=0):
+        """Values of upper boxes for each count of their face's dice"""
+        options = []
+        for face in range(1, 7):
+            if mask & (1 << (face - 1)):
+                rest = mask & ~(1 << (face - 1))
+                options.append((face - 1, [
+                    count * face + self.values[self.key(
+                        rest, min(upper_sum + count * face, self.target),
+                        lower_count, saved, flag
+                    )]
+                    for count in range(self.ndice + 1)
+                ]))
+        return options
+
+    def joker_values(self, index, mask, upper_sum, lower_count, lower_open,
+                     flag):
+        """
+        Values of scoring a Yahtzee hand in each box it may be scored in,
+        if Yahtzee has been scored (by box number), without reserved values
+        """
+        face = self.space.hands[index][0] - 1
+        after = None
+        if lower_count:
+            after = self.values[self.key(
+                mask, upper_sum, lower_count - 1, 0, flag
+            )]
+        if mask & (1 << face):
+            # Corresponding upper box has to be used, if it's open
+            options = self.upper_options(mask, upper_sum, lower_count, 0,
+                                         flag)
+            return {face: 100 + dict(options)[face][self.ndice]}
+        if lower_count:
+            if lower_open is None:
+                # Yahtzee box itself is filled already
+                surplus = [
+                    value for box, value in enumerate(self.yatzy[index])
+                    if box != self.yahtzee_box
+                ]
+                return {6: 100 + after + subset_max_expectation(
+                    surplus, min(lower_count, len(surplus))
+                )}
+            return {
+                6 + box: 100 + after + self.yatzy[index][box]
+                for box in lower_open
+            }
+        return {
+            box: 100 + values[0]
+            for box, values in self.upper_options(
+                mask, upper_sum, lower_count, 0, flag
+            )
+        }
+
+    def terminal(self, mask, upper_sum, lower_count, saved, lower_open=None,
+                 flag=0):
+        """Value of every hand, if it's scored with saved rerolls left"""
+        saved = min(saved, self.cap)
+        upper = self.upper_options(mask, upper_sum, lower_count, saved, flag)
+        lower = None
+        if lower_count:
+            after = self.values[self.key(
+                mask, upper_sum, lower_count - 1, saved, flag
+            )]
+            if lower_open is None:
+                surplus = self.open_surplus[lower_count]
+            else:
+                surplus = [
+                    max(self.surplus[box][hand] for box in lower_open)
+                    for hand in range(len(self.space.hands))
+                ]
+            lower = [value + after for value in surplus]
+        values = []
+        for hand, counts in enumerate(self.counts):
+            best = lower[hand] if lower is not None else None
+            for face, face_values in upper:
+                value = face_values[counts[face]]
+                if best is None or value > best:
+                    best = value
+            values.append(best)
+        for index in self.yatzy:
+            if flag:
+                values[index] = max(self.joker_values(
+                    index, mask, upper_sum, lower_count, lower_open, flag
+                ).values())
+            elif lower_open is not None and self.yahtzee_box in lower_open:
+                # Scoring a Yahtzee gets Yahtzee Bonus going
+                values[index] = max(values[index], self.values[self.key(
+                    mask, upper_sum, lower_count - 1, saved, 1
+                )] + self.surplus[self.yahtzee_box][index])
+        return values
+
+    def levels(self, mask, upper_sum, lower_count, rerolls, lower_open=None,
+               flag=0):
+        """
+        Get values[r][h] - value of a hand h with r rerolls left. Scoring a
+        hand early keeps unused rerolls for later turns (in Maxi Yatzy).
+        """
+        terminals = {}
+
+        def terminal(left):
+            left = min(left, self.cap)
+            if left not in terminals:
+                terminals[left] = self.terminal(
+                    mask, upper_sum, lower_count, left, lower_open, flag
+                )
+            return terminals[left]
+
+        levels = [terminal(0)]
+        for left in range(1, rerolls + 1):
+            keep_values = self.space.keep_values(levels[-1])
+            stop = terminal(left)
+            levels.append([
+                max(stop[hand], max([keep_values[keep] for keep in keeps]))
+                for hand, keeps in enumerate(self.space.hand_keeps)
+            ])
+        return levels
+
+    def state_value(self, mask, upper_sum, lower_count, saved, flag=0):
+        """Expected surplus of the remaining game, before a turn"""
+        if not mask and not lower_count:
+            return float(self.bonus) if upper_sum >= self.target else 0.0
+        levels = self.levels(
+            mask, upper_sum, lower_count, 2 + saved, flag=flag
+        )
+        return self.space.expected(levels[-1])
+
+    def expected_score(self, mask, upper_sum, lower_open, saved, flag=0):
+        """Expected score of the remaining game, before a turn"""
+        upper_sum = min(upper_sum, self.target)
+        saved = min(saved, self.cap)
+        reserved = sum(self.reserve[box] for box in lower_open)
+        return self.values[self.key(
+            mask, upper_sum, len(lower_open), saved, flag
+        )] + reserved
+
+    def box_values(self, mask, upper_sum, lower_open, index, saved, flag=0):
+        """
+        Values of scoring a hand (by its index) in each box it may be scored
+        in right now, leaving saved rerolls for later turns (by box number,
+        without reserved values)
+        """
+        upper_sum = min(upper_sum, self.target)
+        lower_count = len(lower_open)
+        saved = min(saved, self.cap)
+        if flag and index in self.yatzy:
+            return self.joker_values(
+                index, mask, upper_sum, lower_count, lower_open, flag
+            )
+        values = {}
+        counts = self.counts[index]
+        for face, face_values in self.upper_options(
+                mask, upper_sum, lower_count, saved, flag):
+            values[face] = face_values[counts[face]]
+        if lower_count:
+            after = self.values[self.key(
+                mask, upper_sum, lower_count - 1, saved, flag
+            )]
+            for lower in lower_open:
+                values[6 + lower] = self.surplus[lower][index] + after
+            if self.yahtzee_box in lower_open and index in self.yatzy:
+                values[6 + self.yahtzee_box] += self.values[self.key(
+                    mask, upper_sum, lower_count - 1, saved, 1
+                )] - after
+        return values
+
+    def keep_values(self, mask, upper_sum, lower_open, hand, rerolls,
+                    flag=0):
+        """
+        Values of keeping each subset of dice from hand on a reroll (by dice
+        kept, without reserved values)
+        """
+        upper_sum = min(upper_sum, self.target)
+        levels = self.levels(
+            mask, upper_sum, len(lower_open), rerolls - 1, lower_open, flag
+        )
+        return self.space.hand_keep_values(tuple(sorted(hand)), levels[-1])
+
+    def advise(self, mask, upper_sum, lower_open, hand, rerolls, flag=0,
+               allowed=None):
+        """
+        Get the best dice to keep from hand (or the best box to score it in
+        right now, if rerolling is not worth it), and expected score of the
+        remaining game (including this turn). Boxes, which hand can be
+        scored in, can be limited to allowed names.
+        """
+        hand = tuple(sorted(hand))
+        upper_sum = min(upper_sum, self.target)
+        reserved = sum(self.reserve[box] for box in lower_open)
+        index = self.space.index[hand]
+        # Value of scoring this hand right now in each box
+        values = self.box_values(
+            mask, upper_sum, lower_open, index, rerolls, flag
+        )
+        if allowed is not None:
+            values = {
+                box: value for box, value in values.items()
+                if self.names[box] in allowed
+            } or values
+        box = max(values, key=values.get)
+        value = values[box]
+        if rerolls:
+            levels = self.levels(
+                mask, upper_sum, len(lower_open), rerolls - 1, lower_open,
+                flag
+            )
+            keep, keep_value = self.space.best_keep(hand, levels[-1])
+            if keep_value > value:
+                return keep, None, keep_value + reserved
+        return hand, self.names[box], value + reserved
+
+
+def _init_generator(yahtzee, maxi, values):
+    global _generator
+    _generator = ApproxSolver(yahtzee, maxi)
+    _generator.values.values = values
+
+
+def _solve_chunk(chunk):
+    """Compute state values for a given open boxes combination"""
+    mask, lower_count = chunk
+    results = []
+    for upper_sum in range(_generator.max_upper_sum(mask) + 1):
+        for saved in range(_generator.cap + 1):
+            for flag in range(_generator.flags):
+                results.append((upper_sum, saved, flag, _generator.state_value(
+                    mask, upper_sum, lower_count, saved, flag
+                )))
+    return chunk, results
+
+
+def _save_checkpoint(path, checkpoint):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(checkpoint, f)
+    os.replace(tmp, path)
+
+
+def _load_checkpoint(path, rulehash):
+    try:
+        with open(path, "rb") as f:
+            checkpoint = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    if checkpoint.get("rule_hash") != rulehash:
+        return None
+    return checkpoint
+
+
+def generate(yahtzee=False, maxi=True, jobs=None):
+    """
+    Generate a solver table using a pool of processes. States with the same
+    number of open boxes are independent, so they are solved in parallel,
+    level by level. Progress is checkpointed, so an interrupted generation
+    resumes where it has stopped.
+    """
+    name = approx_table_name(yahtzee, maxi)
+    rulehash = approx_rule_hash(yahtzee, maxi)
+    path = table_path(name)
+    solver = ApproxSolver(yahtzee, maxi)
+    values = solver.values
+    checkpoint_path = f"{path}.ckpt"
+    checkpoint = _load_checkpoint(checkpoint_path, rulehash)
+    if checkpoint is None:
+        checkpoint = {
+            "rule_hash": rulehash,
+            "values": array("d", values.values),
+            "done": set(),
+        }
+    else:
+        logger.info("Resuming %s generation from a checkpoint", name)
+    values.values = checkpoint["values"]
+    done = checkpoint["done"]
+    lower_boxes = len(solver.lower)
+    saved_at = time()
+    for level in range(6 + lower_boxes + 1):
+        chunks = [
+            (mask, lower_count)
+            for mask in range(64) for lower_count in range(lower_boxes + 1)
+            if bin(mask).count("1") + lower_count == level
+            and (mask, lower_count) not in done
+        ]
+        if not chunks:
+            continue
+        with Pool(jobs, _init_generator,
+                  (yahtzee, maxi, values.values)) as pool:
+            for chunk, results in pool.imap_unordered(_solve_chunk, chunks):
+                mask, lower_count = chunk
+                for upper_sum, saved, flag, value in results:
+                    values[solver.key(
+                        mask, upper_sum, lower_count, saved, flag
+                    )] = value
+                done.add(chunk)
+                if time() - saved_at > CHECKPOINT_INTERVAL:
+                    _save_checkpoint(checkpoint_path, checkpoint)
+                    saved_at = time()
+        _save_checkpoint(checkpoint_path, checkpoint)
+        logger.info("%s: %d/%d open boxes solved", name, level,
+                    6 + lower_boxes)
+    write_table(path, name, rulehash, solver.dims, values.values, FLOAT16)
+    os.remove(checkpoint_path)
+
+
+def approx_solver(yahtzee=False, maxi=False):
+    """Get a solver for a game variant (or None, if it has no table)"""
+    return _solvers.get((yahtzee, maxi))
+
+
+def load_approx_solvers():
+    """Load solvers for all game variants, which have tables generated"""
+    for yahtzee, maxi in APPROX_VARIANTS:
+        name = approx_table_name(yahtzee, maxi)
+        table = open_table(
+            table_path(name), name, approx_rule_hash(yahtzee, maxi)
+        )
+        if table is not None:
+            _solvers[(yahtzee, maxi)] = ApproxSolver(yahtzee, maxi, table)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate approximate solver tables."
+    )
+    parser.add_argument(
+        "variant", choices=[
+            variant_name(yahtzee, False, maxi)
+            for yahtzee, maxi in APPROX_VARIANTS
+        ], nargs="?", default=variant_name(False, False, True)
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: number of CPU cores)"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO)
+    for yahtzee, maxi in APPROX_VARIANTS:
+        if variant_name(yahtzee, False, maxi) == args.variant:
+            generate(yahtzee, maxi, args.jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+from collections import defaultdict
+
+from const import VARIANTS
+from scoreboard import Scoreboard
+from solver import hand_distribution, keep_face_chain
+from tables import (
+    FIXED16,
+    load_table,
+    rule_hash,
+    table_path,
+    variant_name,
+)
+
+# Bump this when the strategy below changes, so tables get rebuilt
+BONUS_TABLE_VERSION = 1
+PROBABILITY_SCALE = 65535
+
+_bonus_tables = {}
+
+
+def build_bonus_table(yahtzee=False, forced=False, maxi=False):
+    """
+    Compute probabilities P[t][m][s] to get upper section bonus with upper
+    section sum s, mask m of open upper boxes (bit 0 is Ones) and t turns
+    remaining. Strategy is to pick a face of an open upper box after the
+    first roll, keep all dice of that face while rerolling, then score them
+    (or put the hand into lower section, if it's allowed and is better).
+    """
+    ndice = 6 if maxi else 5
+    target = Scoreboard.get_upper_section_bonus_score_static(maxi, forced)
+    scoreboard = Scoreboard([None], yahtzee, forced, maxi)
+    turns = sum(1 for box in scoreboard.scores[0].values() if box.rule)
+    lower = turns - 6
+    chain = keep_face_chain(ndice, 2)
+    hands = hand_distribution(ndice)
+    table = [[[0.0] * (target + 1) for _ in range(64)]
+             for _ in range(turns + 1)]
+    for t in range(turns + 1):
+        for m in range(64):
+            table[t][m][target] = 1.0
+    for m in range(1, 64):
+        faces = [face for face in range(6) if m & (1 << face)]
+        if forced:
+            faces = faces[:1]  # Only first open box can be filled
+        # First roll outcomes, grouped by counts of faces we care about
+        outcomes = defaultdict(float)
+        for probability, counts in hands:
+            outcomes[tuple(counts[face] for face in faces)] += probability
+        outcomes = list(outcomes.items())
+        opened = bin(m).count("1")
+        for t in range(opened, min(opened + lower, turns) + 1):
+            # In Forced Yatzy, upper section is always filled first
+            can_skip = not forced and t > opened
+            for s in range(target):
+                skip = table[t - 1][m][s] if can_skip else 0.0
+                keep_values = []
+                for face in faces:
+                    row = table[t - 1][m & ~(1 << face)]
+                    scored = [
+                        max(row[min(s + k * (face + 1), target)], skip)
+                        for k in range(ndice + 1)
+                    ]
+                    keep_values.append([
+                        sum(chain[c][k] * scored[k]
+                            for k in range(c, ndice + 1))
+                        for c in range(ndice + 1)
+                    ])
+                total = 0.0
+                for counts, probability in outcomes:
+                    best = skip
+                    for values, count in zip(keep_values, counts):
+                        if values[count] > best:
+                            best = values[count]
+                    total += probability * best
+                table[t][m][s] = total
+    values = [
+        min(value, 1.0) for plane in table for row in plane for value in row
+    ]
+    return (turns + 1, 64, target + 1), values
+
+
+def load_bonus_table(yahtzee=False, forced=False, maxi=False):
+    """Load (building it, if necessary) bonus probability table"""
+    name = f"bonus-{variant_name(yahtzee, forced, maxi)}"
+    rulehash = hashlib.sha256(
+        rule_hash(yahtzee, forced, maxi) + bytes([BONUS_TABLE_VERSION])
+    ).digest()
+    _bonus_tables[(yahtzee, forced, maxi)] = load_table(
+        table_path(name), name, rulehash,
+        lambda: build_bonus_table(yahtzee, forced, maxi),
+        FIXED16, PROBABILITY_SCALE
+    )
+
+
+def load_bonus_tables():
+    """Load bonus probability tables for all game variants"""
+    for variant in VARIANTS:
+        load_bonus_table(*variant)
+
+
+def bonus_chance(scoreboard, seat):
+    """
+    Look up a probability for player to get upper section bonus (or None,
+    if bonus probability table is not loaded yet)
+    """
+    table = _bonus_tables.get(
+        (scoreboard.yahtzee, scoreboard.forced, scoreboard.maxi)
+    )
+    if table is None:
+        return None
+    target = scoreboard.get_upper_section_bonus_score()
+    boxes = scoreboard.scores[seat]
+    upper_sum = min(boxes["Up. Sect. Total"].score, target)
+    mask = 0
+    for face, box in enumerate(list(boxes.values())[:6]):
+        if box.score is None:
+            mask |= 1 << face
+    turns = sum(1 for box in boxes.values() if box.score is None)
+    return table[turns, mask, upper_sum]
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Catch-up of updates, which have piled up while the bot was down.
+
+Backlog is fetched in batches before polling starts (so that fetching never
+conflicts with it) and split into streams by table. Commands, which have
+been superseded by later ones of the same player, are dropped:
+
+    * dice toggles, which cancel each other out (/1 /1), or are reset
+      (/1 /2 /rr) - only their net effect is kept;
+    * dice toggles right before scoring a hand (pool doesn't matter then);
+    * repeats of a command (/roll /roll), which can't change anything.
+
+Then streams of different tables are processed concurrently (updates of
+each stream in order) in background, while polling goes on. Lock of each
+table is held from the start of its catch-up, so that new updates of a
+table are queued behind its backlog. While a backlog update is processed,
+replaying is set (so that the table lock isn't taken once more, and
+replies could skip pacing).
+"""
+
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from time import perf_counter
+
+from telegram.error import TelegramError
+
+from const import CATCHUP_BATCH
+
+logger = logging.getLogger(__name__)
+
+replaying = ContextVar("replaying", default=False)
+
+
+async def fetch_backlog(bot, batch=CATCHUP_BATCH):
+    """Fetch all pending updates, confirming them to Telegram"""
+    updates = []
+    offset = None
+    while True:
+        # Each request confirms updates, which have been fetched before
+        fetched = await bot.get_updates(offset=offset, limit=batch, timeout=0)
+        if not fetched:
+            return updates
+        updates.extend(fetched)
+        offset = fetched[-1].update_id + 1
+
+
+def collapse(stream, toggles, resets, moves, repeatable):
+    """
+    Find superseded commands in a stream of (user id, command) of a table
+    (command is None for updates, which aren't commands), returning a list
+    of flags, whether to keep each of them
+    """
+    keep = [True] * len(stream)
+    i = 0
+    while i < len(stream):
+        user, command = stream[i]
+        if command is not None and command.name in toggles:
+            end = i
+            while end < len(stream) and stream[end][0] == user and \
+                    stream[end][1] is not None and \
+                    stream[end][1].name in toggles:
+                end += 1
+            _collapse_toggles(stream, keep, i, end, resets, moves)
+            i = end
+            continue
+        if command is not None and command.name in repeatable and i and \
+                stream[i - 1] == (user, command):
+            keep[i] = False
+        i += 1
+    return keep
+
+
+def _collapse_toggles(stream, keep, start, end, resets, moves):
+    user = stream[start][0]
+    if end < len(stream) and stream[end][0] == user and \
+            stream[end][1] is not None and stream[end][1].name in moves:
+        # Hand is scored right away
+        keep[start:end] = [False] * (end - start)
+        return
+    for i in range(end - 1, start - 1, -1):
+        if stream[i][1].name in resets:
+            keep[start:i] = [False] * (i - start)
+            start = i + 1
+            break
+    # Toggles of the same dice cancel out in pairs, keep the last odd one
+    counts = Counter(stream[i][1].name for i in range(start, end))
+    seen = set()
+    for i in range(end - 1, start - 1, -1):
+        name = stream[i][1].name
+        if counts[name] % 2 == 0 or name in seen:
+            keep[i] = False
+        seen.add(name)
+
+
+async def catch_up(application, parse, lock, toggles, resets, moves,
+                   repeatable):
+    """
+    Fetch a backlog of updates and start processing it in background,
+    returning its task (or None, if there's no backlog). Parse gets a table
+    and a command of an update (or None, if it's not a command of the bot),
+    lock gets a lock of a table.
+    """
+    started = perf_counter()
+    try:
+        updates = await fetch_backlog(application.bot)
+    except TelegramError as e:
+        logger.error("Failed to fetch update backlog: %s", e)
+        return None
+    if not updates:
+        return None
+    streams = defaultdict(list)
+    for update in updates:
+        parsed = parse(update)
+        if parsed is None:
+            streams[None].append((update, None, None))
+        else:
+            table, command = parsed
+            streams[table].append(
+                (update, update.message.from_user.id, command)
+            )
+    dropped = 0
+    for table, stream in streams.items():
+        keep = collapse(
+            [(user, command) for _, user, command in stream],
+            toggles, resets, moves, repeatable
+        )
+        dropped += keep.count(False)
+        streams[table] = [
+            update for (update, _, _), kept in zip(stream, keep) if kept
+        ]
+    # Polling hasn't started yet, so nothing else holds these locks
+    locks = {}
+    for table in streams:
+        if table is not None:
+            locks[table] = lock(table)
+            await locks[table].acquire()
+
+    async def process(table, stream):
+        replaying.set(True)
+        try:
+            for update in stream:
+                await application.process_update(update)
+        finally:
+            if table in locks:
+                locks[table].release()
+
+    async def process_all():
+        await asyncio.gather(
+            *[process(table, stream) for table, stream in streams.items()]
+        )
+        logger.info(
+            "Caught up with %d update(s) in %d stream(s) (%d superseded) "
+            "in %.3fs", len(updates), len(streams), dropped,
+            perf_counter() - started
+        )
+
+    return asyncio.create_task(process_all())
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from const import (
+    ERROR,
+    COMPUTE_TIMEOUT,
+    COMPUTE_WORKERS,
+    COMPUTE_MAX_PENDING,
+)
+from error import ComputeError, ComputeCancelledError
+from tracing import span
+
+
+def _init_worker(initializer, initargs):
+    """Prepare a worker process (e.g. load lookup tables)"""
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _warmup():
+    """No-op job, used to get worker processes spawned in advance"""
+    return os.getpid()
+
+
+class ComputeService(object):
+    """
+    Runs CPU-heavy jobs in a pool of worker processes, so they never block
+    the event loop
+    """
+
+    def __init__(self, workers=COMPUTE_WORKERS,
+                 max_pending=COMPUTE_MAX_PENDING, timeout=COMPUTE_TIMEOUT,
+                 initializer=None, initargs=()):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self.executor = None
+        self.pending = defaultdict(set)  # Running jobs, grouped by key
+        self.cancelled = set()  # Jobs cancelled by the cancel() call
+        self.queued = 0
+
+    async def start(self, warmup=True):
+        """
+        Start worker processes and wait until all of them are ready (or let
+        them be spawned in background, if warmup is False)
+        """
+        if self.executor is not None:
+            return
+        self.executor = ProcessPoolExecutor(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(self.initializer, self.initargs)
+        )
+        if warmup:
+            await self.warmup()
+
+    async def warmup(self):
+        """Spawn worker processes in advance and wait until they're ready"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *[loop.run_in_executor(self.executor, _warmup)
+              for _ in range(self.workers)]
+        )
+
+    def stop(self):
+        """Shut down worker processes, discarding any queued jobs"""
+        if self.executor is None:
+            return
+        for key in list(self.pending):
+            self.cancel(key)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+
+    async def run(self, key, func, *args, timeout=None):
+        """
+        Run func(*args) in a worker process and await its result. Key
+        identifies a state the job is computed for (e.g. a game), so all
+        jobs for that state could be cancelled when it's no longer relevant
+        """
+        if self.executor is None:
+            raise ComputeError(f"{ERROR} Computation service is not running.")
+        if self.queued >= self.max_pending:
+            raise ComputeError(
+                f"{ERROR} Bot is too busy right now, please try again later."
+            )
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, func, *args)
+        self.queued += 1
+        self.pending[key].add(future)
+        try:
+            with span("compute", function=func.__name__):
+                return await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise ComputeError(f"{ERROR} Computation has timed out.")
+        except asyncio.CancelledError:
+            if future not in self.cancelled:
+                raise  # The awaiting task itself was cancelled
+            raise ComputeCancelledError("Computation result is outdated.")
+        finally:
+            self.queued -= 1
+            self.cancelled.discard(future)
+            self.pending[key].discard(future)
+            if not self.pending[key]:
+                del self.pending[key]
+
+    def cancel(self, key):
+        """Cancel all jobs for a given key (e.g. after game state change)"""
+        for future in self.pending.get(key, ()):
+            if not future.done():
+                self.cancelled.add(future)
+                future.cancel()
@@ -19,6 +19,80 @@
 
 # Timing constants
 INACTIVITY_TIMEOUT = 1800
+COMPUTE_TIMEOUT = 10
+TABLE_BUILD_TIMEOUT = 3600
+
+# Game variants (as yahtzee, forced and maxi flags)
+VARIANTS = (
+    (False, False, False),  # Yatzy
+    (True, False, False),  # Yahtzee
+    (False, True, False),  # Forced Yatzy
+    (False, False, True),  # Maxi Yatzy
+    (False, True, True),  # Forced Maxi Yatzy
+)
+
+# Location of precomputed lookup tables
+TABLES_DIR = "tables"
+
+# Computation pool settings
+COMPUTE_WORKERS = None  # None means a worker per CPU core
+COMPUTE_MAX_PENDING = 64
+
+# Statistics database settings
+STATS_DB = "stats.db"
+STATS_FLUSH_INTERVAL = 2
+SCORE_BUCKET = 25  # Width of score histogram buckets
+TOP_SIZE = 10
+TOP_RECENT_DAYS = 30
+
+# Turn export settings
+EXPORT_DIR = "export"
+EXPORT_FLUSH_INTERVAL = 10
+REPLAY_DIR = "replays"
+
+# Player rating settings (Elo)
+RATING_INITIAL = 1500
+RATING_K = 32
+
+# Win chance estimation settings (rollouts per player and time budget)
+ROLLOUT_SAMPLES = 1000
+ROLLOUT_BATCH = 50
+ROLLOUT_BUDGET = 1.0
+ROLLOUT_CACHE_SIZE = 1024
+ADVICE_BUDGET = 0.5  # Win-maximising advice has to fit into a roll message
+ADVICE_BATCH = 20  # Rollouts per candidate, between deadline checks
+ADVICE_CANDIDATES = 4  # Most candidates, that are raced (best by EV first)
+ADVICE_EV_MARGIN = 5.0  # Candidates further behind the best EV are pruned
+ADVICE_CONFIDENCE = 2.0  # Standard errors to overrule the best EV advice
+
+# Bot API HTTP client settings (getUpdates has a pool of its own, so that
+# bursts of outgoing messages never hold update fetching up)
+HTTP_POOL_SIZE = 32  # Connections for outgoing requests
+HTTP_UPDATES_POOL_SIZE = 1  # Connections for getUpdates
+HTTP_POOL_TIMEOUT = 5.0  # Seconds to wait for a free connection
+HTTP_KEEPALIVE_EXPIRY = 60.0  # Seconds to keep an idle connection open
+HTTP_VERSION = "1.1"  # "2" needs httpx[http2] (h2) to be installed
+
+# Catch-up of updates, which have piled up while the bot was down
+CATCHUP_BATCH = 100  # Updates per getUpdates request (at most 100)
+
+# Sharding settings (games are split between worker processes by chat id)
+SHARD_VNODES = 64  # Points per worker on consistent hash ring
+SHARD_RATE = 30  # Messages per second, shared by all workers
+
+# Logging settings
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_SAMPLE = {"dice_toggle": 10}  # Keep 1 in N records of these events
+
+# Handoff of live games to a new process (on restart)
+HANDOFF_SOCKET = "yatzybot.sock"
+HANDOFF_TIMEOUT = 30
+
+# Tracing of updates (into a rotating file of OTLP/JSON traces)
+TRACE_FILE = "traces.jsonl"
+TRACE_SAMPLE = 0.01  # Fraction of updates to be traced (0 to disable)
+TRACE_MAX_BYTES = 16 * 2 ** 20
+TRACE_BACKUPS = 3
 
 # General emojis
 WILDCARD_DICE = "*️⃣"
@@ -51,6 +125,12 @@ LOWER = "🔽"
 JOKER = "🃏"
 BEST = "📈"
 RULES = "📖"
+ADVICE = "🧠"
+ODDS = "📊"
+LUCK = "🍀"
+SKILL = "🎯"
+STATS = "📋"
+TOP = "🏅"
 
 # Move icons
 MOVE_ICONS = {
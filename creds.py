@@ -18,3 +18,4 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 TOKEN = 'TOKEN'
+ADMINS = []  # User ids, which can use admin commands (e.g. /botstats)
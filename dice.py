@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import random
 from random import randint
 
 from const import VALUES, EMOJIS
@@ -67,12 +68,12 @@ class Dice(object):
         return dice
 
     @classmethod
-    def roll(cls, n=5):
+    def roll(cls, n=5, rng=random):
         dice = []
         for _ in range(n):
-            dice.append(Dice())
+            dice.append(Dice(rng.randint(1, 6)))
         return dice
 
     @classmethod
-    def roll_single(cls):
-        return Dice()
+    def roll_single(cls, rng=random):
+        return Dice(rng.randint(1, 6))
@@ -28,3 +28,15 @@ class IllegalMoveError(Exception):
 
 class PlayerError(Exception):
     pass
+
+
+class ComputeError(Exception):
+    pass
+
+
+class ComputeCancelledError(ComputeError):
+    pass
+
+
+class TableError(Exception):
+    pass
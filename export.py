@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Append-only columnar export of finished games, one row per turn.
+
+Each batch of games is written into new part files, partitioned by date
+(EXPORT_DIR/date=YYYY-MM-DD/part-*.yzc). Part file layout (little endian):
+
+    magic       8s   b"YZCOLS\\0\\0"
+    version     H    format version
+    rows        I    number of rows
+    schema_len  I    length of JSON schema - a list of columns with their
+                     names, array type codes and dictionaries (for strings)
+    schema      schema_len bytes
+    columns     for each column: I length, then zlib-compressed array
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import struct
+import sys
+import zlib
+from array import array
+from datetime import datetime, timezone
+from time import time, time_ns
+
+from const import EXPORT_DIR, EXPORT_FLUSH_INTERVAL
+from tables import variant_name
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"YZCOLS\0\0"
+VERSION = 1
+HEADER = struct.Struct('<8sHII')
+LENGTH = struct.Struct('<I')
+
+# Columns as (name, array type code, whether it's dictionary encoded)
+COLUMNS = (
+    ("game_id", 'q', False),
+    ("finished_at", 'q', False),
+    ("chat_id", 'q', False),
+    ("variant", 'B', True),
+    ("turn", 'H', False),
+    ("player_id", 'q', False),
+    ("hand", 'I', False),
+    ("rerolls", 'B', False),
+    ("box", 'B', True),
+    ("score", 'H', False),
+)
+
+
+def hand_code(hand):
+    """Pack a hand into an integer (e.g. 1, 2, 2, 5, 6 -> 12256)"""
+    return int("".join(str(die) for die in sorted(hand)))
+
+
+def game_rows(game, finished_at=None):
+    """Get export rows (as tuples in COLUMNS order) for a finished game"""
+    finished_at = int(time()) if finished_at is None else finished_at
+    variant = variant_name(game.yahtzee, game.forced, game.maxi)
+    return [
+        (game.game_id, finished_at, game.chat, variant, record.turn,
+         record.player_id, hand_code(record.hand), record.rerolls,
+         record.box, record.score)
+        for record in game.turn_log
+    ]
+
+
+def partition(finished_at):
+    """Partition directory name for a timestamp"""
+    date = datetime.fromtimestamp(finished_at, timezone.utc).date()
+    return f"date={date.isoformat()}"
+
+
+def write_part(root, rows):
+    """Write rows into a new part file (atomically), returning its path"""
+    schema = []
+    columns = []
+    for i, (name, code, encoded) in enumerate(COLUMNS):
+        values = [row[i] for row in rows]
+        column = {"name": name, "type": code}
+        if encoded:
+            column["dictionary"] = sorted(set(values))
+            index = {value: n for n, value in enumerate(column["dictionary"])}
+            values = [index[value] for value in values]
+        schema.append(column)
+        data = array(code, values)
+        if sys.byteorder != "little":
+            data.byteswap()
+        columns.append(zlib.compress(data.tobytes()))
+    directory = os.path.join(root, partition(rows[0][1]))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(
+        directory, f"part-{time_ns()}-{os.getpid()}.yzc"
+    )
+    schema = json.dumps(schema).encode()
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(rows), len(schema)))
+        f.write(schema)
+        for column in columns:
+            f.write(LENGTH.pack(len(column)))
+            f.write(column)
+    os.replace(tmp, path)
+    return path
+
+
+def read_part(path, names=None):
+    """
+    Read columns (all or only given names) of a part file, as a dict of
+    column names to lists of values
+    """
+    with open(path, "rb") as f:
+        magic, version, rows, schema_len = HEADER.unpack(
+            f.read(HEADER.size)
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a supported export file")
+        schema = json.loads(f.read(schema_len))
+        columns = {}
+        for column in schema:
+            length, = LENGTH.unpack(f.read(LENGTH.size))
+            if names is not None and column["name"] not in names:
+                f.seek(length, os.SEEK_CUR)
+                continue
+            data = array(column["type"])
+            data.frombytes(zlib.decompress(f.read(length)))
+            if sys.byteorder != "little":
+                data.byteswap()
+            values = data.tolist()
+            if "dictionary" in column:
+                values = [column["dictionary"][value] for value in values]
+            columns[column["name"]] = values
+    return columns
+
+
+def iter_parts(root=EXPORT_DIR, since=None, until=None):
+    """Iterate over part files, optionally limited to a range of dates"""
+    if not os.path.isdir(root):
+        return
+    for directory in sorted(os.listdir(root)):
+        date = directory.partition("=")[2]
+        if since and date < since or until and date > until:
+            continue
+        for name in sorted(os.listdir(os.path.join(root, directory))):
+            if name.endswith(".yzc"):
+                yield os.path.join(root, directory, name)
+
+
+def iter_rows(root=EXPORT_DIR, since=None, until=None, names=None):
+    """
+    Stream rows (as dicts) of all part files - only a single part is held
+    in memory at a time
+    """
+    for path in iter_parts(root, since, until):
+        columns = read_part(path, names)
+        for values in zip(*columns.values()):
+            yield dict(zip(columns, values))
+
+
+class BatchWriter(object):
+    """
+    Writes queued items in batches from a background task. Subclasses
+    provide _write(items), which does the writing itself (it's run in a
+    thread, and may raise OSError, TypeError or ValueError on failure).
+    """
+
+    def __init__(self, flush_interval=EXPORT_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.queue = None
+        self.writer = None
+        self.flushing = None
+
+    def start(self):
+        """Start a background writer"""
+        self.queue = asyncio.Queue()
+        self.writer = asyncio.create_task(self._write_loop())
+
+    async def stop(self):
+        """Write all queued items"""
+        if self.writer is None:
+            return
+        self.writer.cancel()
+        try:
+            await self.writer
+        except asyncio.CancelledError:
+            pass
+        self.writer = None
+        if self.flushing is not None:
+            await self.flushing
+        await self._flush()
+
+    def put(self, item):
+        """Queue an item to be written"""
+        if self.queue is not None:
+            self.queue.put_nowait(item)
+
+    async def _flush(self):
+        items = []
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        if items:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self._write, items)
+            except (OSError, TypeError, ValueError) as e:
+                logger.error("%s failed to write: %s", type(self).__name__, e)
+
+    async def _write_loop(self):
+        while True:
+            # Item is put back, so nothing is lost, if we're cancelled
+            self.queue.put_nowait(await self.queue.get())
+            # Let other items pile up into a single batch
+            await asyncio.sleep(self.flush_interval)
+            # Batch is shielded, so stop() could wait until it's written
+            self.flushing = asyncio.ensure_future(self._flush())
+            await asyncio.shield(self.flushing)
+
+
+class TurnExporter(BatchWriter):
+    """Writes turns of finished games in batches from a background task"""
+
+    def __init__(self, root=EXPORT_DIR, flush_interval=EXPORT_FLUSH_INTERVAL):
+        BatchWriter.__init__(self, flush_interval)
+        self.root = root
+
+    def record(self, game):
+        """Queue turns of a finished game (to be used as on_finish hook)"""
+        if game.turn_log:
+            self.put(game_rows(game))
+
+    def _write(self, games):
+        partitions = {}
+        for rows in games:
+            for row in rows:
+                partitions.setdefault(partition(row[1]), []).append(row)
+        for rows in partitions.values():
+            write_part(self.root, rows)
+        logger.info("Exported %d game(s)", len(games))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Dump exported turns as CSV."
+    )
+    parser.add_argument("--root", default=EXPORT_DIR)
+    parser.add_argument("--since", help="first date (YYYY-MM-DD)")
+    parser.add_argument("--until", help="last date (YYYY-MM-DD)")
+    args = parser.parse_args()
+    writer = csv.writer(sys.stdout)
+    writer.writerow([name for name, _, _ in COLUMNS])
+    for row in iter_rows(args.root, args.since, args.until):
+        writer.writerow(row.values())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from math import comb
+
+from scoreboard import Scoreboard
+from solver import hand_space, keep_face_chain
+
+_solvers = {}
+
+
+class ForcedSolver(object):
+    """
+    Solver for Forced Yatzy and Forced Maxi Yatzy. As boxes are filled in a
+    fixed order, a state is just (box index, upper section sum).
+
+    It's optimal for Forced Yatzy only. In Forced Maxi Yatzy, values assume
+    2 rerolls per turn: saved rerolls have no value of their own (so luck
+    of a player, who banks rerolls, comes out biased) and advice spends
+    available rerolls, as long as there are dice worth rerolling.
+    """
+
+    def __init__(self, maxi=False):
+        self.maxi = maxi
+        self.ndice = 6 if maxi else 5
+        self.space = hand_space(self.ndice)
+        scoreboard = Scoreboard([None], False, True, maxi)
+        self.boxes = [
+            box for box in scoreboard.scores[0].values() if box.rule
+        ]
+        self.target = scoreboard.get_upper_section_bonus_score()
+        self.bonus = scoreboard.get_upper_section_bonus_value()
+        # Distribution of dice count of some face in a fresh roll
+        self.first_roll = [
+            comb(self.ndice, c) * (1 / 6) ** c * (5 / 6) ** (self.ndice - c)
+            for c in range(self.ndice + 1)
+        ]
+        # Lower section box scores and values with r rerolls left
+        self.scores = {}
+        self.levels = {}
+        # values[i][s] - expected score of remaining game before i-th box
+        # is filled, having s points in upper section (bonus is counted
+        # in, but it's awarded at the end)
+        count = len(self.boxes)
+        self.values = [[0.0] * (self.target + 1) for _ in range(count + 1)]
+        self.values[count][self.target] = float(self.bonus)
+        for i in reversed(range(count)):
+            if i < 6:
+                for s in range(self.target + 1):
+                    self.values[i][s] = sum(
+                        probability * self.upper_value(i, s, c, 2)
+                        for c, probability in enumerate(self.first_roll)
+                    )
+            else:
+                self.scores[i] = self.space.score(self.boxes[i])
+                self.levels[i] = self.space.turn_levels(self.scores[i], 2)
+                expected = self.space.expected(self.levels[i][2])
+                for s in range(self.target + 1):
+                    self.values[i][s] = expected + self.values[i + 1][s]
+
+    def upper_value(self, i, upper_sum, count, rerolls):
+        """
+        Expected value of an upper section box turn, having count dice of
+        its face and keeping all of them on rerolls
+        """
+        face = i + 1
+        chain = keep_face_chain(self.ndice, rerolls)
+        return sum(
+            chain[count][k] * (
+                k * face +
+                self.values[i + 1][min(upper_sum + k * face, self.target)]
+            )
+            for k in range(count, self.ndice + 1)
+        )
+
+    def lower_levels(self, i, rerolls):
+        """Lower section box hand values, for up to rerolls rerolls left"""
+        levels = self.levels[i]
+        if len(levels) <= rerolls:
+            # Saved Maxi Yatzy rerolls - extend levels on demand
+            more = rerolls + 1 - len(levels)
+            levels.extend(self.space.turn_levels(levels[-1], more)[1:])
+        return levels
+
+    def expected_score(self, i, upper_sum):
+        """Expected final score of the remaining game"""
+        return self.values[i][min(upper_sum, self.target)]
+
+    def score_value(self, i, upper_sum, hand):
+        """Expected final score of remaining game after hand is scored"""
+        upper_sum = min(upper_sum, self.target)
+        if i < 6:
+            return self.upper_value(
+                i, upper_sum, list(hand).count(i + 1), 0
+            )
+        hand = tuple(sorted(hand))
+        return (self.scores[i][self.space.index[hand]] +
+                self.values[i + 1][upper_sum])
+
+    def keep_values(self, i, upper_sum, hand, rerolls):
+        """
+        Expected final score of remaining game after keeping each subset of
+        dice from hand on a reroll (by dice kept)
+        """
+        hand = tuple(sorted(hand))
+        upper_sum = min(upper_sum, self.target)
+        if i >= 6:
+            after = self.values[i + 1][upper_sum]
+            levels = self.lower_levels(i, rerolls - 1)
+            return {
+                keep: value + after for keep, value in
+                self.space.hand_keep_values(hand, levels[rerolls - 1]).items()
+            }
+        # Only dice of box's face count, and they're kept after this reroll
+        face = i + 1
+        values = {}
+        for keep in self.space.hand_keeps[self.space.index[hand]]:
+            keep = self.space.keeps[keep]
+            count = keep.count(face)
+            rolled = self.ndice - len(keep)
+            values[keep] = sum(
+                comb(rolled, k) * (1 / 6) ** k * (5 / 6) ** (rolled - k) *
+                self.upper_value(i, upper_sum, count + k, rerolls - 1)
+                for k in range(rolled + 1)
+            )
+        return values
+
+    def advise(self, i, upper_sum, hand, rerolls):
+        """
+        Get the best dice to keep from hand before i-th box is filled (and a
+        box name, if hand is to be scored right now), and expected score of
+        remaining game (including this turn). Rerolls left after this turn
+        aren't valued.
+        """
+        hand = tuple(sorted(hand))
+        upper_sum = min(upper_sum, self.target)
+        if i < 6:
+            face = i + 1
+            keep = tuple(die for die in hand if die == face)
+            value = self.upper_value(i, upper_sum, len(keep), rerolls)
+            if rerolls and len(keep) != len(hand):
+                return keep, None, value
+            return hand, self.boxes[i].name, value
+        after = self.values[i + 1][upper_sum]
+        if rerolls:
+            levels = self.lower_levels(i, rerolls - 1)
+            keep, value = self.space.best_keep(hand, levels[rerolls - 1])
+            if keep != hand:
+                return keep, None, value + after
+        value = self.scores[i][self.space.index[hand]] + after
+        return hand, self.boxes[i].name, value
+
+
+def forced_solver(maxi=False):
+    """
+    Get a Forced Yatzy solver (or None, if it isn't built yet - building it
+    takes a while, so it's left to load_forced_solvers)
+    """
+    return _solvers.get(maxi)
+
+
+def load_forced_solvers():
+    """Build Forced Yatzy and Forced Maxi Yatzy solvers in advance"""
+    for maxi in (False, True):
+        if maxi not in _solvers:
+            _solvers[maxi] = ForcedSolver(maxi)
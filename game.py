@@ -17,7 +17,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import UserString, defaultdict
+import random
+from collections import namedtuple
 from functools import wraps
 from time import time
 
@@ -34,9 +35,41 @@ from const import (
     MIDDLE,
     LAST,
 )
+from advisor import expected_score, solver_state
+from bonus import bonus_chance
 from dice import Dice
 from error import PlayerError
 from scoreboard import Scoreboard
+from tracing import span
+
+
+# A committed turn: hand is a tuple of die values, rerolls is how many
+# rerolls were used (including saved ones), score is points gained
+TurnRecord = namedtuple(
+    'TurnRecord', ['turn', 'player_id', 'hand', 'rerolls', 'box', 'score']
+)
+
+
+def recorded(func):
+    """
+    Decorator to log an operation into game's command log for replays.
+    Operations are logged even if they fail (replay fails them the same
+    way), but not if they're called from another logged operation.
+    """
+
+    @wraps(func)
+    def wrapper(self, player, *args):
+        if self.depth:
+            return func(self, player, *args)
+        self.command_log.append([func.__name__, player.id, *args])
+        self.depth += 1
+        try:
+            with span(f"game.{func.__name__}"):
+                return func(self, player, *args)
+        finally:
+            self.depth -= 1
+
+    return wrapper
 
 
 def is_usable(func):
@@ -75,12 +108,14 @@ def is_reroll_sane(func):
 class Game(object):
     """This class represents a Yatzy/Yahtzee game"""
 
-    def __init__(self, chat, owner, yahtzee=False, forced=False, maxi=False):
+    def __init__(self, chat, owner, yahtzee=False, forced=False, maxi=False,
+                 on_finish=None, seed=None, thread=None):
         if (maxi or forced) and yahtzee:
             raise ValueError(
                 "Error, Maxi and Forced mode is valid only for Yatzy game!"
             )
         self.chat = chat
+        self.thread = thread  # Forum topic, where game is played
         self.owner = owner
         self.players = [owner]
         self.current = 0
@@ -91,12 +126,38 @@ class Game(object):
         self.forced = forced
         self.maxi = maxi
         self.hand = None
-        self.saved_rerolls = defaultdict(int)
+        # Seats of players (their indices in turn order) by user id, and
+        # per-player state indexed by seat (allocated, when game starts)
+        self.seats = {}
+        self.active = []
+        self.saved_rerolls = []
         self.reroll = 0
         self.turn = 1
         self.reroll_pool = []
         self.last_op = time()
-
+        # Per-player luck and skill loss (in points of expected score)
+        self.luck = []
+        self.skill_loss = []
+        self.measured = []  # Whether every turn of a player is measured
+        self.turn_value = None
+        # Moves, which are yet to get their skill loss measured, as (seat,
+        # arguments of advisor.choice_loss) - drained by the bot
+        self.choices = []
+        self.on_finish = on_finish  # Called with a game, when it's completed
+        # Called with old and new state, when game starts or finishes
+        self.on_state = None
+        self.game_id = random.getrandbits(63)
+        self.turn_log = []
+        self.turn_rerolls = 0
+        # All dice are rolled from a seeded generator and all operations are
+        # logged, so the game could be replayed
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.command_log = []
+        self.depth = 0
+        self.creator = owner.id
+
+    @recorded
     def add_player(self, player):
         """Add a new player"""
         if self.started:
@@ -105,9 +166,9 @@ class Game(object):
             )
         if player in self.players:
             raise PlayerError(f"{ERROR} You've already joined.")
-        player.activate(self)
         self.players.append(player)
 
+    @recorded
     def del_player(self, player):
         """Remove a player"""
         if player not in self.players:
@@ -122,12 +183,14 @@ class Game(object):
             )
         self.players.remove(player)
 
+    @recorded
     def leave_started(self, player):
         """Leave a started game"""
         if self.started:
-            if player.is_active(self):
-                self.scoreboard.zero_scoreboard(player)
-                player.deactivate(self)
+            seat = self.seat(player)
+            if self.active[seat]:
+                self.scoreboard.zero_scoreboard(seat)
+                self.active[seat] = False
                 finished = self.scoreboard.is_finished()
                 if not self.has_active_players() or finished:
                     self.stop_game(player, True)
@@ -144,14 +207,22 @@ class Game(object):
 
     def has_active_players(self):
         """Check if active players remain in the game"""
-        for player in self.players:
-            if player.is_active(self):
-                return True
-        return False
+        return any(self.active)
+
+    def seat(self, player):
+        """Get player's seat (index in turn order) in a started game"""
+        seat = self.seats.get(player.id)
+        if seat is None:
+            raise PlayerError(f"{ERROR} You're not in game.")
+        return seat
+
+    def is_active(self, seat):
+        """Check, whether player on this seat hasn't left the game"""
+        return self.active[seat]
 
     def is_current_turn(self, player):
         """Check, whether it's a turn of this player"""
-        if self.players[self.current] == player:
+        if self.players[self.current].id == player.id:
             return True
         return False
 
@@ -171,7 +242,8 @@ class Game(object):
         self.hand = None
         self.reroll_pool = []
         self.reroll = 0
-        if not self.get_current_player().is_active(self):
+        self.turn_rerolls = 0
+        if not self.active[self.current]:
             self.rotate_turn()
 
     def chk_command_usable_any_turn(self, player):
@@ -185,7 +257,7 @@ class Game(object):
                 f"{ERROR} This game is already finished, create a new game "
                 f"(try {START} /start)."
             )
-        if player not in self.players:
+        if player.id not in self.seats:
             raise PlayerError(f"{ERROR} You're not in game.")
 
     def chk_command_usable(self, player):
@@ -194,12 +266,19 @@ class Game(object):
         if not self.is_current_turn(player):
             raise PlayerError(f"{ERROR} It's not your turn.")
 
+    @recorded
     @is_usable
-    def roll(self, _):
+    def roll(self, player):
         """Roll a dice (initial)"""
         if self.hand:
             raise PlayerError(f"{ERROR} You've already rolled a hand.")
-        self.hand = sorted(Dice.roll(5 if not self.maxi else 6))
+        seat = self.current
+        self.turn_value = self.expected_score(seat)
+        if self.turn_value is None:
+            self.discard_metrics(seat)
+        elif self.measured[seat] and self.luck[seat] is None:
+            self.luck[seat] = self.skill_loss[seat] = 0.0
+        self.hand = sorted(Dice.roll(5 if not self.maxi else 6, self.rng))
         self.last_op = time()
         return self.hand
 
@@ -214,8 +293,11 @@ class Game(object):
                 f"{ERROR} Cannot get move list - you didn't roll a hand yet "
                 f"(try {ROLL} /roll)."
             )
-        return self.scoreboard.get_score_options(player, self.hand, perf)
+        return self.scoreboard.get_score_options(
+            self.current, self.hand, perf
+        )
 
+    @recorded
     @is_usable
     def commit_turn(self, player, move):
         """Commit a move and record it in scoreboard"""
@@ -224,16 +306,99 @@ class Game(object):
                 f"{ERROR} Cannot move - you didn't roll a hand yet "
                 f"(try {ROLL} /roll)."
             )
+        seat = self.current
+        self.record_choice(seat, self.get_rerolls_left(player), box=move)
         score = self.scoreboard.commit_dice_combination(
-            player, self.hand, move)
+            seat, self.hand, move)
         # In Maxi Yatzy - we keep saved rerolls
         if self.maxi:
-            self.saved_rerolls[player] += (2 - self.reroll)
+            self.saved_rerolls[seat] += (2 - self.reroll)
+        self.record_turn_metrics(seat)
+        self.turn_log.append(TurnRecord(
+            self.turn, player.id, tuple(int(die) for die in self.hand),
+            self.turn_rerolls, move, score
+        ))
         self.rotate_turn()
         if self.scoreboard.is_finished():
             self.stop_game(player, True)
         return score
 
+    def expected_score(self, seat):
+        """Get player's expected final score before a turn (if it's known)"""
+        return expected_score(
+            self.yahtzee, self.forced, self.maxi,
+            solver_state(self.scoreboard, seat), self.saved_rerolls[seat]
+        )
+
+    def record_turn_metrics(self, seat):
+        """
+        Accumulate luck (change of expected score due to dice, which is
+        adjusted by skill loss, once it's measured) of a turn
+        """
+        if self.luck[seat] is None:
+            return
+        after = self.expected_score(seat)
+        if self.turn_value is None or after is None:
+            self.discard_metrics(seat)
+            return
+        self.luck[seat] += after - self.turn_value
+
+    def record_choice(self, seat, rerolls, keep=None, box=None):
+        """
+        Queue a move (dice to keep on a reroll or a box to score hand in)
+        for its skill loss to be measured (see add_skill_loss)
+        """
+        if self.luck[seat] is None:
+            return
+        self.choices.append((seat, (
+            self.yahtzee, self.forced, self.maxi,
+            solver_state(self.scoreboard, seat),
+            [int(die) for die in self.hand], rerolls,
+            list(self.scoreboard.get_score_options(seat, self.hand)),
+            keep, box
+        )))
+
+    def add_skill_loss(self, seat, loss):
+        """
+        Record skill loss (expected score lost to a worse move, as measured
+        by advisor.choice_loss) of a queued move, or None if it has failed
+        """
+        if self.luck[seat] is None:
+            return
+        if loss is None:
+            self.discard_metrics(seat)
+            return
+        self.skill_loss[seat] += loss
+        self.luck[seat] += loss
+
+    def discard_metrics(self, seat=None):
+        """
+        Leave luck and skill loss of a player (or all players) unmeasured
+        for the rest of a game, as some turn couldn't be measured
+        """
+        seats = range(len(self.measured)) if seat is None else [seat]
+        for i in seats:
+            self.measured[i] = False
+            self.luck[i] = self.skill_loss[i] = None
+        self.choices = [
+            choice for choice in self.choices if choice[0] not in seats
+        ]
+
+    @property
+    def state(self):
+        """Game state name (lobby, live or finished)"""
+        if self.finished:
+            return "finished"
+        return "live" if self.started else "lobby"
+
+    def set_state(self, started, finished):
+        """Change game state"""
+        old = self.state
+        self.started = started
+        self.finished = finished
+        if self.on_state is not None:
+            self.on_state(old, self.state)
+
     def is_completed(self):
         """Check if game is completed gracefully"""
         if self.finished and self.scoreboard.is_finished():
@@ -254,15 +419,22 @@ class Game(object):
 
     def scores_player(self, player):
         """Get player scores"""
-        return self.scoreboard.print_player_scores(player)
+        seat = self.seat(player)
+        return self.scoreboard.print_player_scores(
+            seat, bonus_chance(self.scoreboard, seat)
+        )
 
-    def scores_all(self, _):
-        """Get full scoreboard - unused due to formatting issues"""
-        return self.scoreboard.print_scores()
+    def scores_all(self, _, limit=None):
+        """Get full scoreboard (split into tables of at most limit chars)"""
+        return self.scoreboard.print_scores(limit)
 
     def scores_final(self, _):
-        """Get final scores"""
-        return self.scoreboard.print_final_scores()
+        """Get final scores (with luck and skill loss, if game is over)"""
+        metrics = None
+        if self.is_completed() and \
+                any(luck is not None for luck in self.luck):
+            metrics = list(zip(self.luck, self.skill_loss))
+        return self.scoreboard.print_final_scores(metrics)
 
     @is_usable
     def reroll_precheck(self, _, query):
@@ -287,12 +459,19 @@ class Game(object):
                     f"range 1-{dicecount} to reroll."
                 )
 
-    def reroll_increment(self, player):
+    def get_rerolls_left(self, player):
+        """Get number of rerolls player can still do this turn"""
+        rerolls = 2 - self.reroll
+        if self.maxi:
+            rerolls += self.saved_rerolls[self.seat(player)]
+        return rerolls
+
+    def reroll_increment(self, _):
         """Increase number of rerolls (and check if we can reroll)"""
         if self.reroll >= 2:
             if self.maxi:
-                if self.saved_rerolls[player]:
-                    self.saved_rerolls[player] -= 1
+                if self.saved_rerolls[self.current]:
+                    self.saved_rerolls[self.current] -= 1
                 else:
                     raise PlayerError(
                         f"{ERROR} You cannot reroll more than twice "
@@ -304,30 +483,40 @@ class Game(object):
                 )
         else:
             self.reroll += 1
+        self.turn_rerolls += 1
 
+    @recorded
     @is_reroll_sane
     def reroll_dice(self, player, dice):
         """Reroll dice by positions"""
         self.dice_validate(dice)
         dicemap = map(int, dice)
+        rerolls = self.get_rerolls_left(player)
         self.reroll_increment(player)
+        self.record_choice(self.current, rerolls, keep=tuple(
+            int(die) for i, die in enumerate(self.hand, 1)
+            if str(i) not in dice
+        ))
         for d in dicemap:
-            self.hand[d - 1] = Dice.roll_single()
+            self.hand[d - 1] = Dice.roll_single(self.rng)
         self.hand = sorted(self.hand)
         self.last_op = time()
         return self.hand
 
+    @recorded
     def reroll_pooled(self, player):
         """Reroll pooled dice"""
         self.reroll_dice(player, "".join(self.reroll_pool))
         self.reroll_pool = []
         return self.hand
 
+    @recorded
     @is_usable
     def reroll_pool_clear(self, _):
         """Clear pooled dice"""
         self.reroll_pool = []
 
+    @recorded
     @is_usable
     def reroll_pool_select_all(self, _):
         """Clear pooled dice"""
@@ -335,6 +524,7 @@ class Game(object):
         if self.maxi:
             self.reroll_pool.append('6')
 
+    @recorded
     @is_reroll_sane
     def reroll_pool_toggle(self, _, dice):
         """Toggle dice in reroll pool"""
@@ -347,6 +537,7 @@ class Game(object):
         else:
             self.reroll_pool.append(dice)
 
+    @recorded
     @is_reroll_sane
     def reroll_pool_add(self, _, dice):
         """Add dice to reroll pool"""
@@ -360,6 +551,7 @@ class Game(object):
             )
         self.reroll_pool.append(dice)
 
+    @recorded
     @is_reroll_sane
     def reroll_pool_del(self, _, dice):
         """Remove dice from reroll pool"""
@@ -382,7 +574,7 @@ class Game(object):
         def roll_and_stats(playerlist):
             rolls = []
             for player in playerlist:
-                roll = Dice.roll_single()
+                roll = Dice.roll_single(self.rng)
                 rolls.append(roll)
                 current_message.append(
                     f"{ROLL} {player} rolls {roll.to_emoji()}.\n"
@@ -438,6 +630,7 @@ class Game(object):
         self.players = new_players
         return turn_messages
 
+    @recorded
     def start_game(self, player):
         """Begin game"""
         if self.finished:
@@ -451,20 +644,29 @@ class Game(object):
         if player != self.owner:
             raise PlayerError(f"{ERROR} Only owner can do this!")
         turn_order_msgs = self._decide_turn_order()
+        self.seats = {p.id: seat for seat, p in enumerate(self.players)}
+        self.active = [True] * len(self.players)
+        self.saved_rerolls = [0] * len(self.players)
+        # Luck and skill loss stay None, unless they're measured
+        self.measured = [True] * len(self.players)
+        self.luck = [None] * len(self.players)
+        self.skill_loss = [None] * len(self.players)
         self.scoreboard = Scoreboard(
             self.players, self.yahtzee, self.forced, self.maxi)
-        self.started = True
+        self.set_state(True, False)
         self.last_op = time()
         return turn_order_msgs
 
+    @recorded
     def stop_game(self, player, completed=False):
         """Stop game"""
         if not completed and player != self.owner:
             raise PlayerError(f"{ERROR} Only owner can do this!")
-        self.started = False
-        self.finished = True
+        self.set_state(False, True)
         self.last_op = 0
         self.players = []
+        if completed and self.on_finish is not None:
+            self.on_finish(self)
 
     def kick_player(self, player):
         """Kick current player"""
@@ -516,25 +718,38 @@ class Game(object):
         return 13
 
 
-class Player(UserString):
-    """Class for representing a player"""
+class Player(object):
+    """Class for representing a player (identified by Telegram user id)"""
+
+    __slots__ = ('id', 'name', 'short_name')
 
     def __init__(self, user):
-        self.user = user
         name = [user.first_name]
         if user.last_name:
             name.append(user.last_name)
         if user.username:
             name.append(f"({user.username})")
         self.id = user.id
-        self.active = {}
-        UserString.__init__(self, " ".join(name))
+        self.name = " ".join(name)
+        self.short_name = user.username or user.first_name
+
+    @classmethod
+    def restore(cls, user_id, name, short_name):
+        """Recreate a player from saved id and names"""
+        player = cls.__new__(cls)
+        player.id = user_id
+        player.name = name
+        player.short_name = short_name
+        return player
+
+    def __str__(self):
+        return self.name
 
-    def deactivate(self, game):
-        self.active[game] = False
+    def __repr__(self):
+        return f"Player({self.id}, {self.name!r})"
 
-    def activate(self, game):
-        self.active[game] = True
+    def __eq__(self, other):
+        return isinstance(other, Player) and self.id == other.id
 
-    def is_active(self, game):
-        return self.active.get(game, True)
+    def __hash__(self):
+        return self.id
@@ -17,52 +17,76 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import Counter
+
 from const import ERROR, STOP
 from error import PlayerError
 from game import Game, Player
 
 
 class GameManager(object):
-    """Class for managing games"""
+    """
+    Class for managing games. Games are kept per table - a chat id and a
+    forum topic (thread id, None outside of topics), so each topic of a
+    forum supergroup can host its own game.
+    """
 
-    def __init__(self):
-        self.chats = {}
+    def __init__(self, on_finish=None):
+        self.games = {}
         self.players = {}
+        self.on_finish = on_finish
+        self.states = Counter()  # Number of games by state
+
+    def add(self, table, game):
+        """Put a game on a table (replacing a previous one)"""
+        old = self.games.get(table)
+        if old is not None:
+            old.on_state = None
+            self.states[old.state] -= 1
+        self.games[table] = game
+        game.on_state = self._state_changed
+        self.states[game.state] += 1
+
+    def _state_changed(self, old, new):
+        self.states[old] -= 1
+        self.states[new] += 1
 
-    def new_game(self, chat, owner, yahtzee, forced=False, maxi=False):
-        if self.is_game_running(chat) or self.is_game_not_started(chat):
-            if self.chats[chat.id].owner != self.player(owner):
+    def new_game(self, table, owner, yahtzee, forced=False, maxi=False):
+        if self.is_game_running(table) or self.is_game_not_started(table):
+            if self.games[table].owner != self.player(owner):
                 raise PlayerError(f"{ERROR} Only owner can do that!")
-        if self.is_game_running(chat):
+        if self.is_game_running(table):
             raise PlayerError(
                 f"{ERROR} Cannot start a new game while previous one is "
                 f"in progress (try {STOP} /stop)."
             )
-        self.chats[chat.id] = Game(
-            chat.id, self.player(owner), yahtzee, forced, maxi)
+        chat, thread = table
+        self.add(table, Game(
+            chat, self.player(owner), yahtzee, forced, maxi,
+            self.on_finish, thread=thread))
 
-    def is_game_not_started(self, chat):
-        if chat.id in self.chats and self.chats[chat.id].is_game_not_started():
+    def is_game_not_started(self, table):
+        if table in self.games and self.games[table].is_game_not_started():
             return True
         return False
 
-    def is_game_created(self, chat):
-        if chat.id in self.chats:
+    def is_game_created(self, table):
+        if table in self.games:
             return True
         return False
 
-    def is_game_running(self, chat):
-        if chat.id in self.chats and self.chats[chat.id].is_game_in_progress():
+    def is_game_running(self, table):
+        if table in self.games and self.games[table].is_game_in_progress():
             return True
         return False
 
-    def game(self, chat):
-        return self.chats.get(chat.id, None)
+    def game(self, table):
+        return self.games.get(table, None)
 
     def player(self, user):
         if user.id not in self.players:
             self.players[user.id] = Player(user)
         return self.players[user.id]
 
-    def current_turn(self, chat):
-        return self.chats[chat.id].get_current_player()
+    def current_turn(self, table):
+        return self.games[table].get_current_player()
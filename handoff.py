@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Handoff of live games from a running bot to a new process (on restart).
+
+A running bot listens on a unix socket. New process (started with
+--takeover) connects to it, the old one stops polling, finishes updates in
+flight and sends a snapshot of live games, then exits. Snapshot layout
+(little endian):
+
+    magic       8s   b"YZSNAP\\0\\0"
+    version     H    format version
+    offset      Q    id of the first update, which hasn't been handled
+    length      I    length of payload
+    payload     zlib-compressed JSON - players as [id, name, short name]
+                and games as replay records (seed and command log), so
+                they're rebuilt by replaying them
+"""
+
+import asyncio
+import json
+import logging
+import os
+import struct
+import zlib
+from time import time
+
+from telegram.ext import ApplicationHandlerStop
+
+from const import HANDOFF_SOCKET, HANDOFF_TIMEOUT
+from game import Player
+from replay import game_record, replay
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"YZSNAP\0\0"
+VERSION = 1
+HEADER = struct.Struct('<8sHQI')
+
+
+def snapshot(gamemanager, offset):
+    """Serialise live games of a game manager"""
+    games = []
+    players = {}
+    for game in gamemanager.games.values():
+        if game.finished:
+            continue
+        record = game_record(game)
+        record["last_op"] = game.last_op
+        games.append(record)
+        for user_id, _ in record["players"]:
+            players[user_id] = gamemanager.players[user_id]
+    payload = zlib.compress(json.dumps({
+        "players": [[p.id, p.name, p.short_name] for p in players.values()],
+        "games": games,
+    }).encode())
+    return HEADER.pack(MAGIC, VERSION, offset, len(payload)) + payload
+
+
+def restore(gamemanager, header, payload):
+    """
+    Rebuild games of a snapshot in a game manager, returning the update
+    offset and number of games
+    """
+    magic, version, offset, _ = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Unsupported handoff snapshot")
+    data = json.loads(zlib.decompress(payload))
+    for user_id, name, short_name in data["players"]:
+        gamemanager.players[user_id] = Player.restore(
+            user_id, name, short_name
+        )
+    for record in data["games"]:
+        game = replay(record, gamemanager.players, gamemanager.on_finish)
+        # Replayed turns aren't measured (lookup tables may not be loaded
+        # yet, and skill loss is measured by the bot), so luck and skill
+        # loss of taken over games are left unknown
+        game.discard_metrics()
+        game.last_op = record["last_op"]
+        gamemanager.add((record["chat_id"], record["thread"]), game)
+    return offset, len(data["games"])
+
+
+class Handoff(object):
+    """Hands live games over to a new process, or takes them over"""
+
+    def __init__(self, gamemanager, path=HANDOFF_SOCKET,
+                 timeout=HANDOFF_TIMEOUT):
+        self.gamemanager = gamemanager
+        self.path = path
+        self.timeout = timeout
+        self.takeover = False  # If True - take games over on start
+        self.offset = 0  # Next update to be handled
+        self.server = None
+
+    async def track(self, update, _):
+        """
+        Track update offset, skipping updates, which have been handled by
+        the previous process (to be registered before other handlers)
+        """
+        if update.update_id < self.offset:
+            raise ApplicationHandlerStop
+        self.offset = max(self.offset, update.update_id + 1)
+
+    async def start(self, application):
+        """Take games over (if requested) and wait for a successor"""
+        if self.takeover:
+            await self._take_over()
+        self.server = await asyncio.start_unix_server(
+            lambda reader, writer: self._hand_over(application, writer),
+            self.path
+        )
+
+    def stop(self):
+        """Stop waiting for a successor"""
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    async def _take_over(self):
+        started = time()
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError as e:
+            logger.warning("No running bot to take games over from: %s", e)
+            return
+        try:
+            header = await asyncio.wait_for(
+                reader.readexactly(HEADER.size), self.timeout
+            )
+            payload = await asyncio.wait_for(
+                reader.readexactly(HEADER.unpack(header)[3]), self.timeout
+            )
+        except (OSError, asyncio.IncompleteReadError,
+                asyncio.TimeoutError) as e:
+            logger.error("Failed to take games over: %r", e)
+            return
+        finally:
+            writer.close()
+        self.offset, count = restore(self.gamemanager, header, payload)
+        logger.info("Took over %d game(s) in %.3fs, update offset %s",
+                    count, time() - started, self.offset)
+
+    async def _hand_over(self, application, writer):
+        logger.info("Handing games over to a new process")
+        started = time()
+        self.stop()
+        # Updates, that have been fetched, are confirmed and handled here
+        await application.updater.stop()
+        await application.stop()
+        data = snapshot(self.gamemanager, self.offset)
+        try:
+            writer.write(data)
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except OSError as e:
+            logger.error("Failed to hand games over: %s", e)
+        logger.info("Handed over %d byte(s) in %.3fs",
+                    len(data), time() - started)
+        # Application is stopped already, so stop_running() would do nothing
+        # - stop the event loop, that run_polling runs, for it to shut down
+        asyncio.get_running_loop().stop()
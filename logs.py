@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Non-blocking structured logging.
+
+Records are put into a queue as they are (message arguments are formatted
+only by a listener thread, which writes them out) and can carry structured
+fields, which are appended as key=value pairs:
+
+    logger.info("%s has joined a game", player, extra=kv(chat_id=chat_id))
+
+Records with an event field can be sampled (see LOG_SAMPLE).
+"""
+
+import atexit
+import json
+import logging
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+from const import LOG_FORMAT, LOG_SAMPLE
+
+
+def kv(**fields):
+    """Structured fields for a log record (to be passed as extra)"""
+    return {"fields": fields}
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return f"{value:.3f}"
+    if isinstance(value, str) and (not value or any(
+            c.isspace() or c in '="' for c in value)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Formats a record with its structured fields appended as key=value"""
+
+    def format(self, record):
+        line = logging.Formatter.format(self, record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(
+                f"{key}={format_value(value)}"
+                for key, value in fields.items() if value is not None
+            )
+        return line
+
+
+class Sampler(logging.Filter):
+    """
+    Keeps only 1 in N records of high-volume events (by event field), kept
+    records get a sampled=N field
+    """
+
+    def __init__(self, rates):
+        logging.Filter.__init__(self)
+        self.rates = rates
+        self.counts = Counter()
+
+    def filter(self, record):
+        fields = getattr(record, "fields", None)
+        if not fields or fields.get("event") not in self.rates:
+            return True
+        event = fields["event"]
+        rate = self.rates[event]
+        self.counts[event] += 1
+        if rate > 1:
+            if self.counts[event] % rate != 1:
+                return False
+            fields["sampled"] = rate
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Queue handler, that leaves formatting to a listener thread (records
+    don't leave the process, so they're queued as they are)
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=logging.INFO, sample=LOG_SAMPLE):
+    """
+    Route all logging through a queue, so that writing out records never
+    blocks the caller (e.g. the event loop). Listener is stopped at exit.
+    """
+    root = logging.getLogger()
+    if any(isinstance(h, LazyQueueHandler) for h in root.handlers):
+        return  # Already set up (e.g. module has been imported twice)
+    handler = logging.StreamHandler()
+    handler.setFormatter(KeyValueFormatter(LOG_FORMAT))
+    queue = SimpleQueue()
+    listener = QueueListener(queue, handler, respect_handler_level=True)
+    queue_handler = LazyQueueHandler(queue)
+    queue_handler.addFilter(Sampler(sample))
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
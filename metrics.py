@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cheap runtime counters of a running bot (for /botstats)"""
+
+import logging
+import os
+import sys
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import timedelta
+from importlib.util import find_spec
+from time import perf_counter
+
+import httpx
+from telegram.error import RetryAfter, TimedOut
+from telegram.ext import AIORateLimiter
+from telegram.request import HTTPXRequest
+
+from const import (
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_POOL_TIMEOUT,
+    HTTP_VERSION,
+)
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket bounds (in seconds), growing 2^(1/4) times from 1ms
+BOUNDS = [0.001 * 2 ** (i / 4) for i in range(64)]
+
+
+class Histogram(object):
+    """Fixed-bucket histogram of durations, with approximate percentiles"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        """Get an upper bound of q-th quantile (0 < q <= 1)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and i < len(BOUNDS):
+                return min(BOUNDS[i], self.max)
+        return self.max
+
+    def summary(self):
+        """Human-readable summary (count, mean and percentiles in ms)"""
+        if not self.count:
+            return "no data"
+        p50, p90, p99 = (self.percentile(q) * 1000 for q in (.5, .9, .99))
+        mean = self.total / self.count * 1000
+        return (f"n={self.count}, mean {mean:.0f}ms, p50 {p50:.0f}ms, "
+                f"p90 {p90:.0f}ms, p99 {p99:.0f}ms, "
+                f"max {self.max * 1000:.0f}ms")
+
+
+class TimedRateLimiter(AIORateLimiter):
+    """Rate limiter, which keeps a histogram of time requests have waited"""
+
+    def __init__(self, **kwargs):
+        AIORateLimiter.__init__(self, **kwargs)
+        self.waits = Histogram()
+
+    async def acquire(self, data):
+        """Wait for any extra limits, before a request is sent"""
+
+    def retry_after(self, delay):
+        """Called, when Telegram asks to retry in delay seconds"""
+
+    async def process_request(self, callback, args, kwargs, endpoint, data,
+                              rate_limit_args):
+        queued = perf_counter()
+
+        async def request(*args, **kwargs):
+            await self.acquire(data)
+            wait = perf_counter() - queued
+            self.waits.observe(wait)
+            http.set(wait=wait)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                self.retry_after(delay)
+                raise
+
+        with span("http", endpoint=endpoint) as http:
+            return await AIORateLimiter.process_request(
+                self, request, args, kwargs, endpoint, data, rate_limit_args
+            )
+
+
+class RequestStats(object):
+    """Bot API request latencies (by endpoint) and waits for connections"""
+
+    def __init__(self):
+        self.latency = defaultdict(Histogram)  # By endpoint
+        self.pool_waits = defaultdict(Histogram)  # By connection pool
+        self.pool_timeouts = Counter()  # By connection pool
+
+
+def is_pool_timeout(error):
+    """Check, whether a request has failed as all connections were busy"""
+    return isinstance(error, TimedOut) and isinstance(
+        error.__cause__, httpx.PoolTimeout
+    )
+
+
+class MeteredRequest(HTTPXRequest):
+    """
+    Bot API HTTP client, which records request latency by endpoint and time
+    requests have waited for a free connection of its pool
+    """
+
+    def __init__(self, stats, pool, **kwargs):
+        self.stats = stats
+        self.pool = pool  # Name of connection pool
+        httpx_kwargs = kwargs.pop("httpx_kwargs", {})
+        httpx_kwargs["event_hooks"] = {"request": [self._trace_pool_wait]}
+        HTTPXRequest.__init__(self, httpx_kwargs=httpx_kwargs, **kwargs)
+
+    async def _trace_pool_wait(self, request):
+        queued = perf_counter()
+        waits = self.stats.pool_waits[self.pool]
+        waiting = True
+
+        async def trace(*_):
+            # First event of a request comes, when it has got a connection
+            nonlocal waiting
+            if waiting:
+                waiting = False
+                waits.observe(perf_counter() - queued)
+
+        request.extensions["trace"] = trace
+
+    async def do_request(self, url, *args, **kwargs):
+        started = perf_counter()
+        try:
+            return await HTTPXRequest.do_request(self, url, *args, **kwargs)
+        except TimedOut as e:
+            if is_pool_timeout(e):
+                self.stats.pool_timeouts[self.pool] += 1
+            raise
+        finally:
+            self.stats.latency[url.rsplit("/", 1)[-1]].observe(
+                perf_counter() - started
+            )
+
+
+def bot_request(stats, pool, size):
+    """Bot API HTTP client with a pool of size connections"""
+    http_version = HTTP_VERSION
+    if http_version != "1.1" and find_spec("h2") is None:
+        logger.warning("HTTP/2 needs httpx[http2], using HTTP/1.1")
+        http_version = "1.1"
+    return MeteredRequest(
+        stats, pool,
+        connection_pool_size=size,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        http_version=http_version,
+        httpx_kwargs={"limits": httpx.Limits(
+            max_connections=size,
+            max_keepalive_connections=size,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )},
+    )
+
+
+class BotMetrics(object):
+    """Counters, which are updated as updates are handled"""
+
+    def __init__(self):
+        self.application = None  # Set, when bot starts
+        self.latency = Histogram()
+        self.in_flight = 0
+        self.http = RequestStats()
+
+    def queue_depth(self):
+        """Number of fetched updates, which wait to be handled"""
+        if self.application is None:
+            return 0
+        return self.application.update_queue.qsize()
+
+    def rate_limiter_waits(self):
+        """Histogram of rate limiter waits (or None, if it's not timed)"""
+        if self.application is None:
+            return None
+        limiter = self.application.bot.rate_limiter
+        return getattr(limiter, "waits", None)
+
+
+def rss():
+    """Current resident set size of the process (in bytes)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # Peak RSS (in kilobytes on Linux, in bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def is_tracing():
+    """Check, whether memory allocations are traced"""
+    tracemalloc = sys.modules.get("tracemalloc")
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def stop_tracing():
+    """Stop tracing memory allocations (if they're traced)"""
+    if is_tracing():
+        sys.modules["tracemalloc"].stop()
+
+
+def import_times(module, limit=20):
+    """
+    Measure import time of a module (in a fresh interpreter), getting top
+    modules by cumulative time as (name, self, cumulative) tuples (in ms)
+    """
+    import subprocess
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        if own.strip().isdigit():
+            times.append((name.strip(), int(own) / 1000,
+                          int(cumulative) / 1000))
+    times.sort(key=lambda t: t[2], reverse=True)
+    return times[:limit]
+
+
+def top_allocators(limit=10):
+    """
+    Get top memory allocators (by source line), as (location, size, count)
+    tuples, starting tracing first, if it's not running (returns None then)
+    """
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        return None
+    stats = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    )).statistics("lineno")
+    return [
+        (f"{os.path.basename(stat.traceback[0].filename)}:"
+         f"{stat.traceback[0].lineno}", stat.size, stat.count)
+        for stat in stats[:limit]
+    ]
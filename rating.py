@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import logging
+import sqlite3
+from itertools import groupby
+from operator import itemgetter
+
+from const import STATS_DB, RATING_INITIAL, RATING_K
+
+logger = logging.getLogger(__name__)
+
+SELECT_RATINGS = """
+SELECT user_id, rating, games FROM ratings
+WHERE variant = ? AND user_id IN ({})
+"""
+
+UPSERT_RATING = """
+INSERT INTO ratings VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id, variant) DO UPDATE SET
+    rating = excluded.rating,
+    games = excluded.games
+"""
+
+# Game history in order it has been played
+SELECT_HISTORY = """
+SELECT games.game_id, games.variant, results.user_id, results.score,
+       results.has_left
+FROM games JOIN results USING (game_id)
+ORDER BY games.game_id
+"""
+
+
+def expected_score(rating, opponent):
+    """Elo expected score (win probability) against an opponent"""
+    return 1 / (1 + 10 ** ((opponent - rating) / 400))
+
+
+def outcome(result, other):
+    """
+    Pairwise outcome (1 - win, 0.5 - tie, 0 - loss) of two players' results
+    as (score, has_left). Players, who have left, place below everyone else.
+    """
+    mine = (not result[1], result[0])
+    theirs = (not other[1], other[0])
+    if mine == theirs:
+        return 0.5
+    return 1.0 if mine > theirs else 0.0
+
+
+def rate_game(ratings, results, k=RATING_K):
+    """
+    Get new ratings of a multiplayer game participants. Game is treated as a
+    round of pairwise matches, each weighted by 1 / (players - 1). Ratings
+    are (rating, games) by user, results are (score, has_left) by user.
+    """
+    if len(results) < 2:
+        return {}
+    weight = k / (len(results) - 1)
+    rated = {}
+    for user, result in results.items():
+        rating, games = ratings.get(user, (RATING_INITIAL, 0))
+        delta = 0.0
+        for other, other_result in results.items():
+            if other == user:
+                continue
+            opponent = ratings.get(other, (RATING_INITIAL, 0))[0]
+            delta += (outcome(result, other_result)
+                      - expected_score(rating, opponent))
+        rated[user] = (rating + weight * delta, games + 1)
+    return rated
+
+
+def update_ratings(conn, variant, results):
+    """Update ratings of a finished game's players in a database"""
+    users = list(results)
+    ratings = {
+        user: (rating, games) for user, rating, games in conn.execute(
+            SELECT_RATINGS.format(", ".join("?" * len(users))),
+            [variant] + users
+        )
+    }
+    for user, (rating, games) in rate_game(ratings, results).items():
+        conn.execute(UPSERT_RATING, (user, variant, rating, games))
+
+
+def rerate(conn):
+    """
+    Recompute all ratings from scratch, streaming game history from a
+    database - only ratings themselves are kept in memory
+    """
+    ratings = {}
+    count = 0
+    for (_, variant), rows in groupby(
+            conn.execute(SELECT_HISTORY), key=itemgetter(0, 1)):
+        results = {user: (score, bool(left)) for _, _, user, score, left
+                   in rows}
+        variant_ratings = ratings.setdefault(variant, {})
+        variant_ratings.update(rate_game(variant_ratings, results))
+        count += 1
+    with conn:
+        conn.execute("DELETE FROM ratings")
+        for variant, variant_ratings in ratings.items():
+            conn.executemany(UPSERT_RATING, (
+                (user, variant, rating, games)
+                for user, (rating, games) in variant_ratings.items()
+            ))
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute player ratings from game history."
+    )
+    parser.add_argument("--db", default=STATS_DB, help="statistics database")
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO)
+    conn = sqlite3.connect(args.db)
+    count = rerate(conn)
+    conn.close()
+    logger.info("Re-rated %d game(s)", count)
+
+
+if __name__ == '__main__':
+    main()
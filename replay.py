@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Archive of finished games (dice seed and command log) and their replays.
+
+Archive is a set of gzipped JSON lines files, partitioned by date like the
+turn export (REPLAY_DIR/date=YYYY-MM-DD/part-*.jsonl.gz).
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+from collections import namedtuple
+from multiprocessing import Pool
+from time import time, time_ns
+
+from const import REPLAY_DIR
+from error import IllegalMoveError, InvalidDiceError, PlayerError
+from export import BatchWriter, partition
+from game import Game, Player
+
+logger = logging.getLogger(__name__)
+
+# Stand-in for a Telegram user, when a game is replayed
+ReplayUser = namedtuple(
+    'ReplayUser', ['id', 'first_name', 'last_name', 'username']
+)
+
+
+def game_record(game, finished_at=None):
+    """Get an archive record of a game (finished or not)"""
+    scores = {}
+    if game.scoreboard is not None:
+        scores = game.scoreboard.final_scores()
+    names = {player.id: str(player) for player in scores}
+    users = [game.creator]
+    for _, user_id, *_ in game.command_log:
+        if user_id not in users:
+            users.append(user_id)
+    return {
+        "game_id": game.game_id,
+        "finished_at": int(time()) if finished_at is None else finished_at,
+        "chat_id": game.chat,
+        "thread": game.thread,
+        "variant": [game.yahtzee, game.forced, game.maxi],
+        "seed": game.seed,
+        "owner": game.creator,
+        "players": [[user_id, names.get(user_id, "")] for user_id in users],
+        "commands": game.command_log,
+        "scores": [[player.id, score] for player, score in scores.items()],
+    }
+
+
+def replay(record, players=None, on_finish=None):
+    """
+    Re-execute a recorded game headlessly (with given players by user id,
+    if they're known), returning it
+    """
+    if players is None:
+        players = {
+            user_id: Player(ReplayUser(user_id, name, None, None))
+            for user_id, name in record["players"]
+        }
+    owner = players[record["owner"]]
+    game = Game(record["chat_id"], owner, *record["variant"],
+                on_finish=on_finish, seed=record["seed"],
+                thread=record.get("thread"))
+    game.game_id = record["game_id"]
+    for name, user_id, *args in record["commands"]:
+        try:
+            getattr(game, name)(players[user_id], *args)
+        except (PlayerError, IllegalMoveError, InvalidDiceError):
+            pass  # It has failed the same way, when it was recorded
+    return game
+
+
+def verify(record):
+    """Replay a game and check its scores, returning (game id, match)"""
+    game = replay(record)
+    scores = [
+        [player.id, score]
+        for player, score in game.scoreboard.final_scores().items()
+    ]
+    return record["game_id"], scores == record["scores"]
+
+
+class ReplayArchive(BatchWriter):
+    """Archives finished games in batches from a background task"""
+
+    def __init__(self, root=REPLAY_DIR, **kwargs):
+        BatchWriter.__init__(self, **kwargs)
+        self.root = root
+
+    def record(self, game):
+        """Queue a finished game (to be used as on_finish hook)"""
+        if game.command_log:
+            self.put(game_record(game))
+
+    def _write(self, records):
+        partitions = {}
+        for record in records:
+            partitions.setdefault(
+                partition(record["finished_at"]), []
+            ).append(record)
+        for name, part in partitions.items():
+            directory = os.path.join(self.root, name)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(
+                directory, f"part-{time_ns()}-{os.getpid()}.jsonl.gz"
+            )
+            with gzip.open(f"{path}.tmp", "wt") as f:
+                for record in part:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(f"{path}.tmp", path)
+        logger.info("Archived %d game(s)", len(records))
+
+
+def iter_records(root=REPLAY_DIR, since=None, until=None):
+    """Stream game records from an archive"""
+    if not os.path.isdir(root):
+        return
+    for directory in sorted(os.listdir(root)):
+        date = directory.partition("=")[2]
+        if since and date < since or until and date > until:
+            continue
+        for name in sorted(os.listdir(os.path.join(root, directory))):
+            if name.endswith(".jsonl.gz"):
+                with gzip.open(os.path.join(root, directory, name), "rt") as f:
+                    for line in f:
+                        yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay archived games and verify their scores."
+    )
+    parser.add_argument("--root", default=REPLAY_DIR)
+    parser.add_argument("--since", help="first date (YYYY-MM-DD)")
+    parser.add_argument("--until", help="last date (YYYY-MM-DD)")
+    parser.add_argument("--game", type=int, help="show turns of a single game")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: number of CPU cores)"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO)
+    records = iter_records(args.root, args.since, args.until)
+    if args.game is not None:
+        for record in records:
+            if record["game_id"] == args.game:
+                game = replay(record)
+                for turn in game.turn_log:
+                    print(f"Turn {turn.turn}: {turn.player_id} rolled "
+                          f"{''.join(map(str, turn.hand))} with "
+                          f"{turn.rerolls} reroll(s), scored {turn.score} "
+                          f"in {turn.box}")
+                print(game.scores_final(None))
+                return
+        logger.error("Game %s is not found", args.game)
+        return
+    started = time()
+    count = 0
+    mismatches = 0
+    with Pool(args.jobs) as pool:
+        for game_id, match in pool.imap_unordered(
+                verify, records, chunksize=64):
+            count += 1
+            if not match:
+                mismatches += 1
+                logger.error("Game %s scores don't match", game_id)
+    elapsed = time() - started
+    logger.info("Replayed %d game(s) in %.1fs (%.0f games/s), "
+                "%d mismatch(es)", count, elapsed,
+                count / max(elapsed, 1e-9), mismatches)
+
+
+if __name__ == '__main__':
+    main()
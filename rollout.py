@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from math import sqrt
+from random import Random
+from time import time
+
+from const import (
+    ADVICE_BATCH,
+    ADVICE_BUDGET,
+    ADVICE_CANDIDATES,
+    ADVICE_CONFIDENCE,
+    ADVICE_EV_MARGIN,
+    ROLLOUT_BATCH,
+    ROLLOUT_BUDGET,
+    ROLLOUT_CACHE_SIZE,
+    ROLLOUT_SAMPLES,
+    VARIANTS,
+)
+from error import ComputeError
+from scoreboard import Scoreboard
+from solver import hand_space
+
+_models = {}
+
+
+class RolloutModel(object):
+    """
+    A fast fixed strategy for simulating the remaining game of a player:
+    chase an open box with the best value of the hand over that box's
+    reservation value (its expected score in a single turn), keeping dice,
+    which are best for that box alone, then score hand in a box with the
+    best surplus over its reservation value. Upper section scores are
+    weighted up by a share of the bonus, while it's still achievable.
+    """
+
+    def __init__(self, yahtzee=False, forced=False, maxi=False):
+        self.yahtzee = yahtzee
+        self.forced = forced
+        self.maxi = maxi
+        self.ndice = 6 if maxi else 5
+        space = hand_space(self.ndice)
+        self.index = space.index
+        self.keeps = space.keeps
+        scoreboard = Scoreboard([None], yahtzee, forced, maxi)
+        self.names = [
+            box.name for box in scoreboard.scores[0].values() if box.rule
+        ]
+        boxes = [scoreboard.scores[0][name] for name in self.names]
+        self.target = scoreboard.get_upper_section_bonus_score()
+        self.bonus = scoreboard.get_upper_section_bonus_value()
+        self.scores = [space.score(box) for box in boxes]
+        # surplus[b][r][h] - value of hand h for box b with r rerolls left
+        # over box reservation value, keep[b][r][h] - the best dice to keep
+        self.surplus = []
+        self.keep = []
+        for i, scores in enumerate(self.scores):
+            if i < 6:
+                weight = 1 + self.bonus / self.target
+                scores = [score * weight for score in scores]
+            levels = space.turn_levels(scores, 2)
+            reserve = space.expected(levels[2])
+            self.surplus.append([
+                [value - reserve for value in level] for level in levels
+            ])
+            keeps = [None]
+            for rerolls in (1, 2):
+                keep_values = space.keep_values(levels[rerolls - 1])
+                keeps.append([
+                    max(hand_keeps, key=keep_values.__getitem__)
+                    for hand_keeps in space.hand_keeps
+                ])
+            self.keep.append(keeps)
+        self.yatzy = [len(set(hand)) == 1 for hand in space.hands]
+
+    def best_box(self, hand, open_boxes, rerolls=0):
+        """Find an open box with the best surplus for a hand"""
+        if self.forced:
+            return open_boxes[0]
+        surplus = self.surplus
+        best = open_boxes[0]
+        for box in open_boxes:
+            if surplus[box][rerolls][hand] > surplus[best][rerolls][hand]:
+                best = box
+        return best
+
+    def roll(self, rng, keep=()):
+        """Roll dice, which are not kept, returning a sorted hand"""
+        randint = rng.randint
+        return tuple(sorted(keep + tuple(
+            randint(1, 6) for _ in range(self.ndice - len(keep))
+        )))
+
+    def turn(self, rng, state, hand, rerolls):
+        """Play a turn from hand, returning final hand index and rerolls"""
+        open_boxes = state[0]
+        while rerolls:
+            index = self.index[hand]
+            level = min(rerolls, 2)
+            box = self.best_box(index, open_boxes, level)
+            keep = self.keeps[self.keep[box][level][index]]
+            if len(keep) == self.ndice:
+                break
+            hand = self.roll(rng, keep)
+            rerolls -= 1
+        return self.index[hand], rerolls
+
+    def commit(self, state, index, box, rerolls=0):
+        """Score a hand in a box, returning new state and points gained"""
+        open_boxes, upper_sum, saved, yahtzee_scored = state
+        score = self.scores[box][index]
+        points = score
+        if self.yahtzee and yahtzee_scored and self.yatzy[index]:
+            points += 100  # Yahtzee Bonus
+        if self.names[box] == "Yahtzee" and score:
+            yahtzee_scored = True
+        if box < 6:
+            if upper_sum < self.target <= upper_sum + score:
+                points += self.bonus
+            upper_sum += score
+        if self.maxi:
+            saved = rerolls
+        open_boxes = tuple(b for b in open_boxes if b != box)
+        return (open_boxes, upper_sum, saved, yahtzee_scored), points
+
+    def play(self, rng, state, hand=None, rerolls=None):
+        """
+        Simulate the remaining game of a player (optionally, starting in the
+        middle of a turn), returning points gained
+        """
+        points = 0
+        while state[0]:
+            if hand is None:
+                hand = self.roll(rng)
+                rerolls = 2 + state[2]
+            index, rerolls = self.turn(rng, state, hand, rerolls)
+            box = self.best_box(index, state[0])
+            state, gained = self.commit(state, index, box, rerolls)
+            points += gained
+            hand = None
+        return points
+
+
+def rollout_model(yahtzee=False, forced=False, maxi=False):
+    """Get (building it, if necessary) a rollout model for a game variant"""
+    variant = (yahtzee, forced, maxi)
+    if variant not in _models:
+        _models[variant] = RolloutModel(*variant)
+    return _models[variant]
+
+
+def load_rollout_models():
+    """Build rollout models for all game variants in advance"""
+    for variant in VARIANTS:
+        rollout_model(*variant)
+
+
+def simulate(variant, state, samples=ROLLOUT_SAMPLES, budget=ROLLOUT_BUDGET):
+    """
+    Simulate the remaining game of a player in batches, until there are
+    enough samples or time budget is exhausted. Returns points gained.
+    """
+    model = rollout_model(*variant)
+    rng = Random()
+    deadline = time() + budget
+    results = []
+    while len(results) < samples and time() < deadline:
+        for _ in range(min(ROLLOUT_BATCH, samples - len(results))):
+            results.append(model.play(rng, state))
+    return results
+
+
+def win_chance(rivals, points):
+    """Chance to beat the best rival (ties are split), gaining points"""
+    below = bisect_left(rivals, points)
+    tied = bisect_right(rivals, points) - below
+    return (below + tied / 2) / len(rivals)
+
+
+def advise_to_win(variant, state, hand, rerolls, rivals, values=None,
+                  allowed=None, budget=ADVICE_BUDGET):
+    """
+    Find dice to keep (or a box to score hand in right now), which maximise
+    chance to win, given points the best rival gains over player's total.
+    Candidates are scoring in each allowed box and the best keeps for each
+    open box, pruned by expected final score (values are box and keep
+    values from advisor.option_values, if there's a solver) - they're
+    raced against each other in batches of rollouts with common dice, half
+    of them being dropped after each round, while time budget lasts. The
+    best EV candidate (or rollout strategy's own choice) is only overruled,
+    if some other one wins more often by a margin beyond sampling error.
+    Returns dice to keep, a box name (or None) and a chance to win (None,
+    if there was no time for any rollouts).
+    """
+    model = rollout_model(*variant)
+    rivals = sorted(rivals)
+    hand = tuple(sorted(hand))
+    index = model.index[hand]
+    level = min(rerolls, 2)
+    boxes = state[0][:1] if model.forced else state[0]
+    if allowed is not None:
+        boxes = [box for box in boxes if model.names[box] in allowed] or \
+            boxes
+    candidates = [(hand, box) for box in boxes]
+    if rerolls:
+        for box in boxes:
+            keep = model.keeps[model.keep[box][level][index]]
+            if len(keep) != len(hand) and (keep, None) not in candidates:
+                candidates.append((keep, None))
+    if values is not None:
+        box_values, keep_values = values
+        ev = {(hand, box): box_values.get(model.names[box]) for box in boxes}
+        keep_values = {
+            keep: value for keep, value in keep_values.items()
+            if len(keep) != len(hand)
+        }
+        if keep_values:
+            keep = max(keep_values, key=keep_values.get)
+            if (keep, None) not in candidates:
+                candidates.append((keep, None))
+        for keep, box in candidates:
+            if box is None:
+                ev[(keep, None)] = keep_values.get(keep)
+        candidates = sorted(
+            [c for c in candidates if ev[c] is not None],
+            key=ev.get, reverse=True
+        ) or candidates
+        best = ev[candidates[0]]
+        candidates = [
+            c for c in candidates[:ADVICE_CANDIDATES]
+            if best - ev[c] <= ADVICE_EV_MARGIN
+        ]
+    else:
+        # Fall back on the rollout strategy's own choice
+        box = model.best_box(index, boxes, level)
+        keep = model.keeps[model.keep[box][level][index]]
+        if not rerolls or len(keep) == len(hand):
+            keep, box = hand, model.best_box(index, boxes)
+        else:
+            box = None
+        candidates.remove((keep, box))
+        candidates.insert(0, (keep, box))
+    fallback = candidates[0]
+    # Sums of win chances, their squares and points, and rollout count
+    stats = {c: [0.0, 0.0, 0.0, 0] for c in candidates}
+    deadline = time() + budget
+    seed = Random()
+    while time() < deadline:
+        batch = seed.random()
+        for (keep, box) in candidates:
+            if time() >= deadline:
+                break
+            totals = stats[(keep, box)]
+            rng = Random(batch)  # Common dice for all candidates
+            for _ in range(ADVICE_BATCH):
+                if box is None:
+                    points = model.play(
+                        rng, state, model.roll(rng, keep), rerolls - 1
+                    )
+                else:
+                    after, points = model.commit(state, index, box, rerolls)
+                    points += model.play(rng, after)
+                chance = win_chance(rivals, points)
+                totals[0] += chance
+                totals[1] += chance * chance
+                totals[2] += points
+                totals[3] += 1
+        else:
+            if len(candidates) > 2:
+                ranked = sorted(
+                    candidates, key=lambda c: _mean(stats[c]), reverse=True
+                )
+                ranked = ranked[:max(len(ranked) // 2, 2)]
+                if fallback not in ranked:
+                    ranked.append(fallback)
+                candidates = ranked
+            elif len(candidates) == 1:
+                break  # Nothing to race against
+    sampled = [c for c in stats if stats[c][3]]
+    choice = fallback
+    if sampled and stats[fallback][3]:
+        best = max(sampled, key=lambda c: _mean(stats[c]))
+        margin = ADVICE_CONFIDENCE * sqrt(
+            _variance(stats[best]) + _variance(stats[fallback])
+        )
+        if _mean(stats[best]) - _mean(stats[fallback]) > margin:
+            choice = best
+    keep, box = choice
+    chance = _mean(stats[choice]) if stats[choice][3] else None
+    return keep, None if box is None else model.names[box], chance
+
+
+def _mean(totals):
+    return totals[0] / totals[3] if totals[3] else 0.0
+
+
+def _variance(totals):
+    """Squared standard error of mean win chance"""
+    if totals[3] < 2:
+        return 0.0
+    mean = totals[0] / totals[3]
+    return max(totals[1] / totals[3] - mean * mean, 0.0) / totals[3]
+
+
+def rollout_state(game, seat):
+    """
+    Get a player's (by seat) state for rollouts (open boxes, upper section
+    sum, saved rerolls and whether Yahtzee was scored), that is hashable to
+    be cached, and player's total score
+    """
+    scores = game.scoreboard.scores[seat]
+    boxes = [box for box in scores.values() if box.rule]
+    yahtzee_scored = bool(game.yahtzee and scores["Yahtzee"].score)
+    state = (
+        tuple(i for i, box in enumerate(boxes) if box.score is None),
+        scores["Up. Sect. Total"].score,
+        game.saved_rerolls[seat] if game.maxi else 0,
+        yahtzee_scored
+    )
+    return state, scores["Grand Total"].score
+
+
+class WinOdds(object):
+    """
+    Estimates players' chances to win. Rollouts are cached per player state
+    (which doesn't include total score, so states repeat across games), and
+    after a turn only the player, who has moved, gets new rollouts. As a
+    rollout of a state may be awaited on behalf of several keys (e.g.
+    tables), it's only cancelled, once none of them waits for it.
+    """
+
+    def __init__(self, compute, cache_size=ROLLOUT_CACHE_SIZE):
+        self.compute = compute
+        self.cache_size = cache_size
+        self.samples = OrderedDict()
+        self.tasks = {}  # Running rollouts by state
+        self.waiters = {}  # Keys, which wait for rollouts of a state
+
+    def _states(self, game):
+        variant = (game.yahtzee, game.forced, game.maxi)
+        states = {}
+        for seat in range(len(game.scoreboard.players)):
+            state, total = rollout_state(game, seat)
+            states[seat] = ((variant, state), total)
+        return states
+
+    async def _rollout(self, state):
+        task = asyncio.current_task()
+        try:
+            samples = await self.compute.run(
+                ("rollout", state), simulate, *state
+            )
+        except ComputeError:
+            return
+        finally:
+            if self.tasks.get(state) is task:
+                del self.tasks[state]
+                del self.waiters[state]
+        self.samples[state] = samples
+        while len(self.samples) > self.cache_size:
+            self.samples.popitem(last=False)
+
+    def schedule(self, key, game):
+        """
+        Start rollouts in background for player states, which have no
+        samples yet (e.g. right after a turn) on behalf of a key, returning
+        their tasks
+        """
+        tasks = []
+        for state, _ in self._states(game).values():
+            if not state[1][0]:
+                continue  # Nothing to simulate, the scoreboard is filled
+            if state in self.samples:
+                self.samples.move_to_end(state)
+                continue
+            if state not in self.tasks:
+                self.tasks[state] = asyncio.ensure_future(
+                    self._rollout(state)
+                )
+                self.waiters[state] = set()
+            self.waiters[state].add(key)
+            tasks.append(self.tasks[state])
+        return tasks
+
+    def cancel(self, key):
+        """
+        Stop waiting for rollouts on behalf of a key, cancelling the ones,
+        which no other key waits for
+        """
+        for state, keys in list(self.waiters.items()):
+            keys.discard(key)
+            if not keys:
+                del self.tasks[state]
+                del self.waiters[state]
+                self.compute.cancel(("rollout", state))
+
+    async def refresh(self, key, game):
+        """Wait until all players of a game have their rollouts"""
+        await asyncio.gather(*self.schedule(key, game))
+
+    def finals(self, game):
+        """
+        Get samples of each player's final score by seat (or None, if some
+        player has no rollouts yet)
+        """
+        finals = {}
+        for seat, (state, total) in self._states(game).items():
+            if not state[1][0]:
+                finals[seat] = [total]
+            elif state in self.samples:
+                finals[seat] = [total + p for p in self.samples[state]]
+            else:
+                return None
+        return finals
+
+    @staticmethod
+    def _pairs(finals):
+        """
+        Pair samples of all players. Players in the same state share
+        samples, so they're paired shifted.
+        """
+        count = max(len(scores) for scores in finals.values())
+        for i in range(count):
+            yield {
+                seat: scores[(i + seat * 997) % len(scores)]
+                for seat, scores in finals.items()
+            }
+
+    def rivals(self, game, seat):
+        """
+        Get samples of points the best rival gains over current total of a
+        player (by seat), or None, if some player has no rollouts yet
+        """
+        finals = self.finals(game)
+        if finals is None or len(finals) < 2:
+            return None
+        del finals[seat]
+        total = rollout_state(game, seat)[1]
+        return [max(pair.values()) - total for pair in self._pairs(finals)]
+
+    def estimate(self, game):
+        """
+        Get each player's chance to win and projected final score by seat
+        (or None, if some player has no rollouts yet)
+        """
+        finals = self.finals(game)
+        if finals is None:
+            return None
+        wins = dict.fromkeys(finals, 0.0)
+        count = 0
+        for pair in self._pairs(finals):
+            best = max(pair.values())
+            winners = [s for s, score in pair.items() if score == best]
+            for seat in winners:
+                wins[seat] += 1 / len(winners)
+            count += 1
+        return OrderedDict(
+            sorted(
+                (
+                    (seat, (wins[seat] / count,
+                            sum(finals[seat]) / len(finals[seat])))
+                    for seat in finals
+                ),
+                reverse=True, key=lambda x: x[1]
+            )
+        )
@@ -19,10 +19,9 @@
 
 from collections import Counter, OrderedDict
 
-from tabulate import tabulate
-
-from const import POSITIONS, LOLLIPOP, ERROR, SUFFIX
+from const import POSITIONS, LOLLIPOP, ERROR, SUFFIX, LUCK, SKILL
 from error import IllegalMoveError
+from tracing import traced
 
 
 def count_dice(dice):
@@ -43,14 +42,15 @@ class Scoreboard(object):
         if (maxi or forced) and yahtzee:
             raise ValueError(
                 "Error, Maxi and Forced mode is valid only for Yatzy game!")
-        self.players = players  # List of players
+        self.players = players  # List of players, indexed by seat
         # If True - we play Yahtzee (strict commercial rules)
         self.yahtzee = yahtzee
         self.forced = forced  # If True - play Forced Yahtzee variant
         self.maxi = maxi  # If True - play Maxi Yahtzee variant
-        self.scores = {}
+        self.scores = []  # Boxes of each player, indexed by seat
+        self._scores_cache = None
         ndice = 6 if self.maxi else 5
-        for player in self.players:
+        for _ in self.players:
             boxes = [
                 Box(
                     "Aces" if yahtzee else "Ones", 1 * ndice,
@@ -175,19 +175,19 @@ class Scoreboard(object):
                 boxes.append(Box("Yahtzee Bonus", 0, None, None, 0))
             boxes.append(Box("Low. Sect. Total", 0, None, None, 0))
             boxes.append(Box("Grand Total", 0, None, None, 0))
-            self.scores[player] = OrderedDict(
-                [(box.name, box) for box in boxes])
+            self.scores.append(OrderedDict(
+                [(box.name, box) for box in boxes]))
 
-    def award_yahtzee_bonus(self, player, dice):
+    def award_yahtzee_bonus(self, seat, dice):
         """Check if Yahtzee Bonus is to be awarded and give it"""
         # Yahtzee Bonus
         if self.yahtzee:
             # If we have already scored a Yahtzee
-            if self.scores[player].get("Yahtzee").score:
+            if self.scores[seat].get("Yahtzee").score:
                 # And if we're scored another valid Yahtzee
-                if self.scores[player]["Yahtzee"].preview_dice(dice):
+                if self.scores[seat]["Yahtzee"].preview_dice(dice):
                     # Add 100 extra points to Yahtzee Bonus
-                    self.scores[player]["Yahtzee Bonus"].score += 100
+                    self.scores[seat]["Yahtzee Bonus"].score += 100
                     return 100
         return 0
 
@@ -216,22 +216,22 @@ class Scoreboard(object):
             self.maxi, self.yahtzee
         )
 
-    def award_upper_section_bonus(self, player):
+    def award_upper_section_bonus(self, seat):
         """Check if Upper Section Bonus is to be awarded and give it"""
         upper_section_bonus = self.get_upper_section_bonus_score()
-        if self.scores[player].get(
+        if self.scores[seat].get(
                 "Up. Sect. Total").score >= upper_section_bonus:
             # And if we didn't score the bonus yet
-            if not self.scores[player].get("Up. Sect. Bonus").score:
+            if not self.scores[seat].get("Up. Sect. Bonus").score:
                 # Add 50 extra points to Upper Section Bonus (35 for Yahtzee)
                 bonus = self.get_upper_section_bonus_value()
-                self.scores[player]["Up. Sect. Bonus"].set_score(bonus)
+                self.scores[seat]["Up. Sect. Bonus"].set_score(bonus)
                 return bonus
         return 0
 
-    def check_upper_section_bonus_achievable(self, player):
+    def check_upper_section_bonus_achievable(self, seat):
         dice_count = 6 if self.maxi else 5
-        upper_boxes = list(self.scores[player].values())[:6]
+        upper_boxes = list(self.scores[seat].values())[:6]
         up_sec_target = self.get_upper_section_bonus_score()
         max_achievable = 0
         for i in range(6):
@@ -244,57 +244,50 @@ class Scoreboard(object):
             return False
         return True
 
-    def calculate_expected_delta(self, player):
-        upper_boxes = list(self.scores[player].values())[:6]
-        avg_dice_for_bonus = self.get_upper_section_bonus_score() // 21
-        delta = 0
-        for i in range(6):
-            if upper_boxes[i].score is not None:
-                delta += upper_boxes[i].score - ((i + 1) * avg_dice_for_bonus)
-        return delta
-
-    def zero_scoreboard(self, player):
-        for box in list(self.scores[player].values()):
+    def zero_scoreboard(self, seat):
+        for box in list(self.scores[seat].values()):
             if box.score is None:
                 box.set_score(0)
-        self.recompute_calculated_fields(player)
+        self.recompute_calculated_fields(seat)
 
-    def recompute_calculated_fields(self, player):
+    def recompute_calculated_fields(self, seat):
         """Compute all calculated boxes"""
+        # Scores are changing, so complete scoreboard has to be re-rendered
+        self._scores_cache = None
         # Recompute Upper Section Totals
         total = 0
-        for box in list(self.scores[player].values())[:6]:
+        for box in list(self.scores[seat].values())[:6]:
             total += box.score if box.score is not None else 0
-        self.scores[player]["Up. Sect. Total"].set_score(total)
+        self.scores[seat]["Up. Sect. Total"].set_score(total)
         # Compute and award upper section bonus
-        bonus = self.award_upper_section_bonus(player)
+        bonus = self.award_upper_section_bonus(seat)
         # Keep upper score to compute lower subtotal
-        upper = total + self.scores[player].get("Up. Sect. Bonus").score
+        upper = total + self.scores[seat].get("Up. Sect. Bonus").score
         # Proceed to compute totals
-        for box in list(self.scores[player].values())[7:-2]:
+        for box in list(self.scores[seat].values())[7:-2]:
             total += box.score if box.score is not None else 0
         # Compute lower section subtotal
-        self.scores[player]["Low. Sect. Total"].set_score(total - upper)
-        self.scores[player]["Grand Total"].set_score(total)
+        self.scores[seat]["Low. Sect. Total"].set_score(total - upper)
+        self.scores[seat]["Grand Total"].set_score(total)
         return bonus
 
-    def get_score_options(self, player, dice, perf=False):
+    def get_score_options(self, seat, dice, perf=False):
         """Get viable scoring options, sorted in descending order"""
         # Special Yahtzee rules
         if self.yahtzee:
             # If we have already scored a Yahtzee with >0
-            if self.scores[player]["Yahtzee"].score:
+            if self.scores[seat]["Yahtzee"].score:
                 # And if we're scored another valid Yahtzee
-                if self.scores[player]["Yahtzee"].preview_dice(dice, perf):
+                if self.scores[seat]["Yahtzee"].preview_dice(dice, perf):
                     # Try to get a corresponding upper section box:
-                    box = list(self.scores[player].values())[int(dice[0]) - 1]
+                    box = list(self.scores[seat].values())[int(dice[0]) - 1]
                     if box.score is None:
                         return OrderedDict(
                             ((box.name, box.preview_dice(dice, perf)),))
                     # If no free boxes - joker rules allow to use any of lower
                     # boxes
                     res = []
-                    for box in list(self.scores[player].values())[8:15]:
+                    for box in list(self.scores[seat].values())[8:15]:
                         if box.score is None:
                             res.append(
                                 (box.name, box.preview_joker_dice(dice, perf)))
@@ -305,23 +298,23 @@ class Scoreboard(object):
                                 key=lambda x: x[1]))
                     # Finally, if there's only non-matching upper boxes left,
                     # use them and score 0
-                    for box in list(self.scores[player].values())[:6]:
+                    for box in list(self.scores[seat].values())[:6]:
                         if box.score is None:
                             res.append(
                                 (box.name, box.preview_joker_dice(dice, perf)))
                     return OrderedDict(res)
         # Regular scoring options
         scores = []
-        for box in self.scores[player].values():
+        for box in self.scores[seat].values():
             if box.score is None:
                 scores.append((box.name, box.preview_dice(dice, perf)))
                 if self.forced:
                     break  # In Forced Yatzy, we only give a first unfilled box
         return OrderedDict(sorted(scores, reverse=True, key=lambda x: x[1]))
 
-    def commit_dice_combination(self, player, dice, boxname):
+    def commit_dice_combination(self, seat, dice, boxname):
         """Commit dice combination"""
-        options = self.get_score_options(player, dice)
+        options = self.get_score_options(seat, dice)
         if boxname not in options:
             raise IllegalMoveError(
                 f"{ERROR} This move is not allowed in this situation."
@@ -330,57 +323,64 @@ class Scoreboard(object):
         # Special Yahtzee rules
         if self.yahtzee:
             # If we have already scored a Yahtzee with >0
-            if self.scores[player]["Yahtzee"].score:
+            if self.scores[seat]["Yahtzee"].score:
                 # And if we're scored another valid Yahtzee
-                if self.scores[player]["Yahtzee"].preview_dice(dice):
+                if self.scores[seat]["Yahtzee"].preview_dice(dice):
                     # Award a Yahtzee Bonus
-                    score += self.award_yahtzee_bonus(player, dice)
+                    score += self.award_yahtzee_bonus(seat, dice)
                     # Try to get a corresponding upper section box:
-                    scoretable = self.scores[player]
+                    scoretable = self.scores[seat]
                     box = scoretable[boxname]
                     if boxname == list(scoretable.keys())[int(dice[0]) - 1]:
                         score += box.commit_dice(dice)
                     else:
                         score += box.commit_joker_dice(dice)
                     # Update computable fields
-                    score += self.recompute_calculated_fields(player)
+                    score += self.recompute_calculated_fields(seat)
                     return score
         # Regular scoring rules
-        score += self.scores[player][boxname].commit_dice(dice)
+        score += self.scores[seat][boxname].commit_dice(dice)
         # Update computable fields
-        score += self.recompute_calculated_fields(player)
+        score += self.recompute_calculated_fields(seat)
         return score
 
-    def is_filled(self, player):
+    def is_filled(self, seat):
         """Check, whether all player's scoring boxes are filled"""
-        for box in self.scores[player].values():
+        for box in self.scores[seat].values():
             if box.score is None:
                 return False
         return True
 
     def is_finished(self):
         """Check, whether scoreboard is completely filled (and so is game)"""
-        for player in self.players:
-            if not self.is_filled(player):
+        for seat in range(len(self.players)):
+            if not self.is_filled(seat):
                 return False
         return True
 
-    def print_player_scores(self, player):
-        """Print scoreboard for particular player"""
-        output = [["", player.user.username or player.user.first_name]]
+    @traced("render")
+    def print_player_scores(self, seat, bonus_chance=None):
+        """
+        Print scoreboard for particular player (with a probability to get
+        upper section bonus, if it's known)
+        """
+        output = [["", self.players[seat].short_name]]
         up_sec_bonus = self.get_upper_section_bonus_score()
-        up_sec_total = self.scores[player].get("Up. Sect. Total").score
+        up_sec_total = self.scores[seat].get("Up. Sect. Total").score
         remaining = max(up_sec_bonus - up_sec_total, 0)
         bonus_value = self.get_upper_section_bonus_value()
-        lost = not self.check_upper_section_bonus_achievable(player)
-        for box in self.scores[player].values():
+        lost = not self.check_upper_section_bonus_achievable(seat)
+        for box in self.scores[seat].values():
             if box.name == "Up. Sect. Total":
-                delta_msg = ""
-                if not lost and remaining:
-                    delta = self.calculate_expected_delta(player)
-                    if delta:
-                        delta_msg = f" ({delta:+})"
-                output.append([box.name, f"{box.score}{delta_msg}"])
+                chance_msg = ""
+                if not lost and remaining and bonus_chance is not None:
+                    if bonus_chance < 0.01:
+                        chance_msg = " (<1%)"
+                    elif bonus_chance > 0.99:
+                        chance_msg = " (>99%)"
+                    else:
+                        chance_msg = f" ({bonus_chance:.0%})"
+                output.append([box.name, f"{box.score}{chance_msg}"])
             else:
                 output.append(
                     [box.name, "" if box.score is None else str(box.score)]
@@ -395,50 +395,91 @@ class Scoreboard(object):
                     [f"{bonus_value} pts. if ≥ {up_sec_bonus}", bonus]
                 )
                 output.append(["", ""])
+        from tabulate import tabulate  # Deferred, to start faster
         return tabulate(output, tablefmt="simple")
 
-    def print_scores(self):
-        """Print complete scoreboard"""
+    def _tabulate_scores(self, seats):
+        """Tabulate a complete scoreboard for a group of players"""
         output = [[""]]
-        output[0].extend(self.players)
-        for box in self.scores[self.players[0]]:
+        output[0].extend([self.players[seat].short_name for seat in seats])
+        for box in self.scores[0]:
             scores = [box]
-            for player in self.players:
+            for seat in seats:
                 scores.append(
-                    self.scores[player][box].score
-                    if self.scores[player][box].score is not None else "")
+                    self.scores[seat][box].score
+                    if self.scores[seat][box].score is not None else "")
             output.append(scores)
+        from tabulate import tabulate  # Deferred, to start faster
         return tabulate(output, tablefmt="simple")
 
+    @traced("render")
+    def print_scores(self, limit=None):
+        """
+        Print complete scoreboard as a list of multi-column tables, each of
+        them fitting into limit characters (players are split between several
+        tables only when all of them don't fit into one)
+        """
+        if self._scores_cache is not None and self._scores_cache[0] == limit:
+            return self._scores_cache[1]
+        tables = []
+        seats = list(range(len(self.players)))
+        while seats:
+            count = len(seats)
+            table = self._tabulate_scores(seats)
+            while limit is not None and count > 1 and len(table) > limit:
+                count -= 1
+                table = self._tabulate_scores(seats[:count])
+            tables.append(table)
+            seats = seats[count:]
+        self._scores_cache = (limit, tables)
+        return tables
+
+    def ranking(self):
+        """Get seats ordered by total score (from the best)"""
+        return sorted(
+            range(len(self.players)), reverse=True,
+            key=lambda seat: self.scores[seat]['Grand Total'].score
+        )
+
     def final_scores(self):
         """Get final scoring"""
-        scores = []
-        for player in self.players:
-            scores.append((player, self.scores[player]['Grand Total'].score))
-        return OrderedDict(sorted(scores, reverse=True, key=lambda x: x[1]))
+        return OrderedDict(
+            (self.players[seat], self.scores[seat]['Grand Total'].score)
+            for seat in self.ranking()
+        )
 
-    def print_final_scores(self):
-        """Get string representation of final scores"""
-        scores = self.final_scores()
+    @traced("render")
+    def print_final_scores(self, metrics=None):
+        """
+        Get string representation of final scores (with players' luck and
+        skill loss by seat, if they are known - None otherwise)
+        """
+        ranking = self.ranking()
+        totals = [scores['Grand Total'].score for scores in self.scores]
         output = []
         place = 1
         last_score = 0
-        min_score = min(scores.values())
-        max_score = max(scores.values())
-        for player in scores:
-            if scores[player] == last_score:
+        min_score = min(totals)
+        max_score = max(totals)
+        for seat in ranking:
+            if totals[seat] == last_score:
                 place = max(1, place - 1)
             placeemoji = POSITIONS.get(place, LOLLIPOP)
-            if len(scores) > 1 and min_score != max_score:
-                if scores[player] == min_score:
+            if len(ranking) > 1 and min_score != max_score:
+                if totals[seat] == min_score:
                     placeemoji = LOLLIPOP
+            details = ""
+            if metrics and metrics[seat][0] is not None:
+                luck, skill_loss = metrics[seat]
+                details = (f", {LUCK} luck {luck:+.0f}, "
+                           f"{SKILL} skill loss {skill_loss:.0f}")
             output.append(
                 f"{placeemoji} {place}"
                 f"{SUFFIX.get(place, 'th')} place - "
-                f"{player} ({scores[player]} points)"
+                f"{self.players[seat]} ({totals[seat]} points{details})"
             )
             place += 1
-            last_score = scores[player]
+            last_score = totals[seat]
         return '\n'.join(output)
 
 
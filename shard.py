@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sharded mode: games are split between worker processes by chat id.
+
+Supervisor polls for updates and routes each of them to a worker, that owns
+its chat, over a queue. Chats are assigned to workers with a consistent
+hash ring, but a chat with a live game stays on its worker, so workers can
+be added (on SIGUSR1) without disturbing games in progress. Workers reply
+directly, within a message rate budget shared by all of them.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from bisect import bisect, insort
+from hashlib import blake2b
+from time import monotonic
+
+from telegram import Update
+from telegram.ext import Application, MessageHandler
+
+from const import (
+    HTTP_POOL_SIZE,
+    HTTP_UPDATES_POOL_SIZE,
+    SHARD_RATE,
+    SHARD_VNODES,
+    TRACE_FILE,
+)
+from creds import TOKEN
+from logs import setup_logging
+from metrics import RequestStats, TimedRateLimiter, bot_request
+from tracing import setup_tracing
+
+logger = logging.getLogger(__name__)
+
+
+def ring_hash(key):
+    """Position of a key on hash ring"""
+    return int.from_bytes(
+        blake2b(str(key).encode(), digest_size=8).digest(), "big"
+    )
+
+
+class HashRing(object):
+    """Consistent hash ring, mapping chat ids to workers"""
+
+    def __init__(self, vnodes=SHARD_VNODES):
+        self.vnodes = vnodes
+        self.points = []  # Sorted positions
+        self.nodes = {}  # Worker by position
+
+    def add(self, node):
+        """Add a worker (it takes over ~1/N of chats from others)"""
+        for i in range(self.vnodes):
+            point = ring_hash(f"{node}#{i}")
+            self.nodes[point] = node
+            insort(self.points, point)
+
+    def owner(self, key):
+        """Get a worker, which owns a key"""
+        i = bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.nodes[self.points[i]]
+
+
+class SharedBudget(object):
+    """
+    Message rate budget, shared between processes (a token bucket kept as
+    a theoretical arrival time in shared memory, bursts up to rate)
+    """
+
+    def __init__(self, context, rate=SHARD_RATE):
+        self.interval = 1 / rate
+        self.tolerance = 1 - self.interval
+        self.arrival = context.Value('d', 0.0)
+
+    def reserve(self):
+        """Reserve a message, returning how long to wait before sending"""
+        now = monotonic()
+        with self.arrival.get_lock():
+            arrival = max(self.arrival.value, now)
+            self.arrival.value = arrival + self.interval
+        return max(arrival - self.tolerance - now, 0.0)
+
+    def pause(self, delay):
+        """Hold off all workers (e.g. Telegram has asked to retry later)"""
+        with self.arrival.get_lock():
+            self.arrival.value = max(
+                self.arrival.value, monotonic() + delay + self.tolerance
+            )
+
+
+class SharedRateLimiter(TimedRateLimiter):
+    """
+    Rate limiter, which takes overall limit from a budget shared by all
+    workers (per-group limits stay local, as each chat has a single worker)
+    """
+
+    def __init__(self, budget, **kwargs):
+        TimedRateLimiter.__init__(self, overall_max_rate=0, **kwargs)
+        self.budget = budget
+
+    async def acquire(self, data):
+        if data.get("chat_id") is not None and not data.get(
+                "allow_paid_broadcast"):
+            await asyncio.sleep(self.budget.reserve())
+
+    def retry_after(self, delay):
+        self.budget.pause(delay)
+
+
+def live_reporter(bot, index, events):
+    """
+    Get a handler, which reports chats, that have a live game in some topic,
+    to supervisor (it runs after the bot's own handlers)
+    """
+    live = {}  # Topics with a live game by chat id
+
+    async def report(update, _):
+        table = bot.get_table(update)
+        chat_id, thread = table
+        game = bot.gamemanager.game(table)
+        topics = live.setdefault(chat_id, set())
+        was_live = bool(topics)
+        if game is not None and not game.finished:
+            topics.add(thread)
+        else:
+            topics.discard(thread)
+        if bool(topics) != was_live:
+            events.put((index, chat_id, bool(topics)))
+        if not topics:
+            del live[chat_id]
+
+    return report
+
+
+async def _serve(application, bot, index, updates):
+    """Process routed updates (concurrently, as a standalone bot does)"""
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    logger.info("Shard worker %d is ready", index)
+    while True:
+        data = await loop.run_in_executor(None, updates.get)
+        if data is None:
+            break
+        await application.update_queue.put(
+            Update.de_json(data, application.bot)
+        )
+    await application.stop()
+    await bot.post_shutdown(application)
+    await application.shutdown()
+
+
+def run_worker(index, updates, events, budget, compute_workers):
+    """Entry point of a worker process"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Supervisor stops us
+    setup_logging()
+    root, ext = os.path.splitext(TRACE_FILE)
+    setup_tracing(f"{root}-{index}{ext}")  # Each worker has its own file
+    import YatzyBot as bot
+    bot.compute.workers = compute_workers
+    bot.stats.shared = True
+    application = (
+        Application.
+        builder().
+        token(TOKEN).
+        updater(None).
+        request(bot_request(bot.metrics.http, "send", HTTP_POOL_SIZE)).
+        rate_limiter(SharedRateLimiter(budget)).
+        concurrent_updates(True).
+        build()
+    )
+    bot.setup(application)
+    application.add_handler(
+        MessageHandler(bot.COMMANDS, live_reporter(bot, index, events)),
+        group=1
+    )
+    asyncio.run(_serve(application, bot, index, updates))
+
+
+class Supervisor(object):
+    """Runs shard workers and routes updates to them"""
+
+    def __init__(self, workers):
+        self.size = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.budget = SharedBudget(self.context)
+        self.events = self.context.Queue()
+        self.workers = []  # Processes and their update queues
+        self.ring = HashRing()
+        self.live = {}  # Worker by chat id, for chats with a live game
+        self.listener = None
+
+    def _spawn(self, index):
+        updates = self.context.Queue()
+        process = self.context.Process(
+            target=run_worker, name=f"shard-{index}",
+            args=(index, updates, self.events, self.budget,
+                  max((os.cpu_count() or 1) // self.size, 1))
+        )
+        process.start()
+        return process, updates
+
+    def add_worker(self):
+        """Start one more worker and give it its share of new chats"""
+        index = len(self.workers)
+        self.workers.append(self._spawn(index))
+        self.ring.add(index)
+        logger.info("Shard worker %d has started", index)
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await loop.run_in_executor(None, self.events.get)
+            if event is None:
+                return
+            index, chat_id, running = event
+            if running:
+                self.live[chat_id] = index
+            elif self.live.get(chat_id) == index:
+                del self.live[chat_id]
+
+    async def start(self, _: Application):
+        """Build lookup tables once, then bring up workers"""
+        from bonus import load_bonus_tables
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, load_bonus_tables)
+        for _ in range(self.size):
+            self.add_worker()
+        self.listener = asyncio.create_task(self._listen())
+        loop.add_signal_handler(signal.SIGUSR1, self.add_worker)
+
+    async def stop(self, _: Application):
+        """Let workers finish queued updates and shut down"""
+        loop = asyncio.get_running_loop()
+        loop.remove_signal_handler(signal.SIGUSR1)
+        for _, updates in self.workers:
+            updates.put(None)
+        for process, _ in self.workers:
+            await loop.run_in_executor(None, process.join)
+        self.events.put(None)
+        await self.listener
+
+    async def route(self, update, _):
+        """Pass an update to a worker, which owns its chat"""
+        chat_id = update.effective_chat.id
+        index = self.live.get(chat_id)
+        if index is None:
+            index = self.ring.owner(chat_id)
+        process, updates = self.workers[index]
+        if not process.is_alive():
+            logger.error("Shard worker %d has died, restarting it", index)
+            for chat, owner in list(self.live.items()):
+                if owner == index:
+                    del self.live[chat]  # Its games are lost
+            process, updates = self.workers[index] = self._spawn(index)
+        updates.put(update.to_dict())
+
+    def run(self, handler_filter):
+        """Poll for updates and route them (until interrupted)"""
+        http = RequestStats()
+        application = (
+            Application.
+            builder().
+            token(TOKEN).
+            request(bot_request(http, "send", 1)).
+            get_updates_request(bot_request(
+                http, "updates", HTTP_UPDATES_POOL_SIZE
+            )).
+            post_init(self.start).
+            post_shutdown(self.stop).
+            build()
+        )
+        application.add_handler(MessageHandler(handler_filter, self.route))
+        logger.info("YatzyBot has started with %d shard(s).", self.size)
+        application.run_polling()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from functools import lru_cache
+from itertools import combinations_with_replacement
+from math import comb, factorial
+
+from dice import Dice
+
+
+def multinomial_probability(counts):
+    """Probability to roll particular counts of each face"""
+    ndice = sum(counts)
+    ways = factorial(ndice)
+    for count in counts:
+        ways //= factorial(count)
+    return ways / 6 ** ndice
+
+
+def hand_distribution(ndice):
+    """Get all sorted hands (as face counts) with their probabilities"""
+    hands = []
+    for hand in combinations_with_replacement(range(6), ndice):
+        counts = [hand.count(face) for face in range(6)]
+        hands.append((multinomial_probability(counts), counts))
+    return hands
+
+
+@lru_cache(maxsize=None)
+def keep_face_chain(ndice, rerolls):
+    """
+    Get chain[c][k] - probability to end up with k dice of some face, having
+    c of them initially, if all of them are kept on each reroll
+    """
+    step = [[0.0] * (ndice + 1) for _ in range(ndice + 1)]
+    for c in range(ndice + 1):
+        free = ndice - c
+        for new in range(free + 1):
+            step[c][c + new] = (comb(free, new) * (1 / 6) ** new
+                                * (5 / 6) ** (free - new))
+    chain = [[float(c == k) for k in range(ndice + 1)]
+             for c in range(ndice + 1)]
+    for _ in range(rerolls):
+        chain = [
+            [sum(chain[c][j] * step[j][k] for j in range(ndice + 1))
+             for k in range(ndice + 1)]
+            for c in range(ndice + 1)
+        ]
+    return chain
+
+
+class HandSpace(object):
+    """All sorted hands of some number of dice and rerolls between them"""
+
+    def __init__(self, ndice):
+        self.ndice = ndice
+        faces = range(1, 7)
+        self.hands = list(combinations_with_replacement(faces, ndice))
+        self.index = {hand: i for i, hand in enumerate(self.hands)}
+        # Every multiset of dice, which could be kept before a reroll
+        self.keeps = []
+        for size in range(ndice + 1):
+            self.keeps.extend(combinations_with_replacement(faces, size))
+        self.keep_index = {keep: i for i, keep in enumerate(self.keeps)}
+        # Hands (and their probabilities) each keep could turn into
+        self.transitions = []
+        for keep in self.keeps:
+            outcomes = []
+            size = ndice - len(keep)
+            for roll in combinations_with_replacement(faces, size):
+                counts = [roll.count(face) for face in faces]
+                outcomes.append((
+                    self.index[tuple(sorted(keep + roll))],
+                    multinomial_probability(counts)
+                ))
+            self.transitions.append(outcomes)
+        # Distinct keeps for each hand
+        self.hand_keeps = []
+        for hand in self.hands:
+            keeps = set()
+            for mask in range(1 << ndice):
+                keeps.add(tuple(
+                    die for pos, die in enumerate(hand) if mask & (1 << pos)
+                ))
+            self.hand_keeps.append(sorted(self.keep_index[k] for k in keeps))
+        self.first_roll = self.transitions[self.keep_index[()]]
+
+    def score(self, box):
+        """Score every hand in a scoreboard box"""
+        return [box.rule([Dice(die) for die in hand]) for hand in self.hands]
+
+    def keep_values(self, values):
+        """Expected value of every keep, given values of resulting hands"""
+        return [
+            sum([probability * values[hand] for hand, probability in outcomes])
+            for outcomes in self.transitions
+        ]
+
+    def turn_levels(self, terminal, rerolls):
+        """
+        Get values[r][h] - value of a hand h with r rerolls left, if terminal
+        values are received when no rerolls are left (or hand is kept)
+        """
+        levels = [terminal]
+        for _ in range(rerolls):
+            keep_values = self.keep_values(levels[-1])
+            levels.append([
+                max([keep_values[keep] for keep in keeps])
+                for keeps in self.hand_keeps
+            ])
+        return levels
+
+    def expected(self, values):
+        """Expected value of a fresh roll, given values of all hands"""
+        return sum([probability * values[hand]
+                    for hand, probability in self.first_roll])
+
+    def hand_keep_values(self, hand, values):
+        """
+        Get expected value of keeping each subset of dice from hand (by dice
+        kept), given values of hands after reroll
+        """
+        return {
+            self.keeps[keep]: sum([
+                probability * values[outcome]
+                for outcome, probability in self.transitions[keep]
+            ])
+            for keep in self.hand_keeps[self.index[hand]]
+        }
+
+    def best_keep(self, hand, values):
+        """
+        Find the best dice to keep from hand and its expected value, given
+        values of hands after reroll
+        """
+        values = self.hand_keep_values(hand, values)
+        best = max(values, key=values.get)
+        return best, values[best]
+
+
+@lru_cache(maxsize=None)
+def hand_space(ndice):
+    """Get (and cache) a hand space for some number of dice"""
+    return HandSpace(ndice)
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import sqlite3
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from const import (
+    STATS_DB,
+    STATS_FLUSH_INTERVAL,
+    SCORE_BUCKET,
+    TOP_SIZE,
+    TOP_RECENT_DAYS,
+)
+from rating import update_ratings
+from tables import variant_name
+
+logger = logging.getLogger(__name__)
+
+# Outcome of a finished game for a single player
+GameResult = namedtuple('GameResult', [
+    'chat_id', 'user_id', 'name', 'variant', 'score', 'won', 'left',
+    'yatzies', 'bonus', 'finished_at'
+])
+
+# Leaderboard scope of all chats (otherwise scope is a chat id)
+GLOBAL = 0
+DAY = 86400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS player_stats (
+    user_id INTEGER NOT NULL,
+    variant TEXT NOT NULL,
+    games INTEGER NOT NULL,
+    finished INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    total_score INTEGER NOT NULL,
+    best_score INTEGER,
+    yatzies INTEGER NOT NULL,
+    bonuses INTEGER NOT NULL,
+    PRIMARY KEY (user_id, variant)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS score_histogram (
+    user_id INTEGER NOT NULL,
+    variant TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user_id, variant, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS top_scores (
+    scope INTEGER NOT NULL,
+    variant TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    PRIMARY KEY (scope, variant, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS top_scores_rank
+    ON top_scores (scope, variant, score);
+CREATE TABLE IF NOT EXISTS daily_top_scores (
+    scope INTEGER NOT NULL,
+    variant TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    PRIMARY KEY (scope, variant, day, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS daily_top_scores_rank
+    ON daily_top_scores (scope, variant, day, score);
+CREATE TABLE IF NOT EXISTS games (
+    game_id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    variant TEXT NOT NULL,
+    finished_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    game_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    has_left INTEGER NOT NULL,
+    PRIMARY KEY (game_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ratings (
+    user_id INTEGER NOT NULL,
+    variant TEXT NOT NULL,
+    rating REAL NOT NULL,
+    games INTEGER NOT NULL,
+    PRIMARY KEY (user_id, variant)
+) WITHOUT ROWID;
+"""
+
+UPSERT_STATS = """
+INSERT INTO player_stats VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (user_id, variant) DO UPDATE SET
+    games = games + 1,
+    finished = finished + excluded.finished,
+    wins = wins + excluded.wins,
+    total_score = total_score + excluded.total_score,
+    best_score = MAX(COALESCE(best_score, excluded.best_score),
+                     COALESCE(excluded.best_score, best_score)),
+    yatzies = yatzies + excluded.yatzies,
+    bonuses = bonuses + excluded.bonuses
+"""
+
+UPSERT_HISTOGRAM = """
+INSERT INTO score_histogram VALUES (?, ?, ?, 1)
+ON CONFLICT (user_id, variant, bucket) DO UPDATE SET count = count + 1
+"""
+
+UPSERT_USER = """
+INSERT INTO users VALUES (?, ?)
+ON CONFLICT (user_id) DO UPDATE SET name = excluded.name
+"""
+
+# Top-K tables keep only K best users per leaderboard (or per its day)
+UPSERT_TOP = """
+INSERT INTO top_scores VALUES (?, ?, ?, ?)
+ON CONFLICT (scope, variant, user_id) DO UPDATE SET
+    score = MAX(score, excluded.score)
+"""
+
+TRIM_TOP = """
+DELETE FROM top_scores WHERE scope = ?1 AND variant = ?2 AND user_id NOT IN (
+    SELECT user_id FROM top_scores WHERE scope = ?1 AND variant = ?2
+    ORDER BY score DESC LIMIT ?3
+)
+"""
+
+UPSERT_DAILY_TOP = """
+INSERT INTO daily_top_scores VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (scope, variant, day, user_id) DO UPDATE SET
+    score = MAX(score, excluded.score)
+"""
+
+TRIM_DAILY_TOP = """
+DELETE FROM daily_top_scores
+WHERE scope = ?1 AND variant = ?2 AND day = ?3 AND user_id NOT IN (
+    SELECT user_id FROM daily_top_scores
+    WHERE scope = ?1 AND variant = ?2 AND day = ?3
+    ORDER BY score DESC LIMIT ?4
+)
+"""
+
+EXPIRE_DAILY_TOP = "DELETE FROM daily_top_scores WHERE day < ?"
+
+INSERT_GAME = """
+INSERT INTO games (chat_id, variant, finished_at) VALUES (?, ?, ?)
+"""
+
+INSERT_RESULT = "INSERT INTO results VALUES (?, ?, ?, ?)"
+
+SELECT_TOP = """
+SELECT users.name, top.score FROM top_scores AS top
+JOIN users USING (user_id)
+WHERE top.scope = ? AND top.variant = ?
+ORDER BY top.score DESC LIMIT ?
+"""
+
+SELECT_DAILY_TOP = """
+SELECT users.name, MAX(top.score) AS best FROM daily_top_scores AS top
+JOIN users USING (user_id)
+WHERE top.scope = ? AND top.variant = ? AND top.day >= ?
+GROUP BY top.user_id ORDER BY best DESC LIMIT ?
+"""
+
+
+def game_results(game):
+    """
+    Get results of a finished game for each player. Players, who have left
+    the game, can't win and their scores are not counted.
+    """
+    scoreboard = game.scoreboard
+    ranking = scoreboard.ranking()
+    totals = [scores["Grand Total"].score for scores in scoreboard.scores]
+    best = max(
+        (totals[seat] for seat in ranking if game.is_active(seat)),
+        default=None
+    )
+    variant = variant_name(game.yahtzee, game.forced, game.maxi)
+    finished_at = int(time())
+    results = []
+    for seat in ranking:
+        player = scoreboard.players[seat]
+        score = totals[seat]
+        scores = scoreboard.scores[seat]
+        yatzies = 0
+        for name in ("Yatzy", "Maxi Yatzy", "Yahtzee"):
+            if name in scores and scores[name].score:
+                yatzies += 1
+        if "Yahtzee Bonus" in scores:
+            yatzies += scores["Yahtzee Bonus"].score // 100
+        left = not game.is_active(seat)
+        results.append(GameResult(
+            game.chat, player.id, str(player), variant, score,
+            len(ranking) > 1 and not left and score == best, left, yatzies,
+            bool(scores["Up. Sect. Bonus"].score), finished_at
+        ))
+    return results
+
+
+class StatsStore(object):
+    """
+    Persistent per-user statistics, kept as aggregate rows in SQLite. Game
+    results are queued and written in batches by a background task, while
+    all database access goes through a single thread.
+    """
+
+    def __init__(self, path=STATS_DB, flush_interval=STATS_FLUSH_INTERVAL,
+                 top_size=TOP_SIZE, shared=False):
+        self.path = path
+        # If True - other processes write into database too, so global
+        # leaderboards can change behind our back and aren't cached
+        self.shared = shared
+        self.flush_interval = flush_interval
+        self.top_size = top_size
+        self.leaderboards = {}  # Cached leaderboards, until they change
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="stats")
+        self.conn = None
+        self.queue = None
+        self.writer = None
+        self.flushing = None
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def start(self):
+        """Open database and start a background writer"""
+        await self._call(self._connect)
+        self.queue = asyncio.Queue()
+        self.writer = asyncio.create_task(self._write_loop())
+
+    async def stop(self):
+        """Write all queued results and close database"""
+        if self.writer is None:
+            return
+        self.writer.cancel()
+        try:
+            await self.writer
+        except asyncio.CancelledError:
+            pass
+        self.writer = None
+        if self.flushing is not None:
+            await self.flushing
+        await self._flush()
+        await self._call(self.conn.close)
+
+    def record(self, game):
+        """Queue results of a finished game (to be used as on_finish hook)"""
+        if self.queue is None:
+            return
+        self.queue.put_nowait(game_results(game))
+
+    def _write_history(self, results):
+        """Append game to history and update its players' ratings"""
+        first = results[0]
+        game_id = self.conn.execute(INSERT_GAME, (
+            first.chat_id, first.variant, first.finished_at
+        )).lastrowid
+        self.conn.executemany(INSERT_RESULT, (
+            (game_id, r.user_id, r.score, int(r.left)) for r in results
+        ))
+        update_ratings(self.conn, first.variant, {
+            r.user_id: (r.score, r.left) for r in results
+        })
+
+    def _write(self, games):
+        changed = set()
+        results = [result for game in games for result in game]
+        with self.conn:
+            # Lock up front, as ratings are read before they're updated
+            self.conn.execute("BEGIN IMMEDIATE")
+            for game in games:
+                self._write_history(game)
+            for r in results:
+                score = None if r.left else r.score
+                self.conn.execute(UPSERT_STATS, (
+                    r.user_id, r.variant, int(not r.left), int(r.won),
+                    score or 0, score, r.yatzies, int(r.bonus)
+                ))
+                self.conn.execute(UPSERT_USER, (r.user_id, r.name))
+                if r.left:
+                    continue
+                self.conn.execute(UPSERT_HISTOGRAM, (
+                    r.user_id, r.variant, r.score // SCORE_BUCKET
+                ))
+                day = r.finished_at // DAY
+                for scope in (GLOBAL, r.chat_id):
+                    self.conn.execute(UPSERT_TOP, (
+                        scope, r.variant, r.user_id, r.score
+                    ))
+                    self.conn.execute(UPSERT_DAILY_TOP, (
+                        scope, r.variant, day, r.user_id, r.score
+                    ))
+                    changed.add((scope, r.variant, day))
+            for scope, variant, day in changed:
+                self.conn.execute(TRIM_TOP, (scope, variant, self.top_size))
+                self.conn.execute(
+                    TRIM_DAILY_TOP, (scope, variant, day, self.top_size)
+                )
+            self.conn.execute(
+                EXPIRE_DAILY_TOP, (time() // DAY - TOP_RECENT_DAYS,)
+            )
+        return {(scope, variant) for scope, variant, _ in changed}
+
+    async def _flush(self):
+        games = []
+        while not self.queue.empty():
+            games.append(self.queue.get_nowait())
+        if games:
+            try:
+                changed = await self._call(self._write, games)
+            except sqlite3.Error as e:
+                logger.error("Failed to record game results: %s", e)
+                return
+            for key in list(self.leaderboards):
+                if key[:2] in changed:
+                    del self.leaderboards[key]
+            logger.info("Recorded %d game(s)", len(games))
+
+    async def _write_loop(self):
+        while True:
+            # Results are put back, so nothing is lost, if we're cancelled
+            self.queue.put_nowait(await self.queue.get())
+            # Let results of other games pile up into a single transaction
+            await asyncio.sleep(self.flush_interval)
+            # Batch is shielded, so stop() could wait until it's written
+            self.flushing = asyncio.ensure_future(self._flush())
+            await asyncio.shield(self.flushing)
+
+    def _read(self, user_id):
+        stats = {}
+        for row in self.conn.execute(
+                "SELECT variant, games, finished, wins, total_score, "
+                "best_score, yatzies, bonuses FROM player_stats "
+                "WHERE user_id = ? ORDER BY games DESC", (user_id,)):
+            stats[row[0]] = dict(zip(
+                ("games", "finished", "wins", "total_score", "best_score",
+                 "yatzies", "bonuses"), row[1:]
+            ), histogram={})
+        for variant, rating in self.conn.execute(
+                "SELECT variant, rating FROM ratings WHERE user_id = ?",
+                (user_id,)):
+            if variant in stats:
+                stats[variant]["rating"] = rating
+        for variant, bucket, count in self.conn.execute(
+                "SELECT variant, bucket, count FROM score_histogram "
+                "WHERE user_id = ? ORDER BY bucket", (user_id,)):
+            stats[variant]["histogram"][bucket * SCORE_BUCKET] = count
+        return stats
+
+    async def player_stats(self, user_id):
+        """Get user's aggregate statistics per game variant"""
+        return await self._call(self._read, user_id)
+
+    def _read_top(self, scope, variant, recent):
+        if not recent:
+            return self.conn.execute(
+                SELECT_TOP, (scope, variant, self.top_size)
+            ).fetchall()
+        since = time() // DAY - TOP_RECENT_DAYS + 1
+        return self.conn.execute(
+            SELECT_DAILY_TOP, (scope, variant, since, self.top_size)
+        ).fetchall()
+
+    async def top(self, variant, chat_id=None, recent=False):
+        """
+        Get a leaderboard (names and best scores) for a game variant, for
+        all chats or some chat, all-time or for recent days only
+        """
+        scope = GLOBAL if chat_id is None else chat_id
+        today = time() // DAY
+        key = (scope, variant, recent, today)
+        if self.shared and scope == GLOBAL:
+            return await self._call(self._read_top, scope, variant, recent)
+        if key not in self.leaderboards:
+            for stale in [k for k in self.leaderboards if k[3] != today]:
+                del self.leaderboards[stale]
+            self.leaderboards[key] = await self._call(
+                self._read_top, scope, variant, recent
+            )
+        return self.leaderboards[key]
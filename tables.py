@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary lookup tables, shared between processes via mmap.
+
+Table file layout (little endian):
+
+    magic       8s   b"YZTABLE\\0"
+    version     H    format version
+    format      B    FLOAT16 or FIXED16
+    ndim        B    number of dimensions (up to MAX_DIMS)
+    scale       d    fixed-point scale (stored = round(value * scale))
+    name        32s  table name (e.g. a solver and game variant)
+    rule_hash   32s  SHA-256 of scoring rules the table was built for
+    dims        4I   table dimensions (unused ones are zero)
+    count       Q    number of values
+    checksum    I    CRC32 of the values
+    (padding up to HEADER_SIZE)
+    values      count * 2 bytes
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+from functools import lru_cache
+from itertools import combinations_with_replacement
+
+from const import TABLES_DIR
+from dice import Dice
+from error import TableError
+from scoreboard import Scoreboard
+
+MAGIC = b"YZTABLE\0"
+VERSION = 1
+FLOAT16 = 0
+FIXED16 = 1
+MAX_DIMS = 4
+HEADER = struct.Struct('<8sHBBd32s32s4IQI')
+HEADER_SIZE = 128
+VALUE_CODES = {FLOAT16: 'e', FIXED16: 'H'}
+
+_tables = {}
+
+
+def variant_name(yahtzee=False, forced=False, maxi=False):
+    """Get a short game variant name to be used in table names"""
+    name = []
+    if forced:
+        name.append("forced")
+    if maxi:
+        name.append("maxi")
+    name.append("yahtzee" if yahtzee else "yatzy")
+    return "-".join(name)
+
+
+def table_path(name):
+    """Get a path of a table file"""
+    return os.path.join(TABLES_DIR, f"{name}.tbl")
+
+
+@lru_cache(maxsize=None)
+def rule_hash(yahtzee=False, forced=False, maxi=False):
+    """
+    Fingerprint scoring rules of a game variant, by scoring every possible
+    hand in every box of a scoreboard
+    """
+    scoreboard = Scoreboard([None], yahtzee, forced, maxi)
+    digest = hashlib.sha256(variant_name(yahtzee, forced, maxi).encode())
+    digest.update(
+        str(Scoreboard.get_upper_section_bonus_score_static(maxi, forced))
+        .encode()
+    )
+    digest.update(
+        str(Scoreboard.get_upper_section_bonus_value_static(maxi, yahtzee))
+        .encode()
+    )
+    ndice = 6 if maxi else 5
+    hands = [
+        [Dice(value) for value in hand]
+        for hand in combinations_with_replacement(range(1, 7), ndice)
+    ]
+    for box in scoreboard.scores[0].values():
+        digest.update(f"{box.name}:{box.max_score}:".encode())
+        if box.rule is None:
+            continue
+        digest.update(
+            bytes(str([box.rule(hand) for hand in hands]), "ascii")
+        )
+        if box.joker_rule is not None:
+            digest.update(
+                bytes(str([box.joker_rule(hand) for hand in hands]), "ascii")
+            )
+    return digest.digest()
+
+
+def write_table(path, name, rulehash, dims, values, fmt=FLOAT16, scale=1.0):
+    """Write a table file (atomically, so readers never see partial data)"""
+    if len(dims) > MAX_DIMS:
+        raise TableError(f"Table can have at most {MAX_DIMS} dimensions")
+    if len(name.encode()) > 32:
+        raise TableError(f"Table name {name} is too long")
+    count = 1
+    for dim in dims:
+        count *= dim
+    if fmt == FIXED16:
+        values = [round(value * scale) for value in values]
+    if len(values) != count:
+        raise TableError(f"Expected {count} values, got {len(values)}")
+    payload = struct.pack(f"<{count}{VALUE_CODES[fmt]}", *values)
+    header = HEADER.pack(
+        MAGIC, VERSION, fmt, len(dims), scale, name.encode(), rulehash,
+        *(list(dims) + [0] * (MAX_DIMS - len(dims))), count,
+        zlib.crc32(payload)
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(header.ljust(HEADER_SIZE, b"\0"))
+        f.write(payload)
+    os.replace(tmp, path)
+
+
+class Table(object):
+    """A memory-mapped read-only lookup table"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < HEADER_SIZE:
+            self.close()
+            raise TableError(f"Table {path} is truncated")
+        (magic, version, self.format, ndim, self.scale, name, self.rule_hash,
+         *dims, self.count, self.checksum) = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise TableError(f"Table {path} has unsupported format")
+        self.name = name.rstrip(b"\0").decode()
+        self.dims = tuple(dims[:ndim])
+        self.strides = []
+        stride = 1
+        for dim in reversed(self.dims):
+            self.strides.insert(0, stride)
+            stride *= dim
+        self.value = struct.Struct(f"<{VALUE_CODES[self.format]}")
+        if len(self.mmap) != HEADER_SIZE + self.count * self.value.size:
+            self.close()
+            raise TableError(f"Table {path} is truncated")
+
+    def verify(self):
+        """Check table values against a checksum"""
+        with memoryview(self.mmap) as view:
+            return zlib.crc32(view[HEADER_SIZE:]) == self.checksum
+
+    def __getitem__(self, index):
+        """Look a value up by its indices (no data is copied)"""
+        offset = 0
+        for i, stride in zip(index, self.strides):
+            offset += i * stride
+        value = self.value.unpack_from(
+            self.mmap, HEADER_SIZE + offset * self.value.size
+        )[0]
+        if self.format == FIXED16:
+            return value / self.scale
+        return value
+
+    def close(self):
+        self.mmap.close()
+
+
+def open_table(path, name, rulehash):
+    """
+    Open a table, if it exists and was built for given scoring rules (or
+    return None otherwise)
+    """
+    table = _tables.pop(path, None)
+    if table is not None:
+        if table.name == name and table.rule_hash == rulehash:
+            _tables[path] = table
+            return table
+        table.close()
+    try:
+        table = Table(path)
+    except (OSError, TableError):
+        return None
+    if (table.name != name or table.rule_hash != rulehash
+            or not table.verify()):
+        table.close()
+        return None
+    _tables[path] = table
+    return table
+
+
+def load_table(path, name, rulehash, builder, fmt=FLOAT16, scale=1.0):
+    """
+    Open a table, (re)building it with builder() (which should return dims
+    and a flat list of values) if it's missing, corrupted, or was built for
+    different scoring rules
+    """
+    table = open_table(path, name, rulehash)
+    if table is None:
+        dims, values = builder()
+        write_table(path, name, rulehash, dims, values, fmt, scale)
+        table = open_table(path, name, rulehash)
+    return table
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# YatzyBot - A Telegram bot for playing Yatzy/Yahtzee
+# Copyright (C) 2019-2024  Vitaly Ostrosablin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lightweight tracing of updates.
+
+A sampled update gets a root span, and work done on its behalf (game
+operations, rendering, pacing sleeps, Bot API requests) gets child spans:
+
+    with span("render"):
+        ...
+
+Outside of a sampled update, span() is a no-op, so it's cheap enough to be
+left in place. Finished traces are written out by a background thread to a
+rotating JSONL file, one OTLP/JSON export request per line, so that they
+can be read as they are, or fed into an OpenTelemetry collector (with its
+otlpjsonfile receiver).
+"""
+
+import atexit
+import json
+import logging
+from contextvars import ContextVar
+from functools import wraps
+from logging.handlers import QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from random import Random
+from time import time_ns
+
+from const import TRACE_BACKUPS, TRACE_FILE, TRACE_MAX_BYTES, TRACE_SAMPLE
+from logs import LazyQueueHandler
+
+trace_logger = logging.getLogger("yatzybot.trace")
+trace_logger.propagate = False
+
+current = ContextVar("current_span", default=None)
+sample_rate = 0.0  # Fraction of updates to be traced, set up by setup_tracing
+ids = Random()
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span(object):
+    """Timed operation, which is a part of a trace"""
+
+    __slots__ = ('name', 'trace', 'trace_id', 'span_id', 'parent_id',
+                 'attrs', 'start', 'end', 'token')
+
+    def __init__(self, name, attrs, parent=None):
+        self.name = name
+        self.attrs = attrs
+        self.span_id = f"{ids.getrandbits(64):016x}"
+        if parent is None:
+            self.trace = []  # Finished spans of a trace
+            self.trace_id = f"{ids.getrandbits(128):032x}"
+            self.parent_id = None
+        else:
+            self.trace = parent.trace
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+        self.start = self.end = 0
+        self.token = None
+
+    def set(self, **attrs):
+        """Add attributes to a span"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time_ns()
+        self.token = current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time_ns()
+        current.reset(self.token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.append(self)
+        if self.parent_id is None:
+            trace_logger.info("%s", self.trace_id, extra={"trace": self.trace})
+        return False
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": key, "value": otlp_value(value)}
+                for key, value in self.attrs.items() if value is not None
+            ],
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        if "error" in self.attrs:
+            span["status"] = {"code": 2, "message": self.attrs["error"]}
+        return span
+
+
+class NoSpan(object):
+    """Span of an update, which isn't traced"""
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+def trace(name, **attrs):
+    """Start a trace (for a sampled fraction of calls)"""
+    if not sample_rate or ids.random() >= sample_rate:
+        return NO_SPAN
+    return Span(name, attrs)
+
+
+def span(name, **attrs):
+    """Start a child span of current span (if there's one)"""
+    parent = current.get()
+    if parent is None:
+        return NO_SPAN
+    return Span(name, attrs, parent)
+
+
+def traced(name):
+    """Decorator to run a function in a child span"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if current.get() is None:
+                return func(*args, **kwargs)
+            with span(name, function=func.__qualname__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class OTLPFormatter(logging.Formatter):
+    """Formats a trace as an OTLP/JSON trace export request"""
+
+    def format(self, record):
+        return json.dumps({"resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": otlp_value("yatzybot")},
+            ]},
+            "scopeSpans": [{
+                "scope": {"name": "yatzybot"},
+                "spans": [s.to_otlp() for s in record.trace],
+            }],
+        }]}, separators=(",", ":"))
+
+
+def setup_tracing(path=TRACE_FILE, sample=TRACE_SAMPLE):
+    """
+    Trace a given fraction of updates into a rotating file (nothing is
+    traced, if it's 0). Traces are written out by a background thread.
+    """
+    global sample_rate
+    if trace_logger.handlers or sample <= 0:
+        return  # Already set up, or disabled
+    handler = RotatingFileHandler(
+        path, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS,
+        delay=True
+    )
+    handler.setFormatter(OTLPFormatter())
+    queue = SimpleQueue()
+    listener = QueueListener(queue, handler)
+    trace_logger.addHandler(LazyQueueHandler(queue))
+    trace_logger.setLevel(logging.INFO)
+    listener.start()
+    atexit.register(listener.stop)
+    sample_rate = sample